@@ -17,6 +17,11 @@ while keeping the same hash.
 
 For some discussion on the specific design decisions here, see:
 https://github.com/rwth-i6/i6_experiments/issues/78
+
+Loading the autogenerated cache file, hashing the loaded object and checking all its paths
+can take a while for big objects. With the index (see :class:`DependencyBoundaryIndex`),
+an object which was validated before is loaded directly from a local sqlite store,
+without re-hashing, and only paths whose mtime changed since the last check are checked again.
 """
 
 from typing import Any, Optional, TypeVar, Callable
@@ -26,15 +31,27 @@ from i6_experiments.common.utils.dump_py_code import PythonCodeDumper
 from i6_experiments.common.utils.diff import collect_diffs
 import os
 import sys
+import time
+import pickle
+import sqlite3
 import textwrap
 import importlib.util
 
 
 T = TypeVar("T")
 
+# Default for the use_index argument of dependency_boundary.
+UseIndexByDefault = False
+# Filename of the index. If None, it is stored in the Sisyphus work dir.
+IndexFilename: Optional[str] = None
+# Options for the cache file, see :class:`PythonCodeDumper`.
+# Pickled cache files are much faster to create and to load for big objects, but are not human-readable.
+CacheDedupByContent = False
+CachePickled = False
+
 
 # noinspection PyShadowingBuiltins
-def dependency_boundary(func: Callable[[], T], *, hash: Optional[str]) -> T:
+def dependency_boundary(func: Callable[[], T], *, hash: Optional[str], use_index: Optional[bool] = None) -> T:
     """
     It basically returns func(), or some object which has the same hash.
 
@@ -44,6 +61,8 @@ def dependency_boundary(func: Callable[[], T], *, hash: Optional[str]) -> T:
     :param hash: sisyphus.hash.short_hash(func()), or None if you do not know this value yet.
         This value is used to verify the hash of the object.
         For new code when the hash is not known yet, you would pass None here, and it will print the hash on stdout.
+    :param use_index: use the :class:`DependencyBoundaryIndex` for validated cached objects.
+        If None, uses UseIndexByDefault.
     :return: func(), or object with same hash
     """
     hash_via_user = hash
@@ -51,7 +70,18 @@ def dependency_boundary(func: Callable[[], T], *, hash: Optional[str]) -> T:
     hash_via_cache = None
     cached_paths_available = False
 
+    if use_index is None:
+        use_index = UseIndexByDefault
+    index = get_index() if use_index and hash_via_user else None
+    index_key = f"{func.__module__}.{func.__qualname__}"
+
     cache_fn = get_cache_filename_for_func(func)
+    if index and os.path.exists(cache_fn):
+        obj_via_index = index.lookup(index_key, hash_via_user, cache_file_mtime=os.path.getmtime(cache_fn))
+        if obj_via_index is not None:
+            print(f"Dependency boundary for {func.__qualname__}: using indexed object with hash {hash_via_user}")
+            return obj_via_index
+
     if os.path.exists(cache_fn):
         try:
             obj_via_cache = load_obj_from_cache_file(cache_fn)
@@ -69,6 +99,8 @@ def dependency_boundary(func: Callable[[], T], *, hash: Optional[str]) -> T:
 
     if hash_via_user and hash_via_cache and hash_via_user == hash_via_cache and cached_paths_available:
         print(f"Dependency boundary for {func.__qualname__}: using cached object with hash {hash_via_user}")
+        if index:
+            index.store(index_key, hash_via_user, obj_via_cache, cache_file_mtime=os.path.getmtime(cache_fn))
         return obj_via_cache
 
     # Either user hash invalid, or cached hash invalid, or not all paths are available, or user hash not defined.
@@ -119,6 +151,9 @@ def dependency_boundary(func: Callable[[], T], *, hash: Optional[str]) -> T:
                 )
                 os.remove(cache_fn)  # make sure it is not used
 
+    if index and hash_via_user == hash_via_func == hash_via_cache:
+        index.store(index_key, hash_via_user, obj_via_cache, cache_file_mtime=os.path.getmtime(cache_fn))
+
     return obj_via_func
 
 
@@ -147,7 +182,9 @@ def save_obj_to_cache_file(obj: Any, *, cache_filename: str) -> None:
                 """
             )
         )
-        PythonCodeDumper(file=cache_f, use_fake_jobs=True).dump(obj, lhs="obj")
+        PythonCodeDumper(
+            file=cache_f, use_fake_jobs=True, dedup_by_content=CacheDedupByContent, pickled=CachePickled
+        ).dump(obj, lhs="obj")
 
 
 def load_obj_from_cache_file(cache_filename: str) -> Any:
@@ -175,3 +212,129 @@ def _paths_available(func, obj: Any) -> bool:
             # No need to print this for all paths, just the first one is enough.
             return False
     return True
+
+
+class DependencyBoundaryIndex:
+    """
+    Persistent index of validated dependency boundary objects, stored in a sqlite file.
+
+    Entries are keyed by the function qualname and the user hash.
+    An entry stores the pickled object, the verified hash, the mtime of the autogenerated cache file
+    and a snapshot of the mtimes of all paths of the object at the time they were found to be available.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self._conn = sqlite3.connect(self.filename, timeout=60)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS boundaries ("
+                    " key TEXT, user_hash TEXT, verified_hash TEXT, cache_file_mtime REAL, obj BLOB, created REAL,"
+                    " PRIMARY KEY (key, user_hash))"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS paths ("
+                    " key TEXT, user_hash TEXT, path TEXT, mtime REAL, checked REAL,"
+                    " PRIMARY KEY (key, user_hash, path))"
+                )
+        return self._conn
+
+    def lookup(self, key: str, user_hash: str, *, cache_file_mtime: float) -> Optional[Any]:
+        """
+        :return: the indexed object if it was validated for user_hash, the cache file did not change since,
+            and all its paths are still available, otherwise None
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT verified_hash, cache_file_mtime, obj FROM boundaries WHERE key = ? AND user_hash = ?",
+            (key, user_hash),
+        ).fetchone()
+        if row is None:
+            return None
+        verified_hash, indexed_cache_file_mtime, obj_blob = row
+        if verified_hash != user_hash or indexed_cache_file_mtime != cache_file_mtime:
+            return None
+        try:
+            obj = pickle.loads(obj_blob)
+        except Exception as exc:
+            print(f"Dependency boundary index: error, exception {type(exc).__name__} {str(exc)!r} for {key}")
+            return None
+
+        snapshot = dict(
+            conn.execute("SELECT path, mtime FROM paths WHERE key = ? AND user_hash = ?", (key, user_hash)).fetchall()
+        )
+        updates = []
+        for path in extract_paths(obj):
+            filename = path.get_path()
+            mtime = _get_mtime(filename)
+            if mtime is not None and snapshot.get(filename) == mtime:
+                continue  # unchanged since last check
+            if not path.available():
+                print(f"Dependency boundary index: path {path} of {key} not available anymore")
+                return None
+            updates.append((key, user_hash, filename, mtime, time.time()))
+        if updates:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)", updates)
+        return obj
+
+    def store(self, key: str, user_hash: str, obj: Any, *, cache_file_mtime: float) -> bool:
+        """
+        Stores obj, which must have hash user_hash, if it can be pickled and all its paths are available.
+
+        :return: whether it was stored
+        """
+        try:
+            obj_blob = pickle.dumps(obj)
+            assert short_hash(pickle.loads(obj_blob)) == user_hash, "pickled object has a different hash"
+        except Exception as exc:
+            print(
+                f"Dependency boundary index: cannot store {key},"
+                f" exception {type(exc).__name__} {str(exc)!r} while pickling"
+            )
+            return False
+        now = time.time()
+        path_entries = []
+        for path in extract_paths(obj):
+            if not path.available():
+                return False
+            path_entries.append((key, user_hash, path.get_path(), _get_mtime(path.get_path()), now))
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM paths WHERE key = ? AND user_hash = ?", (key, user_hash))
+            conn.execute(
+                "INSERT OR REPLACE INTO boundaries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, user_hash, user_hash, cache_file_mtime, obj_blob, now),
+            )
+            conn.executemany("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)", path_entries)
+        return True
+
+
+_index: Optional[DependencyBoundaryIndex] = None
+
+
+def get_index() -> DependencyBoundaryIndex:
+    """
+    :return: the global index, see IndexFilename
+    """
+    global _index
+    filename = IndexFilename
+    if filename is None:
+        from sisyphus import gs
+
+        filename = f"{gs.WORK_DIR}/dependency_boundary_index.sqlite"
+    if _index is None or _index.filename != filename:
+        _index = DependencyBoundaryIndex(filename)
+    return _index
+
+
+def _get_mtime(filename: str) -> Optional[float]:
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
@@ -1,6 +1,7 @@
 __all__ = ["BaseDecoder"]
 
 import copy
+import functools
 from typing import Dict, List, Optional, Tuple, Type, Union
 
 from sisyphus import tk
@@ -10,7 +11,7 @@ import i6_core.features as features
 import i6_core.rasr as rasr
 import i6_core.recognition as recog
 
-from i6_core.corpus import CorpusToStmJob, SegmentCorpusJob
+from i6_core.corpus import CorpusToStmJob, FilterCorpusBySegmentsJob, SegmentCorpusJob, ShuffleAndSplitSegmentsJob
 from i6_core.meta import CorpusObject
 
 from .config.am_config import Tdp
@@ -21,7 +22,10 @@ from .util.decode import (
     StmArgs,
     ScliteScorerArgs,
     OptimizeJobArgs,
+    AdaptiveTuningArgs,
+    LatticeRescoringArgs,
 )
+from .util.scale_tuning import SuccessiveHalvingScaleTuningJob
 
 
 class BaseDecoder:
@@ -32,6 +36,8 @@ class BaseDecoder:
     - set the eval corpora
     - perform decoding
     - lm scale optimization and redo decoding with optimized lm scale
+    - adaptive scale tuning via successive halving on segment subsets
+    - lm scale sweeps via rescoring of the lattices of one search
     """
 
     def __init__(
@@ -70,6 +76,7 @@ class BaseDecoder:
 
         self.eval_corpora = []
         self.stm_paths = {}
+        self.stm_args = {}
         self.feature_flows = {}
 
         self.feature_name_job_mapping = {
@@ -77,7 +84,7 @@ class BaseDecoder:
             "mfcc": features.MfccJob,
         }
 
-        # holds the recognition jobs: search, lat2ctm, score, optlm
+        # holds the recognition jobs: search, lat2ctm, score, optlm, tuning
         # self.jobs[CORPUS_KEY][JOB_TYPE][EXP_NAME] = tk.Job
         self.jobs: Dict[str, Dict[str, Dict[str, Type[tk.Job]]]] = {}
 
@@ -164,6 +171,7 @@ class BaseDecoder:
             if stm_paths is not None:
                 self.stm_paths[corpus_key] = stm_paths[corpus_key]
             else:
+                self.stm_args[corpus_key] = stm_args[corpus_key]
                 self.stm_paths[corpus_key] = CorpusToStmJob(
                     self.crp[corpus_key].corpus_config.file, **stm_args[corpus_key]
                 ).out_stm_path
@@ -182,8 +190,48 @@ class BaseDecoder:
                 )
                 self.feature_flows[corpus_key] = features.basic_cache_flow(feature_path)
 
-            for job_type in ["search", "lat2ctm", "score", "optlm"]:
-                self.jobs[corpus_key][job_type] = {}
+            self._get_jobs(corpus_key)
+
+    def _get_jobs(self, corpus_key: str) -> Dict[str, Dict[str, tk.Job]]:
+        """
+        :return: job type -> experiment name -> job, for the (possibly derived) corpus key
+        """
+        if corpus_key not in self.jobs:
+            self.jobs[corpus_key] = {job_type: {} for job_type in ["search", "lat2ctm", "score", "optlm", "tuning"]}
+        return self.jobs[corpus_key]
+
+    def _get_segment_subset_corpus_key(self, corpus_key: str, fraction: float, shuffle_seed: int) -> str:
+        """
+        creates an eval corpus (crp, STM) with a random subset of the segments of the given eval corpus.
+        Subsets with a larger fraction contain the subsets with a smaller fraction.
+
+        If the STM for the eval corpus was given directly, the subset STM is created with the default arguments.
+        """
+        subset_key = f"{corpus_key}_subset{fraction:.2f}"
+        if subset_key in self.crp:
+            return subset_key
+
+        base_crp = self.crp[corpus_key]
+        all_segments = SegmentCorpusJob(base_crp.corpus_config.file, 1).out_single_segment_files[1]
+        subset_segments = ShuffleAndSplitSegmentsJob(
+            all_segments, {"subset": fraction, "rest": 1.0 - fraction}, shuffle_seed=shuffle_seed
+        ).out_segments["subset"]
+        subset_corpus = FilterCorpusBySegmentsJob(base_crp.corpus_config.file, subset_segments).out_corpus
+
+        self.crp[subset_key] = rasr.CommonRasrParameters(base=base_crp)
+        self.crp[subset_key].corpus_config = rasr.RasrConfig()
+        self.crp[subset_key].corpus_config._update(base_crp.corpus_config)
+        self.crp[subset_key].corpus_config.file = subset_corpus
+        self.crp[subset_key].corpus_duration = base_crp.corpus_duration * fraction
+        self.crp[subset_key].concurrent = max(1, round(base_crp.concurrent * fraction))
+        self.crp[subset_key].segment_path = SegmentCorpusJob(
+            subset_corpus, self.crp[subset_key].concurrent
+        ).out_segment_path
+
+        self.stm_paths[subset_key] = CorpusToStmJob(subset_corpus, **self.stm_args.get(corpus_key, {})).out_stm_path
+        self._get_jobs(subset_key)
+
+        return subset_key
 
     @staticmethod
     def _get_scales_string(
@@ -330,12 +378,136 @@ class BaseDecoder:
             scorer_job.out_report_dir,
         )
 
-        self.jobs[corpus_key]["search"][name] = search_job
-        self.jobs[corpus_key]["lat2ctm"][name] = lat_2_ctm_job
-        self.jobs[corpus_key]["score"][name] = scorer_job
+        self._get_jobs(corpus_key)["search"][name] = search_job
+        self._get_jobs(corpus_key)["lat2ctm"][name] = lat_2_ctm_job
+        self._get_jobs(corpus_key)["score"][name] = scorer_job
+
+        return search_job, lat_2_ctm_job, scorer_job
+
+    @staticmethod
+    def _get_lattice_rescoring_config(lm_scale: Union[float, tk.Variable]) -> rasr.RasrConfig:
+        """
+        extra config for the lattice to ctm job, which sets the lm scale of the lattice via a Flf rescale node
+        between the archive reader and the rest of the network
+        """
+        config = rasr.RasrConfig()
+        config.flf_lattice_tool.network.archive_reader.links = "rescale"
+        config.flf_lattice_tool.network.rescale.type = "rescale"
+        config.flf_lattice_tool.network.rescale.links = "to-lemma"
+        config.flf_lattice_tool.network.rescale.lm.scale = (
+            Delayed(lm_scale) if isinstance(lm_scale, tk.Variable) else lm_scale
+        )
+        return config
+
+    def _recog_from_lattice(
+        self,
+        name: str,
+        corpus_key: str,
+        search_job: tk.Job,
+        lm_scale: Union[float, tk.Variable],
+        lat_2_ctm_args: Union[Lattice2CtmArgs, Dict],
+        scorer_args: Union[ScliteScorerArgs, Dict],
+        scorer_hyp_param_name: str,
+    ) -> (tk.Job, recog.LatticeToCtmJob, tk.Job):
+        """
+        the recognition job pipeline without search: rescore lattice to ctm with the given lm scale, score
+        """
+        extra_config = rasr.RasrConfig()
+        if lat_2_ctm_args.get("extra_config") is not None:
+            extra_config._update(lat_2_ctm_args["extra_config"])
+        extra_config._update(self._get_lattice_rescoring_config(lm_scale))
+
+        lat_2_ctm_job = recog.LatticeToCtmJob(
+            crp=self.crp[corpus_key],
+            lattice_cache=search_job.out_lattice_bundle,
+            **{**lat_2_ctm_args, "extra_config": extra_config},
+        )
+        lat_2_ctm_job.add_alias(f"{self.alias_output_prefix}lattice2ctm_{corpus_key}/{name}")
+
+        scorer_job = self.scorer_job_class(**{scorer_hyp_param_name: lat_2_ctm_job.out_ctm_file}, **scorer_args)
+        scorer_job.add_alias(f"{self.alias_output_prefix}scoring_{corpus_key}/{name}")
+        tk.register_output(
+            f"{self.alias_output_prefix}recog_{corpus_key}/{name}.reports",
+            scorer_job.out_report_dir,
+        )
+
+        self._get_jobs(corpus_key)["search"][name] = search_job
+        self._get_jobs(corpus_key)["lat2ctm"][name] = lat_2_ctm_job
+        self._get_jobs(corpus_key)["score"][name] = scorer_job
 
         return search_job, lat_2_ctm_job, scorer_job
 
+    def _decode_with_lattice_rescoring(
+        self,
+        name: str,
+        corpus_key: str,
+        *,
+        recognition_parameters: List[RecognitionParameters],
+        lattice_rescoring: Union[LatticeRescoringArgs, Dict],
+        search_job_args: Union[SearchJobArgs, Dict],
+        lat_2_ctm_args: Union[Lattice2CtmArgs, Dict],
+        scorer_args: Union[ScliteScorerArgs, Dict],
+        scorer_hyp_param_name: str,
+        **decode_kwargs,
+    ):
+        """
+        one search per combination of all scales except the lm scale, then lattice rescoring per lm scale,
+        see :func:`decode`
+        """
+        lm_scales_per_search = {}  # scales without lm scale -> lm scales
+        for recog_par in recognition_parameters:
+            for scales in recog_par:
+                am_sc, lm_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas = scales
+                search_scales = (am_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas)
+                lm_scales_per_search.setdefault(search_scales, []).append(lm_sc)
+
+        search_job_args = copy.copy(search_job_args)
+        search_job_args["search_parameters"] = {
+            **(search_job_args.get("search_parameters") or {}),
+            **(lattice_rescoring.get("search_parameters") or {}),
+        }
+
+        for search_scales, lm_scales in lm_scales_per_search.items():
+            am_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas = search_scales
+            search_lm_scale = lattice_rescoring.get("search_lm_scale")
+            if search_lm_scale is None:
+                search_lm_scale = lm_scales[0]
+
+            _, search_job, _, _ = self._decode_scales(
+                f"{name}-lattice",
+                corpus_key,
+                corpus_key,
+                (am_sc, search_lm_scale, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas),
+                search_job_args=search_job_args,
+                lat_2_ctm_args=lat_2_ctm_args,
+                scorer_args=scorer_args,
+                scorer_hyp_param_name=scorer_hyp_param_name,
+                **decode_kwargs,
+            )
+
+            for lm_sc in lm_scales:
+                derived_corpus_key = self._set_scales_and_tdps(
+                    corpus_key=corpus_key,
+                    am_scale=am_sc,
+                    lm_scale=lm_sc,
+                    prior_scale=prior_sc,
+                    tdp_scale=tdp_sc,
+                    tdp_speech=tdp_speech,
+                    tdp_silence=tdp_silence,
+                    tdp_nonspeech=tdp_nonspeech,
+                    pronunciation_scale=pron_sc,
+                    altas=altas,
+                )
+                self._recog_from_lattice(
+                    name=name,
+                    corpus_key=derived_corpus_key,
+                    search_job=search_job,
+                    lm_scale=lm_sc,
+                    lat_2_ctm_args=lat_2_ctm_args,
+                    scorer_args=scorer_args,
+                    scorer_hyp_param_name=scorer_hyp_param_name,
+                )
+
     def _optimize_scales(
         self,
         name: str,
@@ -362,13 +534,175 @@ class BaseDecoder:
         )
         opt_job.add_alias(f"{self.alias_output_prefix}optimize_{corpus_key}/{name}")
 
-        self.jobs[corpus_key]["optlm"][name] = opt_job
+        self._get_jobs(corpus_key)["optlm"][name] = opt_job
 
         best_pron_scale = opt_job.out_best_am_score
         best_lm_scale = opt_job.out_best_lm_score
 
         return best_pron_scale, best_lm_scale
 
+    def _decode_scales(
+        self,
+        name: str,
+        corpus_key: str,
+        eval_corpus_key: str,
+        scales: Tuple,
+        *,
+        feature_scorer: Optional[rasr.FeatureScorer],
+        feature_flow: rasr.FlowNetwork,
+        lm_rasr_config: rasr.RasrConfig,
+        search_job_args: Union[SearchJobArgs, Dict],
+        lat_2_ctm_args: Union[Lattice2CtmArgs, Dict],
+        scorer_args: Union[ScliteScorerArgs, Dict],
+        scorer_hyp_param_name: str,
+    ) -> (str, tk.Job, recog.LatticeToCtmJob, tk.Job):
+        """
+        runs the recognition pipeline for one combination of scales and TDPs
+
+        :param corpus_key: the eval corpus, which holds the LM config
+        :param eval_corpus_key: the corpus to decode, i.e. corpus_key or a segment subset of it
+        :param scales: one entry of the recognition parameters
+        """
+        am_sc, lm_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas = scales
+
+        scorer_args["ref"] = self.stm_paths[eval_corpus_key]
+        self.crp[corpus_key].language_model_config = lm_rasr_config
+
+        derived_corpus_key = self._set_scales_and_tdps(
+            corpus_key=eval_corpus_key,
+            am_scale=am_sc,
+            lm_scale=lm_sc,
+            prior_scale=prior_sc,
+            tdp_scale=tdp_sc,
+            tdp_speech=tdp_speech,
+            tdp_silence=tdp_silence,
+            tdp_nonspeech=tdp_nonspeech,
+            pronunciation_scale=pron_sc,
+            altas=altas,
+        )
+
+        feature_scorer.config.scale = am_sc
+        feature_scorer.config.priori_scale = prior_sc
+
+        if altas is not None:
+            adv_search_extra_config = rasr.RasrConfig()
+            adv_search_extra_config.flf_lattice_tool.network.recognizer.recognizer.acoustic_lookahead_temporal_approximation_scale = (
+                altas
+            )
+            search_job_args["extra_config"] = adv_search_extra_config
+
+        if pron_sc is not None:
+            model_combination_config = rasr.RasrConfig()
+            model_combination_config.pronunciation_scale = pron_sc
+            search_job_args["model_combination_config"] = model_combination_config
+
+        search_job, lat_2_ctm_job, scorer_job = self._recog(
+            name=name,
+            corpus_key=derived_corpus_key,
+            feature_scorer=feature_scorer,
+            feature_flow=feature_flow,
+            search_job_args=search_job_args,
+            lat_2_ctm_args=lat_2_ctm_args,
+            scorer_args=scorer_args,
+            scorer_hyp_param_name=scorer_hyp_param_name,
+        )
+
+        return derived_corpus_key, search_job, lat_2_ctm_job, scorer_job
+
+    def _evaluate_tuning_candidate(
+        self,
+        rung: int,
+        candidate: str,
+        *,
+        name: str,
+        corpus_key: str,
+        eval_corpus_keys: List[str],
+        scales: Dict[str, Tuple],
+        search_job_args: Union[SearchJobArgs, Dict],
+        scorer_args: Union[ScliteScorerArgs, Dict],
+        **decode_kwargs,
+    ) -> tk.Variable:
+        """
+        decodes one candidate of the adaptive tuning in the given rung, see :class:`SuccessiveHalvingScaleTuningJob`
+
+        :param eval_corpus_keys: per rung, the corpus to decode
+        :param scales: candidate name -> one entry of the recognition parameters
+        :return: WER
+        """
+        # _decode_scales modifies the args, and this is also called later from the update of the tuning job
+        *_, scorer_job = self._decode_scales(
+            name,
+            corpus_key,
+            eval_corpus_keys[rung],
+            scales[candidate],
+            search_job_args=copy.copy(search_job_args),
+            scorer_args=copy.copy(scorer_args),
+            **decode_kwargs,
+        )
+        return scorer_job.out_wer
+
+    def _decode_adaptive(
+        self,
+        name: str,
+        corpus_key: str,
+        *,
+        recognition_parameters: List[RecognitionParameters],
+        adaptive_tuning: Union[AdaptiveTuningArgs, Dict],
+        **decode_kwargs,
+    ) -> SuccessiveHalvingScaleTuningJob:
+        """
+        adaptive scale tuning via successive halving, see :func:`decode`
+        """
+        candidates = {}
+        for recog_par in recognition_parameters:
+            for scales in recog_par:
+                am_sc, lm_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas = scales
+                candidate = self._get_scales_string(
+                    am_scale=am_sc,
+                    lm_scale=lm_sc,
+                    prior_scale=prior_sc,
+                    tdp_scale=tdp_sc,
+                    tdp_speech=tdp_speech,
+                    tdp_silence=tdp_silence,
+                    tdp_nonspeech=tdp_nonspeech,
+                    pronunciation_scale=pron_sc,
+                    altas=altas,
+                )
+                assert isinstance(candidate, str), "adaptive tuning needs fixed scales"
+                candidates[candidate] = scales
+
+        shuffle_seed = adaptive_tuning.get("shuffle_seed", 0x3C5EA3E4)
+        eval_corpus_keys = [
+            self._get_segment_subset_corpus_key(corpus_key, fraction, shuffle_seed)
+            for fraction in adaptive_tuning["segment_fractions"]
+        ] + [corpus_key]
+        evaluate = functools.partial(
+            self._evaluate_tuning_candidate,
+            name=name,
+            corpus_key=corpus_key,
+            eval_corpus_keys=eval_corpus_keys,
+            scales=candidates,
+            **{
+                **decode_kwargs,
+                "search_job_args": copy.copy(decode_kwargs["search_job_args"]),
+                "scorer_args": copy.copy(decode_kwargs["scorer_args"]),
+            },
+        )
+        tuning_job = SuccessiveHalvingScaleTuningJob(
+            initial_scores={candidate: evaluate(0, candidate) for candidate in candidates},
+            evaluate=evaluate,
+            num_rungs=len(eval_corpus_keys),
+            eta=adaptive_tuning.get("eta", 3),
+        )
+        tuning_job.add_alias(f"{self.alias_output_prefix}tuning_{corpus_key}/{name}")
+        tk.register_output(
+            f"{self.alias_output_prefix}tuning_{corpus_key}/{name}.trajectory.json",
+            tuning_job.out_trajectory,
+        )
+        self._get_jobs(corpus_key)["tuning"][name] = tuning_job
+
+        return tuning_job
+
     def decode(
         self,
         name: str,
@@ -384,6 +718,8 @@ class BaseDecoder:
         optimize_parameters: Union[OptimizeJobArgs, Dict],
         scorer_hyp_param_name: str = "hyp",
         optimize_pron_lm_scales: bool = False,
+        adaptive_tuning: Optional[Union[AdaptiveTuningArgs, Dict]] = None,
+        lattice_rescoring: Optional[Union[LatticeRescoringArgs, Dict]] = None,
     ):
         """
         run decoding
@@ -400,59 +736,53 @@ class BaseDecoder:
         :param optimize_parameters: specific arguments for the optimize lm scale job
         :param scorer_hyp_param_name: key name for the hypothesis file of the scorer
         :param optimize_pron_lm_scales: run the pronunciation and lm scale optimization step. DO NOT RUN THIS STEP ON TEST SET!!!
+        :param adaptive_tuning: instead of decoding all combinations of the recognition parameters,
+            decode them on segment subsets and only promote the best ones to the full corpus,
+            see :class:`AdaptiveTuningArgs` and :class:`SuccessiveHalvingScaleTuningJob`.
+            The promoted combinations on the full corpus have the same jobs as without adaptive tuning.
+        :param lattice_rescoring: instead of one search per combination of the recognition parameters,
+            search once (with the given wider beams) for all combinations which only differ in the lm scale,
+            and get the CTM of each lm scale by rescoring the lattices, see :class:`LatticeRescoringArgs`.
+            The search, lat2ctm and score jobs are registered in self.jobs as without rescoring.
         """
-        for recog_par in recognition_parameters:
-            for (
-                am_sc,
-                lm_sc,
-                prior_sc,
-                pron_sc,
-                tdp_sc,
-                tdp_speech,
-                tdp_silence,
-                tdp_nonspeech,
-                altas,
-            ) in recog_par:
-                scorer_args["ref"] = self.stm_paths[corpus_key]
-                self.crp[corpus_key].language_model_config = lm_rasr_config
-
-                derived_corpus_key = self._set_scales_and_tdps(
-                    corpus_key=corpus_key,
-                    am_scale=am_sc,
-                    lm_scale=lm_sc,
-                    prior_scale=prior_sc,
-                    tdp_scale=tdp_sc,
-                    tdp_speech=tdp_speech,
-                    tdp_silence=tdp_silence,
-                    tdp_nonspeech=tdp_nonspeech,
-                    pronunciation_scale=pron_sc,
-                    altas=altas,
-                )
-
-                feature_scorer.config.scale = am_sc
-                feature_scorer.config.priori_scale = prior_sc
-
-                if altas is not None:
-                    adv_search_extra_config = rasr.RasrConfig()
-                    adv_search_extra_config.flf_lattice_tool.network.recognizer.recognizer.acoustic_lookahead_temporal_approximation_scale = (
-                        altas
-                    )
-                    search_job_args["extra_config"] = adv_search_extra_config
+        decode_kwargs = dict(
+            feature_scorer=feature_scorer,
+            feature_flow=feature_flow,
+            lm_rasr_config=lm_rasr_config,
+            search_job_args=search_job_args,
+            lat_2_ctm_args=lat_2_ctm_args,
+            scorer_args=scorer_args,
+            scorer_hyp_param_name=scorer_hyp_param_name,
+        )
 
-                if pron_sc is not None:
-                    model_combination_config = rasr.RasrConfig()
-                    model_combination_config.pronunciation_scale = pron_sc
-                    search_job_args["model_combination_config"] = model_combination_config
+        if adaptive_tuning is not None:
+            assert not optimize_pron_lm_scales, "adaptive tuning and scale optimization are exclusive"
+            assert lattice_rescoring is None, "adaptive tuning and lattice rescoring are exclusive"
+            self._decode_adaptive(
+                name,
+                corpus_key,
+                recognition_parameters=recognition_parameters,
+                adaptive_tuning=adaptive_tuning,
+                **decode_kwargs,
+            )
+            return
+
+        if lattice_rescoring is not None:
+            assert not optimize_pron_lm_scales, "lattice rescoring and scale optimization are exclusive"
+            self._decode_with_lattice_rescoring(
+                name,
+                corpus_key,
+                recognition_parameters=recognition_parameters,
+                lattice_rescoring=lattice_rescoring,
+                **decode_kwargs,
+            )
+            return
 
-                search_job, lat_2_ctm_job, scorer_job = self._recog(
-                    name=name,
-                    corpus_key=derived_corpus_key,
-                    feature_scorer=feature_scorer,
-                    feature_flow=feature_flow,
-                    search_job_args=search_job_args,
-                    lat_2_ctm_args=lat_2_ctm_args,
-                    scorer_args=scorer_args,
-                    scorer_hyp_param_name=scorer_hyp_param_name,
+        for recog_par in recognition_parameters:
+            for scales in recog_par:
+                am_sc, lm_sc, prior_sc, pron_sc, tdp_sc, tdp_speech, tdp_silence, tdp_nonspeech, altas = scales
+                derived_corpus_key, search_job, lat_2_ctm_job, scorer_job = self._decode_scales(
+                    name, corpus_key, corpus_key, scales, **decode_kwargs
                 )
                 if optimize_pron_lm_scales:
                     best_pron_scale, best_lm_scale = self._optimize_scales(
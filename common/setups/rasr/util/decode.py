@@ -8,6 +8,8 @@ __all__ = [
     "StmArgs",
     "ScliteScorerArgs",
     "OptimizeJobArgs",
+    "AdaptiveTuningArgs",
+    "LatticeRescoringArgs",
 ]
 
 from dataclasses import dataclass
@@ -161,3 +163,14 @@ class OptimizeJobArgs(TypedDict):
     precision: int
     extra_config: Optional[rasr.RasrConfig]
     extra_post_config: Optional[rasr.RasrConfig]
+
+
+class AdaptiveTuningArgs(TypedDict):
+    segment_fractions: List[float]
+    eta: int
+    shuffle_seed: int
+
+
+class LatticeRescoringArgs(TypedDict):
+    search_parameters: Optional[Dict[str, Any]]
+    search_lm_scale: Optional[float]
@@ -0,0 +1,97 @@
+__all__ = ["SuccessiveHalvingScaleTuningJob"]
+
+import json
+import math
+from typing import Callable, Dict, List
+
+from sisyphus import tk, Task
+
+
+class SuccessiveHalvingScaleTuningJob(tk.Job):
+    """
+    Successive halving over a list of scale combinations (candidates).
+
+    All candidates are first evaluated in rung 0 (usually on a small subset of the segments).
+    From each rung, the best 1/eta of the candidates are promoted to the next rung,
+    which usually evaluates on a larger part of the corpus, and the last rung on the full corpus.
+    The next rung is only created via :func:`update` when all scores of the current rung are available.
+
+    The explored trajectory (all rungs with all scores) is written to out_trajectory.
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_scores: Dict[str, tk.Variable],
+        evaluate: Callable[[int, str], tk.Variable],
+        num_rungs: int,
+        eta: int = 3,
+    ):
+        """
+        :param initial_scores: candidate name -> WER of rung 0
+        :param evaluate: (rung, candidate name) -> WER. Called in the graph process to create the jobs of further rungs.
+            Not hashed, so it must be deterministic given the initial scores. Not pickled with the job.
+        :param num_rungs: total number of rungs including rung 0
+        :param eta: keep ceil(num_candidates / eta) candidates for the next rung
+        """
+        assert num_rungs >= 1 and eta >= 2
+        self.initial_scores = initial_scores
+        self.evaluate = evaluate
+        self.num_rungs = num_rungs
+        self.eta = eta
+
+        self._scores: List[Dict[str, tk.Variable]] = []  # per rung: candidate name -> WER
+        self._add_rung(initial_scores)
+
+        self.out_trajectory = self.output_path("trajectory.json")
+        self.out_best_candidate = self.output_var("best_candidate")
+        self.out_best_wer = self.output_var("best_wer")
+
+    @classmethod
+    def hash(cls, parsed_args):
+        d = {k: v for k, v in parsed_args.items() if k != "evaluate"}
+        return super().hash(d)
+
+    def __getstate__(self):
+        # evaluate is only used by update in the graph process.
+        # It is usually bound to the decoder which created this job, which should not be pickled into the job dir.
+        state = dict(getattr(super(), "__getstate__", lambda: self.__dict__)())
+        state.pop("evaluate", None)
+        if "_sis_kwargs" in state:
+            state["_sis_kwargs"] = {k: v for k, v in state["_sis_kwargs"].items() if k != "evaluate"}
+        return state
+
+    def _add_rung(self, scores: Dict[str, tk.Variable]):
+        for score in scores.values():
+            self.add_input(score)
+        self._scores.append(scores)
+
+    def update(self):
+        """
+        Promotes the best candidates of the last rung to the next one, once all its scores are available.
+        """
+        rung = len(self._scores) - 1
+        if rung + 1 >= self.num_rungs:
+            return
+        scores = self._scores[rung]
+        if not all(score.available() for score in scores.values()):
+            return
+        ranked = sorted(scores, key=lambda name: scores[name].get())
+        promoted = ranked[: math.ceil(len(ranked) / self.eta)]
+        self._add_rung({name: self.evaluate(rung + 1, name) for name in promoted})
+
+    def tasks(self):
+        yield Task("run", mini_task=True)
+
+    def run(self):
+        trajectory = [
+            {"rung": rung, "scores": {name: score.get() for name, score in scores.items()}}
+            for rung, scores in enumerate(self._scores)
+        ]
+        with open(self.out_trajectory.get_path(), "wt") as f:
+            json.dump(trajectory, f, indent=2)
+
+        final_scores = trajectory[-1]["scores"]
+        best = min(final_scores, key=final_scores.get)
+        self.out_best_candidate.set(best)
+        self.out_best_wer.set(final_scores[best])
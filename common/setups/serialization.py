@@ -4,11 +4,15 @@ Helper code for serializing any data, e.g. for ReturnnConfig.
 
 from __future__ import annotations
 
+import functools
+import itertools
 import string
 import sys
 import textwrap
+import time
+import weakref
 from types import FunctionType
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from i6_core.util import uopen, instanciate_delayed
 from sisyphus import tk
@@ -16,8 +20,140 @@ from sisyphus.delayed_ops import DelayedBase
 from sisyphus.hash import short_hash, sis_hash_helper
 from sisyphus.tools import try_get
 
+# If True, the sis hash of the serializer objects (Collection, Import, CodeFromFunction, Call)
+# is computed only once per object and then reused.
+# Assigning any attribute of the object invalidates the memo,
+# and a Collection notices when its list of serializer objects changes.
+# In-place modifications of other containers (e.g. Call.kwargs or PartialImport.hashed_arguments)
+# after the object was hashed must be followed by :func:`SerializerObject.invalidate_sis_hash`.
+UseSisHashMemo = False
+# If True, count the calls and measure the time spent in the sis hash of the serializer objects,
+# see :data:`sis_hash_stats`.
+ProfileSisHash = False
 
-class SerializerObject(DelayedBase):
+# global counter, such that (id(obj), version) is unique even if an object id gets reused
+_sis_hash_version_counter = itertools.count(1)
+# id(obj) -> [version, {method qualname -> (memo key, hash)}], only used while UseSisHashMemo is enabled.
+# This is not stored in obj.__dict__, because objects without an own _sis_hash are hashed via their __dict__.
+# The entry is removed when the object is garbage collected.
+_sis_hash_memo_states: Dict[int, List[Any]] = {}
+
+
+def _get_sis_hash_memo_state(obj: Any) -> List[Any]:
+    state = _sis_hash_memo_states.get(id(obj))
+    if state is None:
+        state = _sis_hash_memo_states[id(obj)] = [None, {}]
+        weakref.finalize(obj, _sis_hash_memo_states.pop, id(obj), None)
+    return state
+
+
+def _get_sis_hash_version(obj: Any) -> Optional[int]:
+    state = _sis_hash_memo_states.get(id(obj))
+    return state[0] if state is not None else None
+
+
+class SisHashStats:
+    """
+    Counter for the hashing of the serializer objects, enabled via :data:`ProfileSisHash`.
+    Only the outermost hash call is timed, so nested objects are not counted twice.
+    """
+
+    def __init__(self):
+        self.num_calls = 0
+        self.num_memo_hits = 0
+        self.total_time = 0.0
+        self.time_by_type: Dict[str, float] = {}
+        self._depth = 0
+
+    def reset(self):
+        """reset all counters"""
+        self.__init__()
+
+    def report(self) -> str:
+        """:return: human-readable summary"""
+        lines = [
+            f"serializer sis_hash: {self.num_calls} calls, {self.num_memo_hits} memo hits,"
+            f" {self.total_time:.3f} sec total"
+        ]
+        for name, t in sorted(self.time_by_type.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name}: {t:.3f} sec")
+        return "\n".join(lines)
+
+
+sis_hash_stats = SisHashStats()
+
+
+def _memoize_sis_hash(func: Callable[[Any], bytes]) -> Callable[[Any], bytes]:
+    """
+    Decorator for the ``_sis_hash`` of serializer objects, see :data:`UseSisHashMemo` and :data:`ProfileSisHash`.
+    The memo is stored per method, so ``super()._sis_hash()`` in derived classes works as expected.
+    """
+    memo_name = func.__qualname__
+
+    @functools.wraps(func)
+    def _sis_hash(self) -> bytes:
+        if not UseSisHashMemo and not ProfileSisHash:
+            return func(self)
+        stats = sis_hash_stats if ProfileSisHash else None
+        if stats:
+            stats.num_calls += 1
+        if UseSisHashMemo:
+            state = _get_sis_hash_memo_state(self)
+            memo_key = (state[0], self._sis_hash_memo_key())
+            memo = state[1]
+            if memo_name in memo and memo[memo_name][0] == memo_key:
+                if stats:
+                    stats.num_memo_hits += 1
+                return memo[memo_name][1]
+        if not stats or stats._depth > 0:
+            res = func(self)
+        else:
+            stats._depth += 1
+            start = time.perf_counter()
+            try:
+                res = func(self)
+            finally:
+                stats._depth -= 1
+                elapsed = time.perf_counter() - start
+                stats.total_time += elapsed
+                type_name = type(self).__qualname__
+                stats.time_by_type[type_name] = stats.time_by_type.get(type_name, 0.0) + elapsed
+        if UseSisHashMemo:
+            memo[memo_name] = (memo_key, res)
+        return res
+
+    return _sis_hash
+
+
+class _SisHashMemoMixin:
+    """
+    Tracks modifications of the object for the memoized sis hash, see :func:`_memoize_sis_hash`.
+    """
+
+    def __setattr__(self, key: str, value: Any):
+        super().__setattr__(key, value)
+        self.invalidate_sis_hash()
+
+    def invalidate_sis_hash(self):
+        """
+        Drop the memoized sis hash. Needed after in-place modifications of attributes.
+        """
+        if UseSisHashMemo:
+            state = _get_sis_hash_memo_state(self)
+            state[0] = next(_sis_hash_version_counter)
+            state[1].clear()
+        elif _sis_hash_memo_states:
+            # a memo from a time when UseSisHashMemo was enabled would be outdated now
+            _sis_hash_memo_states.pop(id(self), None)
+
+    def _sis_hash_memo_key(self) -> Any:
+        """
+        :return: additional state which the memoized hash depends on, besides the attribute assignments
+        """
+        return None
+
+
+class SerializerObject(_SisHashMemoMixin, DelayedBase):
     """
     Base class for objects that can be passed to :class:`Collection` or :class:`returnn_common.Collection`.
     """
@@ -33,7 +169,7 @@ class SerializerObject(DelayedBase):
         raise NotImplementedError
 
 
-class Collection(DelayedBase):
+class Collection(_SisHashMemoMixin, DelayedBase):
     """
     Collection of a list of :class:`SerializerObject`
     """
@@ -54,6 +190,11 @@ class Collection(DelayedBase):
         content = [obj.get() for obj in self.serializer_objects]
         return "".join(content)
 
+    def _sis_hash_memo_key(self) -> Any:
+        # the list can be modified in-place, and the objects themselves can be modified
+        return tuple((id(obj), _get_sis_hash_version(obj)) for obj in self.serializer_objects)
+
+    @_memoize_sis_hash
     def _sis_hash(self) -> bytes:
         h = {
             "delayed_objects": [obj for obj in self.serializer_objects if obj.use_for_hash],
@@ -124,6 +265,7 @@ class Import(SerializerObject):
             return f"from {self.module} import {self.object_name} as {self.import_as}\n"
         return f"from {self.module} import {self.object_name}\n"
 
+    @_memoize_sis_hash
     def _sis_hash(self):
         if self.import_as and not self.ignore_import_as_for_hash:
             return sis_hash_helper({"code_object": self.code_object, "import_as": self.import_as})
@@ -261,6 +403,7 @@ class CodeFromFunction(SerializerObject):
         """get"""
         return self._code
 
+    @_memoize_sis_hash
     def _sis_hash(self):
         if self.hash_full_python_code:
             return sis_hash_helper((self.name, self._func_code))
@@ -399,6 +542,7 @@ class Call(SerializerObject):
         # full call
         return f"{return_assign_str}{self.callable_name}({', '.join(kwargs_str_list)})\n"
 
+    @_memoize_sis_hash
     def _sis_hash(self):
         h = {
             "callable_name": self.callable_name,
@@ -1,12 +1,24 @@
 """
 Dump to Python code utils
+
+For huge objects (e.g. the init args of a whole RasrSystem), there are two options to make the dump smaller
+and faster to import:
+
+- ``dedup_by_content``: structurally equal subobjects (e.g. the same RasrConfig in many CRPs)
+  are emitted only once, also when they are not the same object.
+- ``pickled``: only a tiny loader stub is emitted, with the object as compressed pickle data.
 """
 
 import re
 import sys
 import os
+import io
+import base64
+import hashlib
+import pickle
+import zlib
 from operator import attrgetter
-from typing import Any, Optional, TextIO
+from typing import Any, Dict, Optional, TextIO, Tuple
 import sisyphus
 from sisyphus import gs, tk
 from sisyphus.hash import sis_hash_helper
@@ -30,18 +42,36 @@ class PythonCodeDumper:
         "i6_core",
         "i6_experiments",
         "make_fake_job",
+        "load_pickled_data",
     }
 
-    def __init__(self, *, file: Optional[TextIO] = None, use_fake_jobs: bool = False):
+    def __init__(
+        self,
+        *,
+        file: Optional[TextIO] = None,
+        use_fake_jobs: bool = False,
+        dedup_by_content: bool = False,
+        pickled: bool = False,
+    ):
         """
         :param file: File to write the code to. None means stdout.
         :param use_fake_jobs: If True, use :func:`_make_fake_job`, avoids indirect dependencies
+        :param dedup_by_content: If True, subobjects which are structurally equal are dumped only once
+            and are then shared in the loaded object.
+            Only use this if the loaded object is not modified in-place.
+        :param pickled: If True, dump the object as compressed pickle data with a small loader stub,
+            see :func:`load_pickled_data`. Much faster to dump and to load, but not human-readable.
         """
         self.file = file
         self.use_fake_jobs = use_fake_jobs
+        self.dedup_by_content = dedup_by_content
+        self.pickled = pickled
         # We use id(obj) for identification. To keep id unique, keep all objects alive.
         self._reserved_names = set()
         self._id_to_obj_name = {}  # id -> (obj, name). like pickle memo
+        self._id_to_content_key: Dict[int, Tuple[Any, bytes]] = {}  # id -> (obj, key), for dedup_by_content
+        self._content_key_to_name: Dict[bytes, str] = {}
+        self._content_key_in_progress = set()  # ids, to handle cycles
         self._imports = set()  # module names
 
     def dump(self, obj: Any, *, lhs: str):
@@ -55,13 +85,31 @@ class PythonCodeDumper:
         assert is_valid_python_identifier_name(lhs)
         # Clear any previous memo. Any mutable objects could have been changed in the meantime.
         self._id_to_obj_name.clear()
+        self._id_to_content_key.clear()
+        self._content_key_to_name.clear()
         self._reserved_names.clear()
-        self._dump(obj, lhs=lhs)
+        if self.pickled:
+            self._dump_pickled(obj, lhs=lhs)
+        else:
+            self._dump(obj, lhs=lhs)
+
+    def _dump_pickled(self, obj: Any, *, lhs: str):
+        buffer = io.BytesIO()
+        _Pickler(buffer, use_fake_jobs=self.use_fake_jobs).dump(obj)
+        data = base64.b85encode(zlib.compress(buffer.getvalue()))
+        self._import_reserved("load_pickled_data")
+        lines = [f"{lhs} = load_pickled_data("]
+        for i in range(0, len(data), 100):
+            lines.append(f"    {data[i:i + 100]!r}")
+        lines.append(")")
+        print("\n".join(lines), file=self.file)
 
     def _dump(self, obj: Any, *, lhs: str, check_memo: bool = True):
-        if check_memo and id(obj) in self._id_to_obj_name:
-            print(f"{lhs} = {self._id_to_obj_name[id(obj)][1]}", file=self.file)
-            return
+        if check_memo:
+            name = self._memo_name(obj)
+            if name:
+                print(f"{lhs} = {name}", file=self.file)
+                return
         if isinstance(obj, rasr.CommonRasrParameters):
             self._dump_crp(crp=obj, lhs=lhs)
         elif isinstance(obj, rasr.RasrConfig):
@@ -155,6 +203,11 @@ class PythonCodeDumper:
             self._dump(v, lhs=f"{lhs}.{k}")
 
     def _dump_rasr_config(self, config: rasr.RasrConfig, *, lhs: str, parent_is_config: bool):
+        if parent_is_config and self.dedup_by_content:
+            name = self._content_key_to_name.get(self._content_key(config))
+            if name:
+                print(f"{lhs} = {name}", file=self.file)
+                return
         kwargs = {}
         for k in ["prolog", "epilog"]:
             v = getattr(config, f"_{k}")
@@ -228,8 +281,9 @@ class PythonCodeDumper:
         """
         Unfortunately some __repr__ implementations are messed up, so need to use some custom here.
         """
-        if id(obj) in self._id_to_obj_name:
-            return self._id_to_obj_name[id(obj)][1]
+        name = self._memo_name(obj)
+        if name:
+            return name
         if isinstance(obj, tk.Path):
             return self._py_repr_path(obj)
         if isinstance(obj, dict):
@@ -293,8 +347,9 @@ class PythonCodeDumper:
         return f"tk.Path({', '.join(args)})"
 
     def _name_for_obj(self, obj: Any) -> str:
-        if id(obj) in self._id_to_obj_name:
-            return self._id_to_obj_name[id(obj)][1]
+        name = self._memo_name(obj)
+        if name:
+            return name
         if isinstance(obj, type):
             name = obj.__name__
         else:
@@ -309,6 +364,81 @@ class PythonCodeDumper:
             return
         self._id_to_obj_name[id(obj)] = (obj, name)
         self._reserved_names.add(name)
+        if self.dedup_by_content:
+            self._content_key_to_name.setdefault(self._content_key(obj), name)
+
+    def _memo_name(self, obj: Any) -> Optional[str]:
+        """
+        :return: name of the previously dumped object, which is either obj itself,
+            or with dedup_by_content, some structurally equal object
+        """
+        if id(obj) in self._id_to_obj_name:
+            return self._id_to_obj_name[id(obj)][1]
+        if self.dedup_by_content and not isinstance(obj, _valid_primitive_types):
+            name = self._content_key_to_name.get(self._content_key(obj))
+            if name:
+                self._id_to_obj_name[id(obj)] = (obj, name)
+                return name
+        return None
+
+    def _content_key(self, obj: Any) -> bytes:
+        """
+        :return: digest of the structure of the object, following the same logic as the dumping.
+            Objects with the same key are dumped to the same code.
+        """
+        if isinstance(obj, (type(None), int, float, str, bool)):
+            return f"{type(obj).__name__}:{obj!r}".encode()
+        if id(obj) in self._id_to_content_key:
+            return self._id_to_content_key[id(obj)][1]
+        if id(obj) in self._content_key_in_progress:
+            # Cyclic reference. Make this unique, i.e. never dedup objects which are part of a cycle.
+            return f"cycle:{id(obj)}".encode()
+        self._content_key_in_progress.add(id(obj))
+        try:
+            ck = self._content_key
+            if isinstance(obj, type):
+                parts = (obj.__module__, obj.__qualname__)
+            elif isinstance(obj, sisyphus.Job):
+                # noinspection PyProtectedMember
+                parts = (obj._sis_id(),)
+            elif isinstance(obj, tk.Path):
+                # noinspection PyProtectedMember
+                parts = (
+                    obj.path,
+                    ck(obj.creator),
+                    obj.cached,
+                    ck(obj.hash_overwrite),
+                    ck(obj._tags),
+                    ck(obj._available),
+                )
+            elif isinstance(obj, dict):
+                parts = tuple((ck(k), ck(v)) for k, v in obj.items())
+            elif isinstance(obj, (list, tuple)):
+                parts = tuple(ck(v) for v in obj)
+            elif isinstance(obj, (set, frozenset)):
+                parts = tuple(sorted(ck(v) for v in obj))
+            elif isinstance(obj, rasr.RasrConfig):
+                # noinspection PyProtectedMember
+                parts = (
+                    ck(obj._prolog),
+                    ck(obj._prolog_hash),
+                    ck(obj._epilog),
+                    ck(obj._epilog_hash),
+                    ck(obj._value),
+                    tuple((k, ck(obj[k])) for k in obj),
+                )
+            elif isinstance(obj, rasr.CommonRasrParameters):
+                parts = (ck(vars(obj)),)
+            elif isinstance(obj, i6_core.util.MultiPath):
+                parts = (obj.path_template, ck(obj.hidden_paths), obj.cached, obj.path_root, ck(obj.hash_overwrite))
+            else:
+                state = obj.__getstate__() if hasattr(obj, "__getstate__") else obj.__dict__
+                parts = (ck(state),)
+        finally:
+            self._content_key_in_progress.remove(id(obj))
+        key = hashlib.sha256(repr((type(obj).__module__, type(obj).__qualname__) + parts).encode()).digest()
+        self._id_to_content_key[id(obj)] = (obj, key)
+        return key
 
     def _new_unique_private_name(self, name: str) -> str:
         name = re.sub(r'[\\/:"\'*?<>\[\].|]+', "_", name)
@@ -337,6 +467,58 @@ class PythonCodeDumper:
             "tk": "from sisyphus import tk",
             "rasr": "import i6_core.rasr as rasr",
             "make_fake_job": "from i6_experiments.common.utils.fake_job import make_fake_job",
+            "load_pickled_data": "from i6_experiments.common.utils.dump_py_code import load_pickled_data",
         }
         print(code[name], file=self.file)
         self._imports.add(name)
+
+
+_gs_path_prefix_names = ("BASE_DIR", "RASR_ROOT")
+
+
+class _Pickler(pickle.Pickler):
+    """
+    Pickler for :class:`PythonCodeDumper` with ``pickled=True``.
+    Like the Python code, it stores jobs as fake jobs (if use_fake_jobs)
+    and paths relative to the gs.BASE_DIR and gs.RASR_ROOT settings.
+    """
+
+    def __init__(self, file: io.BytesIO, *, use_fake_jobs: bool):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.use_fake_jobs = use_fake_jobs
+        self._gs_prefixes = [(name, getattr(gs, name, None)) for name in _gs_path_prefix_names]
+        self._gs_prefixes = [(name, v) for name, v in self._gs_prefixes if v]
+
+    def persistent_id(self, obj: Any) -> Optional[Tuple[Any, ...]]:
+        """persistent id"""
+        if isinstance(obj, str):
+            for name, v in self._gs_prefixes:
+                if obj == v or obj.startswith(v + "/") or (v.endswith("/") and obj.startswith(v)):
+                    return "gs", name, obj[len(v) :]
+            return None
+        if self.use_fake_jobs and isinstance(obj, sisyphus.Job):
+            # noinspection PyProtectedMember
+            _, sis_hash = os.path.basename(obj._sis_id()).split(".", 1)
+            return "job", type(obj).__module__, type(obj).__name__, sis_hash
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid: Tuple[Any, ...]) -> Any:
+        """persistent load"""
+        if pid[0] == "gs":
+            _, name, suffix = pid
+            return getattr(gs, name) + suffix
+        if pid[0] == "job":
+            from i6_experiments.common.utils.fake_job import make_fake_job
+
+            _, module, name, sis_hash = pid
+            return make_fake_job(module=module, name=name, sis_hash=sis_hash)
+        raise pickle.UnpicklingError(f"unsupported persistent id {pid!r}")
+
+
+def load_pickled_data(data: bytes) -> Any:
+    """
+    Loader for the code generated by :class:`PythonCodeDumper` with ``pickled=True``.
+    """
+    return _Unpickler(io.BytesIO(zlib.decompress(base64.b85decode(data)))).load()
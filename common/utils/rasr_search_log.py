@@ -0,0 +1,104 @@
+"""
+Streaming parser for the statistics in RASR search logs (log.*.gz of the recognition jobs).
+
+The logs are parsed with ``ET.iterparse``, every completed ``segment`` element is passed to a
+job-specific callback and dropped afterwards, so the memory per log is bounded by one segment.
+The per-log results (partial aggregates) can be merged in log order, and several logs can be parsed in parallel.
+"""
+
+__all__ = ["parse_search_log", "merge_search_log_statistics", "parse_search_logs"]
+
+import functools
+import gzip
+import multiprocessing
+import xml.etree.ElementTree as ET
+from typing import Any, Callable, Dict, Iterable, List
+
+
+def parse_search_log(
+    path: str,
+    *,
+    segment_statistics: Callable[[ET.Element, Dict[str, Any]], None],
+    initial_statistics: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Parses one search log, such that only the current segment is kept in memory.
+
+    Besides the job-specific entries, the partial aggregate contains
+    total_elapsed, total_user and total_system of the root timer and lm_time (``fwd-summary/total-run-time``).
+
+    :param path: gzipped search log
+    :param segment_statistics: adds the statistics of one completed segment element to the partial aggregate.
+        Must be picklable (e.g. a module-level function) for :func:`parse_search_logs` with multiple processes.
+    :param initial_statistics: job-specific entries of the partial aggregate, numbers or dicts, copied
+    :return: partial aggregate, see :func:`merge_search_log_statistics`
+    """
+    partial = {"total_elapsed": 0.0, "total_user": 0.0, "total_system": 0.0, "lm_time": 0.0}
+    partial.update(
+        {key: value.copy() if isinstance(value, dict) else value for key, value in initial_statistics.items()}
+    )
+    stack = []  # open elements
+    segment_depth = None  # position of the open segment in the stack
+    root_timer_seen = False
+    with gzip.open(path, "rb") as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if segment_depth is None and elem.tag == "segment":
+                    segment_depth = len(stack)
+                stack.append(elem)
+                continue
+            stack.pop()
+            if segment_depth is not None and len(stack) > segment_depth:
+                continue  # inside of a segment, handled when the segment is complete
+            if elem.tag == "segment":
+                segment_statistics(elem, partial)
+                segment_depth = None
+            elif elem.tag == "timer" and len(stack) == 1 and not root_timer_seen:
+                root_timer_seen = True
+                partial["total_elapsed"] += float(elem.findall("./elapsed")[0].text)
+                partial["total_user"] += float(elem.findall("./user")[0].text)
+                partial["total_system"] += float(elem.findall("./system")[0].text)
+            elif elem.tag == "total-run-time" and stack and stack[-1].tag == "fwd-summary":
+                partial["lm_time"] += float(elem.text)
+            if elem.tag == "segment" or len(stack) == 1:
+                # completely handled, free the memory
+                stack[-1].remove(elem)
+    return partial
+
+
+def merge_search_log_statistics(partials: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merges the partial aggregates of :func:`parse_search_log`, in the given order.
+    Numbers are summed up, dicts (per segment) are joined.
+    """
+    merged = None
+    for partial in partials:
+        if merged is None:
+            merged = partial
+            continue
+        for key, value in partial.items():
+            if isinstance(value, dict):
+                merged[key].update(value)
+            else:
+                merged[key] += value
+    return merged
+
+
+def parse_search_logs(
+    paths: List[str],
+    *,
+    segment_statistics: Callable[[ET.Element, Dict[str, Any]], None],
+    initial_statistics: Dict[str, Any],
+    num_processes: int = 1,
+) -> Dict[str, Any]:
+    """
+    Parses all search logs with :func:`parse_search_log`, with up to num_processes logs in parallel,
+    and merges the results in the order of the paths.
+    """
+    parse = functools.partial(
+        parse_search_log, segment_statistics=segment_statistics, initial_statistics=initial_statistics
+    )
+    if num_processes > 1:
+        with multiprocessing.Pool(num_processes) as pool:
+            return merge_search_log_statistics(pool.imap(parse, paths))
+    return merge_search_log_statistics(map(parse, paths))
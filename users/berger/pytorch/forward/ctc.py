@@ -1,110 +1,244 @@
-import torch
+import collections
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional, Tuple
+
 import numpy as np
-from torchaudio.models.rnnt import RNNT
-from returnn.frontend import Tensor
+import torch
+from returnn.forward_iface import ForwardCallbackIface
 from returnn.tensor.tensor_dict import TensorDict
-from i6_experiments.users.berger.pytorch.forward.transducer_beam_search import beam_search
-from sisyphus import tk
-from i6_core.lib.lexicon import Lexicon
+
+
+class RecognitionTimes:
+    """
+    Timing counters of the recognition, shared by the forward step (AM) and the search callback of one process.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.running_audio_len_s = 0.0
+        self.total_am_time = 0.0
+        self.total_search_time = 0.0  # summed over all decoder threads
+        self.total_search_wait_time = 0.0  # search time which is not overlapped with the AM
+        self.start_time = time.perf_counter()
+
+    def print_summary(self):
+        audio_len_s = max(self.running_audio_len_s, 1e-8)
+        total_time = time.perf_counter() - self.start_time
+        print("Total-AM-Time: %.2fs, AM-RTF: %.3f" % (self.total_am_time, self.total_am_time / audio_len_s))
+        print(
+            "Total-Search-Time: %.2fs, Search-RTF: %.3f"
+            % (self.total_search_time, self.total_search_time / audio_len_s)
+        )
+        print(
+            "Total-Search-Wait-Time: %.2fs, Search-Wait-RTF: %.3f"
+            % (self.total_search_wait_time, self.total_search_wait_time / audio_len_s)
+        )
+        print("Total-time: %.2fs, RTF: %.3f" % (total_time, total_time / audio_len_s))
+
+
+recognition_times = RecognitionTimes()
 
 
 def flashlight_ctc_decoder_forward_step(
-    *, model: torch.nn.Module, extern_data: TensorDict, lexicon_file: tk.Path, beam_size: int, **kwargs
+    *, model: torch.nn.Module, extern_data: TensorDict, input_sample_rate: int = 16000, **kwargs
 ):
-    from torchaudio.models.decoder import ctc_decoder
+    """
+    AM part of the flashlight CTC recognition, the search is done by :class:`FlashlightCTCSearchCallback`,
+    such that it runs concurrently to the AM of the next batches.
 
+    :param input_sample_rate: input frames per second of extern_data["data"], e.g. 16000 for raw audio
+        or 100 for features with 10ms frame shift. Only used for the RTF.
+    """
     audio_features = extern_data["data"].raw_tensor
     assert extern_data["data"].dims[1].dyn_size_ext is not None
     audio_features_len = extern_data["data"].dims[1].dyn_size_ext.raw_tensor
-    seq_tags = extern_data["seq_tag"].raw_tensor
-    assert seq_tags is not None
 
     assert audio_features is not None
     assert audio_features_len is not None
 
-    lexicon = Lexicon()
-    lexicon.load(lexicon_file)
-    label_list = list(lexicon.phonemes)
-
-    dec = ctc_decoder()
-
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    tokens_arrays = []
-    tokens_len = []
-
-    for b in range(audio_features.size(0)):
-        seq_feature_len = audio_features_len[b : b + 1]
-        seq_features = audio_features[b : b + 1, : seq_feature_len[0]]
-        token_indices = beam_search(
-            model=model.to(device=device),
-            features=seq_features.to(device=device),
-            features_len=seq_feature_len.to(device=device),
-            beam_size=beam_size,
-        )
-        tokens_array = np.array([label_list[token_idx] for token_idx in token_indices], dtype="<U3")
-        print(f"Recognized sequence {repr(seq_tags[b])}: {tokens_array}")
-        tokens_arrays.append(tokens_array)
-        tokens_len.append(len(tokens_array))
-
-    max_len = np.max(tokens_len)
-    tokens_arrays_padded = [
-        np.pad(tokens_array, pad_width=(0, max_len - len(tokens_array))) for tokens_array in tokens_arrays
-    ]
+    am_start = time.perf_counter()
+    log_probs, out_seq_len = model(
+        audio_features=audio_features.to(device),
+        audio_features_len=audio_features_len.to(device),
+    )  # [B, T, F]
+    log_probs = log_probs.cpu()
+    am_time = time.perf_counter() - am_start
 
-    tokens_tensor = Tensor(
-        name="tokens", dtype="string", raw_tensor=np.stack(tokens_arrays_padded, axis=0), feature_dim_axis=None
-    )
-    tokens_len_array = np.array(tokens_len, dtype=np.int32)
+    audio_len_batch = float(torch.sum(audio_features_len)) / input_sample_rate
+    recognition_times.running_audio_len_s += audio_len_batch
+    recognition_times.total_am_time += am_time
+    print("Batch-AM-Time: %.2fs, AM-RTF: %.3f" % (am_time, am_time / max(audio_len_batch, 1e-8)))
 
     import returnn.frontend as rf
 
     run_ctx = rf.get_run_ctx()
     if run_ctx.expected_outputs is not None:
-        assert run_ctx.expected_outputs["tokens"].dims[1].dyn_size_ext is not None
-        run_ctx.expected_outputs["tokens"].dims[1].dyn_size_ext.raw_tensor = tokens_len_array
-
-    run_ctx.mark_as_output(tokens_tensor, name="tokens")
-
-    run_ctx.recognition_file = open("search_out.py", "wt")
-    run_ctx.recognition_file.write("{\n")
-    import subprocess
-
-    if kwargs["arpa_lm"] is not None:
-        lm = subprocess.check_output(["cf", kwargs["arpa_lm"]]).decode().strip()
-    else:
-        lm = None
-    from returnn.datasets.util.vocabulary import Vocabulary
-
-    vocab = Vocabulary.create_vocab(vocab_file=kwargs["returnn_vocab"], unknown_label=None)
-    labels = vocab.labels
-    run_ctx.ctc_decoder = ctc_decoder(
-        lexicon=kwargs["lexicon"],
-        lm=lm,
-        lm_weight=kwargs["lm_weight"],
-        tokens=labels + ["[blank]", "[SILENCE]", "[UNK]"],
-        # "[SILENCE]" and "[UNK]" are not actually part of the vocab,
-        # but the decoder is happy as long they are defined in the token list
-        # even if they do not exist as label index in the softmax output,
-        blank_token="[blank]",
-        sil_token="[SILENCE]",
-        unk_word="[unknown]",
-        nbest=1,
-        beam_size=kwargs["beam_size"],
-        beam_size_token=kwargs.get("beam_size_token", None),
-        beam_threshold=kwargs["beam_threshold"],
-        sil_score=kwargs.get("sil_score", 0.0),
-        word_score=kwargs.get("word_score", 0.0),
-    )
-    run_ctx.labels = labels
-    run_ctx.blank_log_penalty = kwargs.get("blank_log_penalty", None)
-
-    if kwargs.get("prior_file", None):
-        run_ctx.prior = np.loadtxt(kwargs["prior_file"], dtype="float32")
-        run_ctx.prior_scale = kwargs["prior_scale"]
-    else:
-        run_ctx.prior = None
-
-    run_ctx.running_audio_len_s = 0
-    run_ctx.total_am_time = 0
-    run_ctx.total_search_time = 0
+        run_ctx.expected_outputs["log_probs"].dims[1].dyn_size_ext.raw_tensor = out_seq_len
+    run_ctx.mark_as_output(log_probs, name="log_probs")
+
+
+def _get_local_lm_file(arpa_lm: str) -> str:
+    # Copy the LM to the local disk via the cache manager, if it is available.
+    if shutil.which("cf") is None:
+        return arpa_lm
+    return subprocess.check_output(["cf", arpa_lm]).decode().strip()
+
+
+class FlashlightCTCDecoderPool:
+    """
+    Thread pool where every worker thread owns one torchaudio flashlight CTC decoder.
+    The decoders are not thread-safe, but they can be reused for all sequences,
+    so the lexicon trie and the LM are built only once per thread instead of once per forward step.
+    """
+
+    def __init__(
+        self,
+        *,
+        lexicon: str,
+        returnn_vocab: str,
+        arpa_lm: Optional[str] = None,
+        lm_weight: float = 0.0,
+        beam_size: int = 50,
+        beam_size_token: Optional[int] = None,
+        beam_threshold: float = 50.0,
+        sil_score: float = 0.0,
+        word_score: float = 0.0,
+        num_threads: int = 4,
+    ):
+        from returnn.datasets.util.vocabulary import Vocabulary
+
+        vocab = Vocabulary.create_vocab(vocab_file=returnn_vocab, unknown_label=None)
+        self.labels = vocab.labels
+        self.decoder_kwargs = dict(
+            lexicon=lexicon,
+            lm=_get_local_lm_file(arpa_lm) if arpa_lm is not None else None,
+            lm_weight=lm_weight,
+            tokens=self.labels + ["[blank]", "[SILENCE]", "[UNK]"],
+            # "[SILENCE]" and "[UNK]" are not actually part of the vocab,
+            # but the decoder is happy as long they are defined in the token list
+            # even if they do not exist as label index in the softmax output,
+            blank_token="[blank]",
+            sil_token="[SILENCE]",
+            unk_word="[unknown]",
+            nbest=1,
+            beam_size=beam_size,
+            beam_size_token=beam_size_token,
+            beam_threshold=beam_threshold,
+            sil_score=sil_score,
+            word_score=word_score,
+        )
+        self._thread_local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, initializer=self._init_thread)
+
+    def _init_thread(self):
+        from torchaudio.models.decoder import ctc_decoder
+
+        self._thread_local.decoder = ctc_decoder(**self.decoder_kwargs)
+
+    def _decode(self, log_probs: np.ndarray) -> Tuple[str, float]:
+        """
+        :param log_probs: [T, F]
+        :return: recognized words, search time
+        """
+        search_start = time.perf_counter()
+        emissions = torch.from_numpy(np.ascontiguousarray(log_probs, dtype=np.float32)).unsqueeze(0)  # [1, T, F]
+        hypothesis = self._thread_local.decoder(emissions, torch.tensor([log_probs.shape[0]], dtype=torch.int32))
+        words = hypothesis[0][0].words
+        sequence = " ".join([word for word in words if not word.startswith("[")])
+        return sequence, time.perf_counter() - search_start
+
+    def submit(self, log_probs: np.ndarray) -> "Future[Tuple[str, float]]":
+        """
+        :param log_probs: [T, F]
+        :return: future of (recognized words, search time)
+        """
+        return self._executor.submit(self._decode, log_probs)
+
+
+_decoder_pools: Dict[Tuple[Tuple[str, Any], ...], FlashlightCTCDecoderPool] = {}
+
+
+def get_flashlight_ctc_decoder_pool(**kwargs) -> FlashlightCTCDecoderPool:
+    """
+    :param kwargs: see :class:`FlashlightCTCDecoderPool`
+    :return: decoder pool of this process for these options
+    """
+    key = tuple(sorted(kwargs.items()))
+    if key not in _decoder_pools:
+        _decoder_pools[key] = FlashlightCTCDecoderPool(**kwargs)
+    return _decoder_pools[key]
+
+
+class FlashlightCTCSearchCallback(ForwardCallbackIface):
+    """
+    Lexicon-constrained CTC search on the log_probs of :func:`flashlight_ctc_decoder_forward_step`.
+    The sequences are decoded in a thread pool while the next batches are forwarded,
+    the results are written in the order of the sequences to search_out.py.
+    """
+
+    def __init__(
+        self,
+        *,
+        blank_log_penalty: Optional[float] = None,
+        prior_file: Optional[str] = None,
+        prior_scale: float = 0.0,
+        max_pending_seqs: int = 100,
+        **decoder_kwargs,
+    ):
+        """
+        :param blank_log_penalty: subtracted from the blank log prob, assumes blank is last
+        :param prior_file: txt file with the log prior, see :class:`ComputePriorCallback`
+        :param prior_scale:
+        :param max_pending_seqs: max number of sequences which are waiting for the search,
+            such that the log_probs of the whole corpus do not pile up when the search is slower than the AM
+        :param decoder_kwargs: see :class:`FlashlightCTCDecoderPool`
+        """
+        self.blank_log_penalty = blank_log_penalty
+        self.prior = np.loadtxt(prior_file, dtype="float32") if prior_file else None
+        self.prior_scale = prior_scale
+        self.max_pending_seqs = max_pending_seqs
+        self.decoder_kwargs = decoder_kwargs
+
+    def init(self, *, model: torch.nn.Module):
+        recognition_times.reset()
+        self.decoder_pool = get_flashlight_ctc_decoder_pool(**self.decoder_kwargs)
+        self.pending: Deque[Tuple[str, Future]] = collections.deque()
+        self.recognition_file = open("search_out.py", "wt")
+        self.recognition_file.write("{\n")
+
+    def _write_finished(self, *, max_pending: int):
+        while self.pending and (len(self.pending) > max_pending or self.pending[0][1].done()):
+            seq_tag, future = self.pending.popleft()
+            wait_start = time.perf_counter()
+            sequence, search_time = future.result()
+            recognition_times.total_search_wait_time += time.perf_counter() - wait_start
+            recognition_times.total_search_time += search_time
+            print(f"Recognized sequence {repr(seq_tag)}: {sequence}")
+            self.recognition_file.write("%s: %s,\n" % (repr(seq_tag), repr(sequence)))
+
+    def process_seq(self, *, seq_tag: str, outputs: TensorDict):
+        log_probs = outputs["log_probs"].raw_tensor  # [T, F]
+        assert log_probs is not None
+        if self.blank_log_penalty is not None or self.prior is not None:
+            log_probs = log_probs.copy()
+        if self.blank_log_penalty is not None:
+            # assumes blank is last
+            log_probs[:, -1] -= self.blank_log_penalty
+        if self.prior is not None:
+            log_probs -= self.prior_scale * self.prior
+        self.pending.append((seq_tag, self.decoder_pool.submit(log_probs)))
+        self._write_finished(max_pending=self.max_pending_seqs)
+
+    def finish(self):
+        self._write_finished(max_pending=0)
+        self.recognition_file.write("}\n")
+        self.recognition_file.close()
+        recognition_times.print_summary()
@@ -1,51 +1,29 @@
-import numpy as np
 import torch
 from returnn.forward_iface import ForwardCallbackIface
 from returnn.tensor.tensor_dict import TensorDict
 
+from .prior_utils import PriorAccumulator, write_prior_files
+
 
 class ComputePriorCallback(ForwardCallbackIface):
+    """
+    Writes the prior files and the mergeable statistics (prior_stats.npz),
+    see :class:`i6_experiments.users.berger.recipe.returnn.forward.MergePriorStatisticsJob`.
+    """
+
     def init(self, *, model: torch.nn.Module):
-        self.n = 1
-        self.avg_probs = None
+        self.accumulator = PriorAccumulator()
 
     def process_seq(self, *, seq_tag: str, outputs: TensorDict):
         log_prob_tensor = outputs["log_probs"].raw_tensor
         assert log_prob_tensor is not None
-        prob_tensor_iter = iter(np.exp(log_prob_tensor))
-
-        if self.avg_probs is None:
-            self.avg_probs = next(prob_tensor_iter)
-            print("Create probs collection tensor of shape", self.avg_probs.shape)
-
-        for prob_tensor in prob_tensor_iter:
-            self.n += 1
-            self.avg_probs += (prob_tensor - self.avg_probs) / self.n
+        self.accumulator.add(log_prob_tensor)
 
     def finish(self):
-        prob_array = self.avg_probs
-        log_prob_array = np.log(prob_array)
-        log_prob_strings = ["%.20e" % s for s in log_prob_array]
-
-        # Write txt file
-        with open("../output/prior.txt", "wt") as f:
-            f.write(" ".join(log_prob_strings))
-
-        # Write xml file
-        with open("../output/prior.xml", "wt") as f:
-            f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<vector-f32 size="{len(log_prob_array)}">\n')
-            f.write(" ".join(log_prob_strings))
-            f.write("\n</vector-f32>")
-
-        # Plot png file
-        import matplotlib
-
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-
-        xdata = range(len(prob_array))
-        plt.semilogy(xdata, prob_array)
-        plt.xlabel("emission idx")
-        plt.ylabel("prior")
-        plt.grid(True)
-        plt.savefig("../output/prior.png")
+        self.accumulator.save("../output/prior_stats.npz")
+        write_prior_files(
+            self.accumulator.get_log_prior(),
+            txt_file="../output/prior.txt",
+            xml_file="../output/prior.xml",
+            png_file="../output/prior.png",
+        )
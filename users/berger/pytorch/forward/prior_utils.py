@@ -0,0 +1,73 @@
+"""
+Prior statistics and prior file writing, numpy only,
+such that it can be used both in the RETURNN forward callback and in the Sisyphus jobs.
+"""
+
+import numpy as np
+
+
+def logsumexp(log_values: np.ndarray, axis: int = 0) -> np.ndarray:
+    max_values = np.max(log_values, axis=axis, keepdims=True)
+    max_values[~np.isfinite(max_values)] = 0.0
+    return np.squeeze(max_values, axis=axis) + np.log(np.sum(np.exp(log_values - max_values), axis=axis))
+
+
+class PriorAccumulator:
+    """
+    Accumulates the frame count and the log of the summed probabilities.
+    The statistics of several accumulators (e.g. of forward jobs on different parts of the data) can be merged,
+    the prior is the log of the average probability over all frames.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.log_sum = None
+
+    def add(self, log_probs: np.ndarray):
+        """
+        :param log_probs: [T, F]
+        """
+        if log_probs.shape[0] == 0:
+            return  # nothing to accumulate, and logsumexp does not work on an empty axis
+        seq_log_sum = logsumexp(log_probs.astype(np.float64), axis=0)  # [F]
+        if self.log_sum is None:
+            self.log_sum = seq_log_sum
+            print("Create probs collection tensor of shape", self.log_sum.shape)
+        else:
+            self.log_sum = np.logaddexp(self.log_sum, seq_log_sum)
+        self.count += log_probs.shape[0]
+
+    def get_log_prior(self) -> np.ndarray:
+        assert self.log_sum is not None and self.count > 0
+        return self.log_sum - np.log(self.count)
+
+    def save(self, filename: str):
+        with open(filename, "wb") as f:
+            np.savez(f, count=np.array(self.count, dtype=np.int64), log_sum=self.log_sum)
+
+
+def write_prior_files(log_prob_array: np.ndarray, txt_file: str, xml_file: str, png_file: str):
+    log_prob_strings = ["%.20e" % s for s in log_prob_array]
+
+    # Write txt file
+    with open(txt_file, "wt") as f:
+        f.write(" ".join(log_prob_strings))
+
+    # Write xml file
+    with open(xml_file, "wt") as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<vector-f32 size="{len(log_prob_array)}">\n')
+        f.write(" ".join(log_prob_strings))
+        f.write("\n</vector-f32>")
+
+    # Plot png file
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    xdata = range(len(log_prob_array))
+    plt.semilogy(xdata, np.exp(log_prob_array))
+    plt.xlabel("emission idx")
+    plt.ylabel("prior")
+    plt.grid(True)
+    plt.savefig(png_file)
@@ -1,33 +1,135 @@
-from functools import lru_cache
 from typing import List
-from dataclasses import dataclass
 
 import torch
-from torchaudio.models.rnnt import RNNT
 
-from i6_experiments.users.berger.pytorch.models.conformer_transducer import FFNNTransducer
-
-
-@dataclass
-class Hypothesis:
-    tokens: List[int]
-    score: float
-    timestep: int
-
-    @property
-    def avg_score(self) -> float:
-        return self.score / len(self.tokens)
-
-
-def extended_hypothesis(base_hyp: Hypothesis, token: int, is_blank: bool, score: float) -> Hypothesis:
-    return Hypothesis(
-        base_hyp.tokens + [token],
-        base_hyp.score + score,
-        base_hyp.timestep + int(is_blank),
-    )
-
-
-def beam_search(*, model: RNNT, features: torch.Tensor, features_len: torch.Tensor, beam_size: int = 100) -> List[int]:
+from i6_experiments.users.berger.pytorch.models.conformer_transducer_v1 import FFNNTransducer
+
+
+def batched_beam_search(
+    *, model: FFNNTransducer, features: torch.Tensor, features_len: torch.Tensor, beam_size: int = 100
+) -> List[List[int]]:
+    """
+    Beam search for a whole batch, with all hypotheses kept as [B, K] tensors (K = beam_size).
+
+    Hypotheses are scored with the sum of the negative log probs and pruned with the score normalized by the number
+    of tokens (including the initial blank history). A non-blank label does not advance the time frame,
+    finished hypotheses are kept until all hypotheses of the batch have reached the end of their time axis.
+
+    Since the predictor of the FFNN transducer only sees the last context_history_size tokens,
+    - the joint network is evaluated once per unique (sequence, frame, context) of the active hypotheses
+    - hypotheses with identical (frame, number of tokens, context) are recombined, only the best one is kept
+
+    :return: non-blank token indices of the best hypothesis of every sequence
+    """
+    enc, enc_lens = model.forward_encoder(features, features_len)  # [B, T, C], [B]
+    enc_lens = enc_lens.to(device=enc.device, dtype=torch.long)
+    B = enc.size(0)
+    C = enc.size(2)
+    H = model.context_history_size
+    K = beam_size
+    blank_idx = model.blank_idx
+    device = enc.device
+    batch_idx = torch.arange(B, device=device).unsqueeze(1)  # [B, 1]
+    inf = torch.tensor(float("inf"), device=device)
+
+    # Initial hypothesis contains all-blank history with 0 score, the other beam entries are unused (infinite score)
+    context = torch.full((B, K, H), blank_idx, dtype=torch.long, device=device)  # [B, K, H]
+    timesteps = torch.zeros((B, K), dtype=torch.long, device=device)  # [B, K]
+    lengths = torch.full((B, K), H, dtype=torch.long, device=device)  # [B, K]
+    scores = torch.full((B, K), float("inf"), device=device)  # [B, K]
+    scores[:, 0] = 0
+
+    # per step: beam index of the parent and appended token (-1 if the hypothesis was finished and kept)
+    backpointers = []
+
+    with torch.no_grad():
+        while True:
+            active = (timesteps < enc_lens.unsqueeze(1)) & torch.isfinite(scores)  # [B, K]
+            if not active.any():
+                break
+
+            # Scores of all extensions, the joint is evaluated once per unique (b, t, context)
+            active_b, active_k = active.nonzero(as_tuple=True)  # [N], [N]
+            keys = torch.cat(
+                [active_b.unsqueeze(1), timesteps[active_b, active_k].unsqueeze(1), context[active_b, active_k]], dim=1
+            )  # [N, 2+H]
+            unique_keys, inverse = torch.unique(keys, dim=0, return_inverse=True)  # [U, 2+H], [N]
+            log_probs = model.forward_single(enc[unique_keys[:, 0], unique_keys[:, 1]], unique_keys[:, 2:])  # [U, C]
+
+            ext_scores = torch.full((B, K, C), float("inf"), device=device)  # [B, K, C]
+            ext_scores[active_b, active_k] = scores[active_b, active_k].unsqueeze(1) - log_probs[inverse]
+            # finished hypotheses are kept as they are
+            keep_scores = torch.where(active, inf, scores)  # [B, K]
+            cand_scores = torch.cat([ext_scores, keep_scores.unsqueeze(2)], dim=2)  # [B, K, C+1]
+
+            # Recombination of candidates with identical (b, t, length, context), keep the first best one
+            cand_b, cand_k, cand_c = torch.isfinite(cand_scores).nonzero(as_tuple=True)  # [M]
+            is_keep = cand_c == C  # [M]
+            parent_context = context[cand_b, cand_k]  # [M, H]
+            cand_context = torch.where(
+                is_keep.unsqueeze(1), parent_context, torch.cat([parent_context[:, 1:], cand_c.unsqueeze(1)], dim=1)
+            )  # [M, H]
+            cand_timesteps = timesteps[cand_b, cand_k] + ((cand_c == blank_idx) & ~is_keep)  # [M]
+            cand_lengths = lengths[cand_b, cand_k] + (~is_keep)  # [M]
+            keys = torch.cat(
+                [cand_b.unsqueeze(1), cand_timesteps.unsqueeze(1), cand_lengths.unsqueeze(1), cand_context], dim=1
+            )  # [M, 3+H]
+            unique_keys, group = torch.unique(keys, dim=0, return_inverse=True)  # [G, 3+H], [M]
+            if unique_keys.size(0) < keys.size(0):
+                flat_scores = cand_scores[cand_b, cand_k, cand_c]  # [M]
+                group_best = torch.full((unique_keys.size(0),), float("inf"), device=device).scatter_reduce(
+                    0, group, flat_scores, reduce="amin"
+                )  # [G]
+                positions = torch.arange(keys.size(0), device=device)  # [M]
+                first_best = torch.full((unique_keys.size(0),), keys.size(0), device=device).scatter_reduce(
+                    0, group, torch.where(flat_scores == group_best[group], positions, keys.size(0)), reduce="amin"
+                )  # [G]
+                recombined = first_best[group] != positions  # [M]
+                cand_scores[cand_b[recombined], cand_k[recombined], cand_c[recombined]] = float("inf")
+
+            # Pruning on the length normalized scores
+            cand_lengths = lengths.unsqueeze(2) + (torch.arange(C + 1, device=device) < C)  # [B, K, C+1]
+            avg_scores = (cand_scores / cand_lengths).view(B, K * (C + 1))  # [B, K*(C+1)]
+            _, best = torch.topk(avg_scores, k=K, dim=1, largest=False)  # [B, K]
+            parents = best // (C + 1)  # [B, K]
+            tokens = best % (C + 1)  # [B, K]
+            is_keep = tokens == C  # [B, K]
+
+            scores = cand_scores.view(B, K * (C + 1)).gather(1, best)  # [B, K]
+            parent_context = context[batch_idx, parents]  # [B, K, H]
+            context = torch.where(
+                is_keep.unsqueeze(2),
+                parent_context,
+                torch.cat([parent_context[:, :, 1:], tokens.clamp(max=C - 1).unsqueeze(2)], dim=2),
+            )  # [B, K, H]
+            timesteps = timesteps[batch_idx, parents] + ((tokens == blank_idx) & ~is_keep)  # [B, K]
+            lengths = lengths[batch_idx, parents] + (~is_keep)  # [B, K]
+            backpointers.append((parents, torch.where(is_keep, -1, tokens)))
+
+    best_hyps = torch.argmin(scores / lengths, dim=1).cpu()  # [B]
+    assert torch.all(timesteps[torch.arange(B), best_hyps.to(device)] == enc_lens)
+
+    # Backtracking of the token sequences
+    results = []
+    if backpointers:
+        all_parents = torch.stack([parents for parents, _ in backpointers]).cpu().numpy()  # [S, B, K]
+        all_tokens = torch.stack([tokens for _, tokens in backpointers]).cpu().numpy()  # [S, B, K]
+    for b in range(B):
+        k = int(best_hyps[b])
+        non_blanks = []
+        for step in range(len(backpointers) - 1, -1, -1):
+            token = int(all_tokens[step, b, k])
+            if token >= 0 and token != blank_idx:
+                non_blanks.append(token)
+            k = int(all_parents[step, b, k])
+        results.append(non_blanks[::-1])
+
+    return results
+
+
+def beam_search(
+    *, model: FFNNTransducer, features: torch.Tensor, features_len: torch.Tensor, beam_size: int = 100
+) -> List[int]:
     # Some dimension checks
     assert features.dim() == 2 or (features.dim() == 3 and features.size(0) == 1)  # [T, F] or [1, T, F]
     if features.dim() == 2:
@@ -37,50 +139,4 @@ def beam_search(*, model: RNNT, features: torch.Tensor, features_len: torch.Tens
     if features_len.dim() == 0:
         features_len = features_len.unsqueeze(0)  # [1]
 
-    # Compute encoder once
-    enc, enc_lens = model.forward_encoder(features, features_len)  # [1, T, C], [1]
-    T = enc_lens[0].cpu().item()
-
-    # Function to get scores for time and history to avoid duplicate computation
-    @lru_cache
-    def cached_forward(timestep: int, context_tensor: torch.Tensor) -> torch.Tensor:
-        enc_state = enc[:, timestep]  # [1, C]
-        log_probs = model.forward_single(enc_state, context_tensor.unsqueeze(0))[0]  # [C]
-        scores = -log_probs  # [C]
-        return scores.cpu()
-
-    # Initial hypothesis contains all-blank history with 0 score
-    hypotheses = [Hypothesis([model.blank_idx] * model.context_history_size, 0, 0)]
-
-    # all_finished indicated if all hypotheses have reached the end of the time axis
-    all_finished = False
-    while not all_finished:
-        next_hypotheses = []  # accumulate extended hypotheses in here
-        all_finished = True
-
-        # iterate over all existing hypotheses and extend them
-        for hypothesis in hypotheses:
-            if hypothesis.timestep == T:
-                # hypothesis has already reached end of time axis and is not extended
-                next_hypotheses.append(hypothesis)
-                continue
-
-            # hypothesis gets extended, so not all are finished
-            all_finished = False
-
-            # form limited context of hypothesis into a tensor and compute log probs with it
-            context_tensor = torch.tensor(hypothesis.tokens[-model.context_history_size :], device=enc.device)  # [H]
-            scores = cached_forward(hypothesis.timestep, context_tensor)  # [C]
-
-            # extend hypothesis with all possible next classes
-            for c in range(scores.size(0)):
-                next_hypotheses.append(extended_hypothesis(hypothesis, c, c == model.blank_idx, scores[c].item()))
-
-        # Pruning
-        hypotheses = sorted(next_hypotheses, key=lambda hyp: hyp.avg_score)[:beam_size]
-
-    best_hypothesis = hypotheses[0]  # list has been sorted at the end of the loop so the best is first in the list
-    assert best_hypothesis.timestep == T
-    non_blanks = list(filter(lambda c: c != model.blank_idx, best_hypothesis.tokens))
-
-    return non_blanks
+    return batched_beam_search(model=model, features=features, features_len=features_len, beam_size=beam_size)[0]
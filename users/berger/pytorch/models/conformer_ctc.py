@@ -113,6 +113,36 @@ def get_recog_serializer(
     )
 
 
+def get_flashlight_recog_serializer(
+    model_config: ConformerCTCConfig, *, input_sample_rate: int = 16000, **kwargs
+) -> Collection:
+    """
+    :param input_sample_rate: see flashlight_ctc_decoder_forward_step
+    :param kwargs: search options, see FlashlightCTCSearchCallback
+    """
+    pytorch_package = __package__.rpartition(".")[0]
+    return get_basic_pt_network_serializer(
+        module_import_path=f"{__name__}.{ConformerCTCModel.__name__}",
+        model_config=model_config,
+        additional_serializer_objects=[
+            PartialImport(
+                code_object_path=f"{pytorch_package}.forward.ctc.flashlight_ctc_decoder_forward_step",
+                import_as="forward_step",
+                hashed_arguments={},
+                unhashed_package_root="",
+                unhashed_arguments={"input_sample_rate": input_sample_rate},
+            ),
+            PartialImport(
+                code_object_path=f"{pytorch_package}.forward.ctc.FlashlightCTCSearchCallback",
+                import_as="forward_callback",
+                hashed_arguments=kwargs,
+                unhashed_package_root="",
+                unhashed_arguments={},
+            ),
+        ],
+    )
+
+
 def get_serializer(model_config: ConformerCTCConfig, variant: ConfigVariant) -> Collection:
     if variant == ConfigVariant.TRAIN:
         return get_train_serializer(model_config)
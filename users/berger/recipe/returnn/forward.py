@@ -1,7 +1,9 @@
 import copy
 import os
 import subprocess as sp
-from typing import Optional, Union
+
+import numpy as np
+from typing import List, Optional, Union
 
 from i6_core import util
 from i6_core.returnn.config import ReturnnConfig
@@ -35,6 +37,8 @@ class ReturnnForwardComputePriorJob(Job):
         self.out_prior_txt_file = self.output_path("prior.txt")
         self.out_prior_xml_file = self.output_path("prior.xml")
         self.out_prior_png_file = self.output_path("prior.png")
+        # written by ComputePriorCallback, can be combined over several jobs with MergePriorStatisticsJob
+        self.out_prior_stats_file = self.output_path("prior_stats.npz")
 
         self.rqmt = {
             "gpu": 1 if device == "gpu" else 0,
@@ -118,3 +122,44 @@ class ReturnnForwardComputePriorJob(Job):
         }
 
         return super().hash(d)
+
+
+class MergePriorStatisticsJob(Job):
+    """
+    Combines the prior statistics (frame count and log-sum of the probabilities) of several
+    ReturnnForwardComputePriorJobs, e.g. each forwarding a different part of the training data,
+    into the prior of all data.
+    """
+
+    def __init__(self, prior_stats_files: List[tk.Path]):
+        """
+        :param prior_stats_files: out_prior_stats_file of the ReturnnForwardComputePriorJobs
+        """
+        assert len(prior_stats_files) > 0
+        self.prior_stats_files = prior_stats_files
+
+        self.out_prior_txt_file = self.output_path("prior.txt")
+        self.out_prior_xml_file = self.output_path("prior.xml")
+        self.out_prior_png_file = self.output_path("prior.png")
+        self.out_num_frames = self.output_var("num_frames")
+
+    def tasks(self):
+        yield Task("run", mini_task=True)
+
+    def run(self):
+        count = 0
+        log_sum = None
+        for stats_file in self.prior_stats_files:
+            stats = np.load(stats_file.get_path())
+            count += int(stats["count"])
+            log_sum = stats["log_sum"] if log_sum is None else np.logaddexp(log_sum, stats["log_sum"])
+        from i6_experiments.users.berger.pytorch.forward.prior_utils import write_prior_files
+
+        write_prior_files(
+            log_sum - np.log(count),
+            txt_file=self.out_prior_txt_file.get_path(),
+            xml_file=self.out_prior_xml_file.get_path(),
+            png_file=self.out_prior_png_file.get_path(),
+        )
+
+        self.out_num_frames.set(count)
@@ -7,11 +7,10 @@ import logging
 from i6_core.returnn.config import ReturnnConfig
 from i6_core.returnn.training import PtCheckpoint
 from onnxruntime.quantization import quant_pre_process, quantize_static, CalibrationDataReader, CalibrationMethod, QuantType, QuantFormat
-from onnxruntime import InferenceSession, SessionOptions
 from returnn.datasets import Dataset, init_dataset
 from returnn.datasets.hdf import HDFDataset
-from returnn.datasets.meta import MetaDataset
 import numpy as np
+from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader, SimpleHDFWriter
 
 class ExportPyTorchModelToOnnxJob(Job):
     """
@@ -74,6 +73,199 @@ class ExportPyTorchModelToOnnxJob(Job):
             export_func(model=model, model_filename=self.out_onnx_model.get())
 
 
+def select_calibration_seqs(
+    dataset: Dataset,
+    max_seqs: int,
+    random_seed: int = 0,
+    final_skip: Tuple[Optional[int], Optional[int]] = (None, None),
+    filter_opts: Optional[Dict[str, Any]] = None,
+    budget: Tuple[Optional[int], Optional[float]] = (None, None),
+) -> Tuple[List[int], List[Tuple[str, int]], Optional[int]]:
+    """
+    Draws the calibration sequences for :class:`ModelQuantizeStaticJob` randomly without replacement.
+
+    The sequence lengths are read once and the length filters are applied to all sequences at once.
+    The stateful filters (partition, budget, unique_tags, single_tag) are checked in the order of a random permutation
+    of the remaining sequences. This is the same as drawing until a sequence passes,
+    as a sequence which was rejected once can not pass later. All filters have to pass.
+
+    :param dataset: with initialized seq order
+    :param max_seqs:
+    :param random_seed:
+    :param final_skip: (step, count), adds step * count sequences without any filter in the end
+    :param filter_opts: max_seq_len, min_seq_len, partition (list of (min, max) length ranges, one seq each),
+        budget, unique_tags, single_tag
+    :param budget: (total length, stop when less than this fraction of the total length is left)
+    :return: seq indices and (seq tag, seq len) in the order of selection, unused budget
+    """
+    key = "data" if "data" in dataset.get_data_keys() else "raw_audio"
+    filter_opts = filter_opts or {}
+    for name in filter_opts:
+        if name not in ["max_seq_len", "min_seq_len", "partition", "budget", "unique_tags", "single_tag"]:
+            raise NotImplementedError(name)
+    rng = np.random.RandomState(random_seed)
+    num_seqs = dataset.num_seqs
+    seq_lens = np.array([dataset.get_seq_length(seq_idx)[key] for seq_idx in range(num_seqs)], dtype=np.int64)
+
+    candidates = np.arange(num_seqs)
+    if "max_seq_len" in filter_opts:
+        candidates = candidates[seq_lens[candidates] <= filter_opts["max_seq_len"]]
+    if "min_seq_len" in filter_opts:
+        candidates = candidates[seq_lens[candidates] >= filter_opts["min_seq_len"]]
+    logging.info(f"{len(candidates)} of {num_seqs} seqs pass the length filters")
+
+    partitions = list(filter_opts.get("partition", []))
+    open_budget = budget[0]
+    budget_thresh = None if budget[0] is None else budget[0] * budget[1]
+    tag_prefixes = set()
+    seq_idxs = []
+    seq_infos = []
+    for seq_idx in rng.permutation(candidates).tolist():
+        if len(seq_idxs) >= max_seqs or (budget_thresh is not None and budget_thresh > open_budget):
+            break
+        seq_len = int(seq_lens[seq_idx])
+        partition = None
+        if "partition" in filter_opts:
+            partition = next(((lower, upper) for lower, upper in partitions if lower <= seq_len <= upper), None)
+            if partition is None:
+                continue
+        if open_budget is not None and seq_len >= open_budget:
+            continue
+        seq_tag = dataset.get_tag(seq_idx)
+        if "unique_tags" in filter_opts or "single_tag" in filter_opts:
+            tag_prefix = seq_tag.split("/")[1]
+            if "unique_tags" in filter_opts and tag_prefix in tag_prefixes:
+                continue
+            if "single_tag" in filter_opts and tag_prefixes and tag_prefix not in tag_prefixes:
+                continue
+            tag_prefixes.add(tag_prefix)
+        if partition is not None:
+            partitions.remove(partition)
+        if open_budget is not None:
+            open_budget -= seq_len
+        seq_idxs.append(seq_idx)
+        seq_infos.append((seq_tag, seq_len))
+    if len(seq_idxs) < max_seqs and (budget_thresh is None or budget_thresh <= open_budget):
+        logging.warning(f"All seqs seen, only {len(seq_idxs)} seqs selected")
+
+    if final_skip[0] is not None:
+        num_extra = final_skip[0] * final_skip[1]
+        selected = set(seq_idxs)
+        remaining = rng.permutation([seq_idx for seq_idx in range(num_seqs) if seq_idx not in selected])
+        for seq_idx in remaining[:num_extra].tolist():
+            seq_idxs.append(seq_idx)
+            seq_infos.append((dataset.get_tag(seq_idx), int(seq_lens[seq_idx])))
+        logging.info(f"Added {min(num_extra, len(remaining))} seqs for the final skip")
+    return seq_idxs, seq_infos, open_budget
+
+
+def dump_calibration_data(dataset: Dataset, filename: str, **selection_opts):
+    """
+    Writes the sequences selected by :func:`select_calibration_seqs` in the order of selection into a simple HDF.
+    The unused budget is stored in the attribute "unusedBudget".
+
+    :param dataset: with initialized seq order
+    :param filename:
+    :param selection_opts: see :func:`select_calibration_seqs`
+    """
+    import h5py
+
+    key = "data" if "data" in dataset.get_data_keys() else "raw_audio"
+    seq_idxs, seq_infos, open_budget = select_calibration_seqs(dataset, **selection_opts)
+    writer = None
+    for seq_idx, (seq_tag, seq_len) in zip(seq_idxs, seq_infos):
+        dataset.load_seqs(seq_idx, seq_idx + 1)
+        data: np.ndarray = dataset.get_data(seq_idx, key)
+        assert seq_len == data.shape[0], (data.shape, seq_len)
+        if writer is None:
+            writer = SimpleHDFWriter(
+                filename,
+                dim=data.shape[-1] if data.ndim > 1 else None,
+                ndim=data.ndim,
+                buffer_size=100,
+                preallocate=True,
+            )
+        writer.insert_batch(data[None], [seq_len], [seq_tag])
+    assert writer is not None, "no calibration seqs selected"
+    writer.close()
+    if open_budget is not None:
+        with h5py.File(filename, "r+") as f:
+            f.attrs["unusedBudget"] = open_budget
+
+
+def _get_model_input_names(model_path: str) -> List[str]:
+    """
+    :return: names of the graph inputs, without the initializers which are listed as inputs by older exporters
+    """
+    import onnx
+
+    model = onnx.load(model_path, load_external_data=False)
+    initializers = {initializer.name for initializer in model.graph.initializer}
+    return [graph_input.name for graph_input in model.graph.input if graph_input.name not in initializers]
+
+
+class CachedCalibrationDataReader(CalibrationDataReader):
+    """
+    Feeds the calibration data written by :func:`dump_calibration_data` to the quantization.
+    The next sequences are read from the HDF in a background thread.
+    """
+
+    def __init__(self, filename: str, model_path: str, prefetch: int = 16):
+        """
+        :param filename: calibration data HDF
+        :param model_path: ONNX model, the first input gets the data, the second (if any) the seq lengths
+        :param prefetch: number of sequences to read ahead
+        """
+        import queue
+        import threading
+
+        input_names = _get_model_input_names(model_path)
+        logging.info(f"Session Inputs: {input_names}")
+        self.input_name_1 = input_names[0]
+        self.input_name_2 = input_names[1] if len(input_names) > 1 else None
+        self.reader = SimpleHDFReader(filename, cache_blocks=0)
+        self.counter: int = 0
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _prefetch(self):
+        end = None  # None when all data was read, otherwise the exception, which is re-raised in get_next
+        try:
+            for data, _ in self.reader.iterate():
+                data = np.expand_dims(data, axis=0)
+                if self.input_name_2 is not None:
+                    self._queue.put(
+                        {self.input_name_1: data, self.input_name_2: np.array([data.shape[1]], dtype=np.int32)}
+                    )
+                else:
+                    self._queue.put({self.input_name_1: data})
+        except BaseException as exc:
+            end = exc
+        finally:
+            self.reader.close()
+            self._queue.put(end)
+
+    def get_next(self):
+        inputs = self._queue.get()
+        if inputs is None or isinstance(inputs, BaseException):
+            self._queue.put(inputs)  # in case get_next is called again
+            if inputs is not None:
+                raise inputs
+            logging.info(f"Finished after {self.counter} sequences")
+            return None
+        if self.counter % 10 == 0:
+            logging.info(f"{self.counter} seqs seen")
+        self.counter += 1
+        return inputs
+
+    def get_seq_infos(self) -> List[Tuple[str, int]]:
+        """
+        :return: (seq tag, seq len) of all calibration sequences
+        """
+        return [(seq_tag, int(seq_len)) for seq_tag, seq_len in zip(self.reader.tags, self.reader.lengths)]
+
+
 class ModelQuantizeStaticJob(Job):
 
     __sis_hash_exclude__ = {
@@ -90,6 +282,7 @@ class ModelQuantizeStaticJob(Job):
         "num_bins": None,
         "random_seed": 0,
         "filter_opts": None,
+        "calibration_data": None,
     }
 
     def __init__(self,
@@ -111,6 +304,7 @@ class ModelQuantizeStaticJob(Job):
         num_bins: Optional[int] = None,
         random_seed: int = 0,
         filter_opts: Optional[Dict[str, Any]] = None,
+        calibration_data: Optional[tk.Path] = None,
     ):
         """
         :param model:
@@ -118,6 +312,9 @@ class ModelQuantizeStaticJob(Job):
         :param num_seqs:
         :param num_parallel_seqs:
         :param moving_average: whether to use moving average for MinMax or Symmetry for Entropy
+        :param calibration_data: out_calibration_data of :class:`ExtractQuantizationCalibrationDataJob`,
+            if given, the calibration sequences are taken from there and dataset, num_seqs, random_seed, final_skip
+            and filter_opts are not used
         """
         self.model = model
         self.dataset = dataset
@@ -128,6 +325,7 @@ class ModelQuantizeStaticJob(Job):
         self.quant_format = quant_format
         self.weight_type = weight_type
         self.filter_opts = filter_opts
+        self.calibration_data = calibration_data
 
         self.out_model = self.output_path("model.onnx")
         if num_seqs is None:
@@ -177,11 +375,12 @@ class ModelQuantizeStaticJob(Job):
     def tasks(self):
         yield Task("run", rqmt=self.rqmt)
 
-    def convert_to_str(self, dataset: Dict):
+    @staticmethod
+    def convert_to_str(dataset: Dict):
         res = {}
         for x in dataset:
             if isinstance(dataset[x], dict):
-                res[x] = self.convert_to_str(dataset[x])
+                res[x] = ModelQuantizeStaticJob.convert_to_str(dataset[x])
             elif isinstance(dataset[x], tk.Path):
                 res[x] = str(dataset[x])
             else:
@@ -193,168 +392,27 @@ class ModelQuantizeStaticJob(Job):
         quant_pre_process(
             input_model_path=self.model.get_path(),
             output_model_path="model_prep.onnx")
+        if self.calibration_data is not None:
+            calibration_data = self.calibration_data.get_path()
+        else:
+            logging.info("Start Calibration Data Selection")
+            calibration_data = "calibration_data.hdf"
+            if os.path.exists(calibration_data):
+                os.remove(calibration_data)
+            self.dataset = self.convert_to_str(self.dataset)
+            dataset: Dataset = init_dataset(self.dataset)
+            dataset.init_seq_order(1)
+            dump_calibration_data(
+                dataset,
+                calibration_data,
+                max_seqs=self.num_seqs,
+                random_seed=self.random_seed,
+                final_skip=self.final_skip,
+                filter_opts=self.filter_opts,
+                budget=self.budget,
+            )
         logging.info("Start Quant")
-        seed = self.random_seed
-        import random
-        random.seed(seed)
-        class DummyDataReader(CalibrationDataReader):
-
-            def __init__(self,
-                         model_str: str,
-                         data: Union[Dataset, MetaDataset],
-                         max_seqs: int, final_skip:  Optional[Tuple[int, int]] = (None, None),
-                         filter_opts: Optional[Dict[str, Any]] = None,
-                         open_budget: Optional[Tuple[int, float]] = (None, None),
-                ):
-
-                self.max_seqs = max_seqs
-                self.data = data
-                self.counter: int = 0
-                sess_option = SessionOptions()
-                logging.info(f"Data Loading {os.getenv('SLURM_CPUS_PER_TASK')}")
-                sess_option.intra_op_num_threads = int(os.getenv('SLURM_CPUS_PER_TASK'))
-                session = InferenceSession(model_str, sess_option)
-                self.input_name_1 = session.get_inputs()[0].name
-                inputs = []
-                for x in session.get_inputs():
-                    inputs.append(x.name)
-                logging.info(f"Session Inputs: {inputs}")
-                self.input_name_2 = session.get_inputs()[1].name if len(session.get_inputs()) > 1 else None
-                self.final_skip_step = final_skip[0]
-                self.final_skip_count = final_skip[1]
-                self.seen_seqs = []
-                self.seq_infos = []
-                self.filter_opts = filter_opts
-                self.visited_seqs = set()
-                self.open_budget = open_budget[0]
-                self.budget_thresh = None if open_budget[0] is None else open_budget[0] * open_budget[1]
-
-            def compare_budget(self):
-                if self.budget_thresh is None or self.open_budget is None:
-                    return False
-                else:
-                    return self.budget_thresh > self.open_budget
-
-            def get_next(self):
-                key = "data" if "data" in self.data.get_data_keys() else "raw_audio"  # hack to make it compatible with both setups for now
-                seq_number = None
-                if not self.data.is_less_than_num_seqs(self.counter) or self.counter >= self.max_seqs or self.compare_budget():
-                    if not self.data.is_less_than_num_seqs(self.counter):
-                        logging.info(f"Finished after {self.counter} sequences")
-                        return None
-                    elif self.final_skip_step is not None and self.counter < self.max_seqs + self.final_skip_step * self.final_skip_count:
-                        logging.info("Drawing skip step")
-                        for _ in range(self.final_skip_step):
-                            seq_number = random.randint(0, self.data.num_seqs - 1)
-                            self.visited_seqs.add(seq_number)
-                        while seq_number in self.seen_seqs:
-                            seq_number = random.randint(0, self.data.num_seqs - 1)
-                            self.visited_seqs.add(seq_number)
-                            assert len(self.visited_seqs) <= self.data.num_seqs, f"Visited all sequences {len(self.visited_seqs)} vs. {self.data.num_seqs}"
-                    else:
-                        logging.info("Seen all sequences in dataset")
-                        return None
-                if seq_number is None:
-                        while not seq_number or seq_number in self.seen_seqs or not self.check_filter(seq_number):
-                            seq_number = random.randint(0, self.data.num_seqs - 1)
-                            self.visited_seqs.add(seq_number)
-                            assert len(self.visited_seqs) <= self.data.num_seqs, "Visited all sequences"
-                            if len(self.visited_seqs) == self.data.num_seqs and any(x in self.filter_opts for x in ["single_tag", "unique_tags"]):
-                                logging.warning("All seqs seen, still not all num seqs reached")
-                                return None
-                self.seen_seqs.append(seq_number)
-                self.data.load_seqs(seq_number, seq_number+1)
-                data: np.ndarray = self.data.get_data(seq_number, key)
-                seq_len: np.ndarray = self.data.get_seq_length(seq_number)[key]
-                self.seq_infos.append((self.data.get_tag(seq_number), seq_len))
-                logging.info(f"Next Seq Tag {self.data.get_tag(seq_number)} with idx number {seq_number} and len {seq_len}")
-                if self.counter % 10 == 0:
-                    logging.info(f"{self.counter} seqs seen")
-                data = np.expand_dims(data, axis=0)
-                if self.input_name_2 is not None:
-                    assert seq_len == data.shape[1], (data.shape, seq_len)
-                    seq_len = np.array([seq_len], dtype=np.int32)
-                    self.counter += 1
-                    return {self.input_name_1: data, self.input_name_2: seq_len}
-                else:
-                    self.counter += 1
-                    return {self.input_name_1: data}
-
-            def check_filter(self, seq_number) -> bool:
-                if self.filter_opts is not None and len(self.filter_opts) > 0:
-                    for name, value in self.filter_opts.items():
-                        if name == "max_seq_len":
-                            seq_len = self.data.get_seq_length(seq_number)["data" if "data" in self.data.get_data_keys() else "raw_audio"]
-                            if seq_len > value:
-                                logging.info(
-                                    f"FILTER: Seq {self.data.get_tag(seq_number)} has length {seq_len} longer than {value}")
-                                return False
-                        elif name == "min_seq_len":
-                            seq_len = self.data.get_seq_length(seq_number)[
-                                "data" if "data" in self.data.get_data_keys() else "raw_audio"]
-                            if seq_len < value:
-                                logging.info(
-                                    f"FILTER: Seq {self.data.get_tag(seq_number)}has length {seq_len} shorter than {value}")
-                                return False
-                        elif name == "partition":
-                            seq_len = self.data.get_seq_length(seq_number)[
-                                "data" if "data" in self.data.get_data_keys() else "raw_audio"]
-                            for lower, upper in value:
-                                if seq_len > upper or seq_len < lower:
-                                    continue
-                                logging.info(f"FILTER: Removing {(lower, upper)} for Seq {self.data.get_tag(seq_number)} of length {seq_len}")
-                                value.remove((lower, upper))
-                                logging.info(value)
-                                return True
-                            logging.info(
-                                f"FILTER: {self.data.get_tag(seq_number)} of length {seq_len} not matching {value}")
-                            return False
-                        elif name == "budget":
-                            seq_len = self.data.get_seq_length(seq_number)[
-                                "data" if "data" in self.data.get_data_keys() else "raw_audio"]
-                            if seq_len < self.open_budget:
-                                logging.info(f"FILTER: Seq with len {seq_len} within budget {self.open_budget}")
-                                self.open_budget -= seq_len
-                                return True
-                            return False
-                        elif name == "unique_tags":
-                            seq_tag = self.data.get_tag(seq_number)
-                            if self.seq_infos is not None and any(seq_tag.split("/")[1] == info[0].split("/")[1] for info in self.seq_infos):
-                                logging.info(f"FILTER: {seq_tag} found in {self.seq_infos}")
-                                return False
-                            else:
-                                return True
-                        elif name == "single_tag":
-                            seq_tag = self.data.get_tag(seq_number)
-                            if self.seq_infos is not None and not all(seq_tag.split("/")[1] == info[0].split("/")[1] for info in self.seq_infos):
-                                #logging.info(f"FILTER: {seq_tag} prefix not found in {self.seq_infos[0]}")
-                                return False
-                            else:
-                                return True
-                        else:
-                            raise NotImplementedError
-                if self.open_budget is not None:
-                    seq_len = self.data.get_seq_length(seq_number)[
-                        "data" if "data" in self.data.get_data_keys() else "raw_audio"]
-                    if seq_len < self.open_budget:
-                        logging.info(f"FILTER: Seq with len {seq_len} within budget {self.open_budget}")
-                        self.open_budget -= seq_len
-                        return True
-                    return False
-                return True
-
-        self.dataset = self.convert_to_str(self.dataset)
-        dataset: Dataset = init_dataset(self.dataset)
-        dataset.init_seq_order(1)
-
-        y = DummyDataReader(
-            model_str="model_prep.onnx",
-            data=dataset,
-            max_seqs=self.num_seqs,
-            final_skip=self.final_skip,
-            filter_opts=self.filter_opts,
-            open_budget=self.budget
-        )
+        y = CachedCalibrationDataReader(calibration_data, model_path="model_prep.onnx")
         quant_options = {
                 "CalibMaxIntermediateOutputs": self.num_parallel_seqs,
                 "CalibMovingAverage": self.moving_average,
@@ -385,13 +443,82 @@ class ModelQuantizeStaticJob(Job):
             open("calibrate_tensors_dev", "wt").close()
         shutil.move("calibrate_tensors_dev", self.out_dev_log)
 
+        seq_infos = y.get_seq_infos()
         with open("seq_infos", "wt") as f:
-            for seq_tag, seq_len in y.seq_infos:
+            for seq_tag, seq_len in seq_infos:
                 f.write(f"{seq_tag}: {seq_len}\n")
         shutil.move("seq_infos", self.out_seq_info)
-        if y.open_budget is not None:
-            self.out_left_bud.set(y.open_budget)
-            self.out_num_seqs.set(len(y.seq_infos))
-        else:
-            self.out_left_bud.set(0)
-            self.out_num_seqs.set(len(y.seen_seqs))
+        import h5py
+        with h5py.File(calibration_data, "r") as f:
+            self.out_left_bud.set(int(f.attrs.get("unusedBudget", 0)))
+        self.out_num_seqs.set(len(seq_infos))
+
+
+class ExtractQuantizationCalibrationDataJob(Job):
+    """
+    Selects the calibration sequences like :class:`ModelQuantizeStaticJob` and dumps them into a simple HDF.
+    Passed as calibration_data to multiple :class:`ModelQuantizeStaticJob`, e.g. with different calibration methods
+    or quantized op types, they all use the same calibration sequences and the selection is only done once.
+    """
+
+    def __init__(
+        self,
+        dataset: Dict[str, Any],
+        num_seqs: Optional[int] = 10,
+        random_seed: int = 0,
+        final_skip: Tuple[Optional[int], Optional[int]] = (None, None),
+        filter_opts: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        :param dataset: RETURNN dataset opts
+        :param num_seqs: None to only select by the budget in filter_opts
+        :param random_seed:
+        :param final_skip: see :func:`select_calibration_seqs`
+        :param filter_opts: see :func:`select_calibration_seqs`
+        """
+        self.dataset = dataset
+        self.num_seqs = num_seqs
+        self.random_seed = random_seed
+        self.final_skip = final_skip
+        self.filter_opts = filter_opts
+        if num_seqs is None:
+            assert filter_opts is not None and "budget" in filter_opts
+
+        self.out_calibration_data = self.output_path("calibration_data.hdf")
+        self.out_seq_info = self.output_path("seq_info")
+        self.out_num_seqs = self.output_var("num_seqs")
+        self.out_left_bud = self.output_var("unused_budget")
+
+        self.rqmt = {"cpu": 1, "mem": 8, "time": 1 if num_seqs is not None and num_seqs < 1000 else 4}
+
+    def tasks(self):
+        yield Task("run", rqmt=self.rqmt)
+
+    def run(self):
+        import h5py
+
+        dataset_opts = ModelQuantizeStaticJob.convert_to_str(self.dataset)
+        dataset: Dataset = init_dataset(dataset_opts)
+        dataset.init_seq_order(1)
+        dump_calibration_data(
+            dataset,
+            "calibration_data.hdf",
+            max_seqs=self.num_seqs or 10000000,
+            random_seed=self.random_seed,
+            final_skip=self.final_skip,
+            filter_opts=self.filter_opts,
+            budget=(None, None) if self.filter_opts is None else self.filter_opts.get("budget", (None, None)),
+        )
+
+        reader = SimpleHDFReader("calibration_data.hdf", cache_blocks=0)
+        with open(self.out_seq_info.get_path(), "wt") as f:
+            for seq_tag, seq_len in zip(reader.tags, reader.lengths):
+                f.write(f"{seq_tag}: {seq_len}\n")
+        self.out_num_seqs.set(len(reader))
+        reader.close()
+        with h5py.File("calibration_data.hdf", "r") as f:
+            self.out_left_bud.set(int(f.attrs.get("unusedBudget", 0)))
+
+        import shutil
+
+        shutil.move("calibration_data.hdf", self.out_calibration_data.get_path())
@@ -1,6 +1,8 @@
 from sisyphus import *
 import h5py
 from i6_core.lib import corpus
+from i6_experiments.users.rossenbach.lib.corpus_index import open_bliss_corpus_index
+from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader
 import numpy as np
 from typing import Optional
 
@@ -27,59 +29,44 @@ class CalculateVarianceFromFeaturesJob(Job):
 
   def run(self):
 
-    duration_data = h5py.File(self.durations.get_path(), "r")
-    duration_inputs = duration_data["inputs"]
-    duration_raw_tags = duration_data["seqTags"]
-    duration_lengths = duration_data["seqLengths"]
-
-    durations_by_tag = {}
-    offset = 0
-    for tag, length in zip(duration_raw_tags, duration_lengths):
-      durations_by_tag[tag] = duration_inputs[offset:offset + length[0]]
-      offset += length[0]
+    # random access by tag, only the currently needed sequences are held in memory
+    durations_by_tag = SimpleHDFReader(self.durations.get_path())
     print("Durations loaded ", len(durations_by_tag))
-
-    feature_data = h5py.File(self.features.get_path(), "r")
-    feature_inputs = feature_data["inputs"]
-    feature_raw_tags = list(feature_data["seqTags"])
-    feature_lengths = feature_data["seqLengths"]
-    features_by_tag = {}
-    offset = 0
-    for tag, length in zip(feature_raw_tags, feature_lengths):
-      features_by_tag[tag if isinstance(tag, str) else str(tag, "utf-8")] = feature_inputs[offset:offset + length[0]]
-      offset += length[0]
-
+    features_by_tag = SimpleHDFReader(self.features.get_path())
     print("Features loaded ", len(features_by_tag))
 
-    bliss = corpus.Corpus()
-    bliss.load(self.corpus.get_path())
+    bliss = open_bliss_corpus_index(self.corpus.get_path())
     counter = 0
+    # per phoneme: number of frames, sum and sum of squares of the features, to compute the std without storing them
     phoneme_dict = {}
     if self.segments is not None:
         with open(self.segments.get_path(), "rt") as f:
-            segment_list = f.read().splitlines()
+            segment_list = set(f.read().splitlines())
     else:
         segment_list = None
-    for recording in bliss.all_recordings():
-      for segment in recording.segments:
-        if segment_list is not None and segment not in segment_list and segment.fullname() not in segment_list:
-            continue
-        text = segment.orth.split(" ")
-        durations = durations_by_tag[segment.fullname()]
-        features = features_by_tag[segment.fullname()]
-        counter += 1
-        print(counter)
-        assert np.sum(durations) == len(features), (sum(durations), len(features), segment.fullname())
-        assert len(text) == len(durations), (len(text), len(durations), segment.fullname(), text)
-        offset = 0
-        for duration, token in zip(durations, text):
-          if token not in phoneme_dict:
-            phoneme_dict[token] = []
-          if int(duration) > 0:
-            for feature in features[offset:int(duration) + offset]:
-              phoneme_dict[token].append(feature)
-            offset += int(duration)
-        # print(list(zip(text, durations)))
+    for segment in bliss.segments():
+      if segment_list is not None and segment.fullname not in segment_list:
+        continue
+      text = segment.orth.split(" ")
+      durations = durations_by_tag[segment.fullname]
+      features = features_by_tag[segment.fullname]
+      counter += 1
+      print(counter)
+      assert np.sum(durations) == len(features), (sum(durations), len(features), segment.fullname)
+      assert len(text) == len(durations), (len(text), len(durations), segment.fullname, text)
+      offset = 0
+      for duration, token in zip(durations, text):
+        if token not in phoneme_dict:
+          phoneme_dict[token] = [0, 0.0, 0.0]
+        if int(duration) > 0:
+          token_features = features[offset:int(duration) + offset].astype(np.float64)
+          phoneme_dict[token][0] += len(token_features)
+          phoneme_dict[token][1] += np.sum(token_features, axis=0)
+          phoneme_dict[token][2] += np.sum(np.square(token_features), axis=0)
+          offset += int(duration)
+      # print(list(zip(text, durations)))
+    durations_by_tag.close()
+    features_by_tag.close()
 
     mean_ls = []
     counts = []
@@ -90,7 +77,12 @@ class CalculateVarianceFromFeaturesJob(Job):
       for token in phoneme_dict:
         if token.startswith("[start") or token.startswith("[end"):
           continue
-        covs = np.std(phoneme_dict[token], axis=0)
+        count, feature_sum, feature_square_sum = phoneme_dict[token]
+        if count > 0:
+          covs = np.sqrt(np.maximum(feature_square_sum / count - np.square(feature_sum / count), 0.0))
+        else:
+          # token only with zero durations, same as the std of an empty list
+          covs = np.float64(np.nan)
         print(token, covs)
         print("Mean:", np.mean(covs), "Median:", np.median(covs), "Min:", covs.min(), "Max:", covs.max(), "Stds:",
           np.std(covs))
@@ -104,10 +96,10 @@ class CalculateVarianceFromFeaturesJob(Job):
         )
         f.write(string)
         mean_ls.append(np.mean(covs))
-        counts.append(len(phoneme_dict[token]))
+        counts.append(count)
         if not token.startswith("["):
           no_sil_means.append(np.mean(covs))
-          no_sil_counts.append(len(phoneme_dict[token]))
+          no_sil_counts.append(count)
     assert len(mean_ls) == len(no_sil_means) + 1, (len(mean_ls), len(no_sil_means))
     assert len(counts) == len(no_sil_counts) + 1, (len(counts), len(no_sil_counts))
     self.out_variance.set(np.mean(mean_ls))
@@ -1,38 +1,328 @@
 from sisyphus import *
+import json
+import multiprocessing
 import soundfile
 import librosa
 import numpy
+from typing import Optional, Sequence
 
-from i6_core.lib import corpus
+from i6_experiments.users.rossenbach.lib.corpus_index import open_bliss_corpus_index
+from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader, SimpleHDFWriter
+
+# default parameters for the feature extraction of the scoring jobs
+DEFAULT_FEATURE_OPTIONS = {
+  "step_len": 0.0125,
+  "window_len": 0.05,
+  "fmin_pyin": 60,
+  "fmax_pyin": 1000,
+  "fmin_ex": 60,
+  "fmax_ex": 7600,
+  "center": True,
+  "n_mels": 80,
+}
+
+# features which can be extracted, "f0" also includes the voiced flags
+FEATURES = ("mel", "f0", "energy")
+
+
+def _get_feature_options(job):
+  """
+  :param Job job: job with the feature options as attributes, see DEFAULT_FEATURE_OPTIONS
+  :rtype: dict[str]
+  """
+  return {key: getattr(job, key) for key in DEFAULT_FEATURE_OPTIONS}
+
+
+def extract_features(audio, features, options):
+  """
+  Extracts the features of one audio file.
+
+  :param str audio: path to the audio file
+  :param Sequence[str] features: subset of FEATURES
+  :param dict[str] options: see DEFAULT_FEATURE_OPTIONS
+  :return: key -> data, with "mel" [T, n_mels], "f0" [T], "voiced" [T], "energy" [T] and "sample_rate"
+  :rtype: dict[str,numpy.ndarray|int]
+  """
+  signal, sample_rate = soundfile.read(audio)
+  hop_length = int(options["step_len"] * sample_rate)
+  window_length = int(options["window_len"] * sample_rate)
+  res = {"sample_rate": sample_rate}
+  if "mel" in features:
+    mel_filterbank = librosa.feature.melspectrogram(
+      y=signal, sr=sample_rate,
+      n_mels=options["n_mels"],
+      hop_length=hop_length,
+      n_fft=window_length,
+      fmin=options["fmin_ex"], fmax=options["fmax_ex"], center=options["center"]
+    )
+    res["mel"] = numpy.float32(mel_filterbank.T)
+  if "f0" in features:
+    f0, voiced, _ = librosa.pyin(y=signal, sr=sample_rate, hop_length=hop_length,
+      frame_length=window_length, win_length=window_length // 2,
+      fmin=options["fmin_pyin"], fmax=options["fmax_pyin"], center=options["center"], fill_na=0.0)
+    res["f0"] = numpy.float32(f0)
+    res["voiced"] = numpy.int8(voiced)
+  if "energy" in features:
+    energy = librosa.feature.rms(y=signal, hop_length=hop_length, frame_length=window_length)
+    res["energy"] = numpy.float32(numpy.squeeze(energy, axis=0))
+  return res
+
+
+def _extract_features_worker(args):
+  """
+  :param (str,str,Sequence[str],dict[str]) args: segment name, audio, features, options
+  :rtype: (str, dict[str,numpy.ndarray|int])
+  """
+  segment_name, audio, features, options = args
+  return segment_name, extract_features(audio, features, options)
+
+
+def extract_features_parallel(segment_audios, features, options, num_processes=1):
+  """
+  Extracts the features of many audio files with a pool of worker processes.
+
+  :param list[(str,str)] segment_audios: (segment name, audio path)
+  :param Sequence[str] features: subset of FEATURES
+  :param dict[str] options: see DEFAULT_FEATURE_OPTIONS
+  :param int num_processes: usually the cpu rqmt of the job
+  :return: generator of (segment name, features), in the order of segment_audios
+  :rtype: Iterator[(str, dict[str,numpy.ndarray|int])]
+  """
+  assert all(feature in FEATURES for feature in features), "unknown features %r" % (features,)
+  args = [(segment_name, audio, tuple(features), options) for segment_name, audio in segment_audios]
+  if num_processes <= 1:
+    yield from map(_extract_features_worker, args)
+    return
+  with multiprocessing.Pool(num_processes) as pool:
+    yield from pool.imap(_extract_features_worker, args, chunksize=4)
+
+
+def _get_segment_audios(bliss_corpus, segment_list):
+  """
+  :param str bliss_corpus: corpus xml or index of :class:`BuildBlissCorpusIndexJob`
+  :param list[str] segment_list:
+  :return: (segment name, audio path) in the order of segment_list
+  :rtype: list[(str,str)]
+  """
+  index = open_bliss_corpus_index(bliss_corpus)
+  return [(segment_name, index.get_audio(index.get_segment_idx(segment_name))) for segment_name in segment_list]
+
+
+class FeatureCache:
+  """
+  Random access to the features written by :class:`ExtractScoringFeaturesJob`.
+  The mel features are stored as "inputs", all other features as extra data keys of the simple HDF.
+  """
+
+  def __init__(self, filename, features, options=None):
+    """
+    :param str filename:
+    :param Sequence[str] features: features which are needed, must be contained in the cache
+    :param dict[str]|None options: if given, checks that the cache was extracted with these options
+    """
+    import h5py
+    with h5py.File(filename, "r") as f:
+      cached_features = json.loads(f.attrs["features"])
+      cached_options = json.loads(f.attrs["featureOptions"])
+    assert all(feature in cached_features for feature in features), (
+      "features %r not in cache %s with %r" % (features, filename, cached_features))
+    if options is not None:
+      assert cached_options == options, "cache %s was extracted with %r, not %r" % (filename, cached_options, options)
+    self.options = cached_options
+    keys = ["sample_rate"]
+    for feature in features:
+      keys += ["f0", "voiced"] if feature == "f0" else [feature]
+    self._readers = {
+      key: SimpleHDFReader(filename, data_key="inputs" if key == "mel" else key) for key in keys
+    }
+
+  def __contains__(self, segment_name):
+    return segment_name in self._readers["sample_rate"]
+
+  def __getitem__(self, segment_name):
+    """
+    :param str segment_name:
+    :return: same format as :func:`extract_features`
+    :rtype: dict[str,numpy.ndarray|int]
+    """
+    res = {key: reader[segment_name] for key, reader in self._readers.items()}
+    res["sample_rate"] = int(res["sample_rate"][0])
+    return res
+
+  def close(self):
+    for reader in self._readers.values():
+      reader.close()
+
+
+def _iterate_feature_pairs(job, segment_list, features):
+  """
+  Yields the reference and test features of all segments.
+  The reference features are taken from job.ref_features if given, otherwise they are extracted as well.
+  Extraction uses as many processes as cpus are requested by the job.
+
+  :param Job job: :class:`CompareF0ValuesJob` or :class:`CompareEnergyValuesJob`
+  :param list[str] segment_list:
+  :param Sequence[str] features:
+  :rtype: Iterator[(str, dict[str], dict[str])]
+  """
+  options = _get_feature_options(job)
+  num_processes = job.rqmt.get("cpu", 1)
+  test_audios = _get_segment_audios(job.test_corpus.get_path(), segment_list)
+  if job.ref_features is not None:
+    ref_cache = FeatureCache(job.ref_features.get_path(), features, options)
+    assert all(segment in ref_cache for segment in segment_list), "reference features do not contain all segments"
+    for segment, test_features in extract_features_parallel(test_audios, features, options, num_processes):
+      yield segment, ref_cache[segment], test_features
+    ref_cache.close()
+  else:
+    ref_audios = _get_segment_audios(job.ref_corpus.get_path(), segment_list)
+    interleaved = [audio for pair in zip(ref_audios, test_audios) for audio in pair]
+    results = extract_features_parallel(interleaved, features, options, num_processes)
+    for (segment, ref_features), (_, test_features) in zip(results, results):
+      yield segment, ref_features, test_features
+
+
+def _get_warping_path(ref_mel, test_mel, dtw):
+  """
+  :param numpy.ndarray ref_mel: [T_1, n_mels]
+  :param numpy.ndarray test_mel: [T_2, n_mels]
+  :param bool dtw:
+  :return: [N, 2] mapping of ref frames to test frames
+  :rtype: numpy.ndarray
+  """
+  if dtw:
+    D, wp = librosa.sequence.dtw(ref_mel.T, test_mel.T)
+    return wp
+  assert len(ref_mel) == len(test_mel), "If no DTW sequences need same length"
+  return numpy.stack([numpy.arange(len(ref_mel)), numpy.arange(len(test_mel))], axis=1)
+
+
+class ExtractScoringFeaturesJob(Job):
+  """
+  Extracts mel, F0 and energy features of a corpus once,
+  e.g. of the reference corpus which is then passed as ref_features to all :class:`CompareF0ValuesJob`
+  and :class:`CompareEnergyValuesJob` of the different TTS systems.
+  The output is a simple HDF which can be accessed by segment name with :class:`FeatureCache`.
+  """
+
+  def __init__(
+    self,
+    bliss_corpus: tk.Path,
+    segment_list: Optional[tk.Path] = None,
+    features: Sequence[str] = FEATURES,
+    step_len: float = DEFAULT_FEATURE_OPTIONS["step_len"],
+    window_len: float = DEFAULT_FEATURE_OPTIONS["window_len"],
+    fmin_pyin: int = DEFAULT_FEATURE_OPTIONS["fmin_pyin"],
+    fmax_pyin: int = DEFAULT_FEATURE_OPTIONS["fmax_pyin"],
+    fmin_ex: int = DEFAULT_FEATURE_OPTIONS["fmin_ex"],
+    fmax_ex: int = DEFAULT_FEATURE_OPTIONS["fmax_ex"],
+    center: bool = DEFAULT_FEATURE_OPTIONS["center"],
+    n_mels: int = DEFAULT_FEATURE_OPTIONS["n_mels"],
+  ):
+    """
+    :param bliss_corpus: corpus xml or index of :class:`BuildBlissCorpusIndexJob`
+    :param segment_list: only extract these segments, all if None
+    :param features: subset of FEATURES
+    """
+    assert "mel" in features, "mel features are needed for the DTW and stored as inputs"
+    assert all(feature in FEATURES for feature in features), "unknown features %r" % (features,)
+    self.bliss_corpus = bliss_corpus
+    self.segment_list = segment_list
+    self.features = tuple(features)
+    self.step_len = step_len
+    self.window_len = window_len
+    self.fmin_pyin = fmin_pyin
+    self.fmax_pyin = fmax_pyin
+    self.fmin_ex = fmin_ex
+    self.fmax_ex = fmax_ex
+    self.center = center
+    self.n_mels = n_mels
+
+    self.rqmt = {
+      "cpu": 4,
+      "mem": 4,
+      "time": 8,
+    }
+
+    self.out_hdf = self.output_path("features.hdf")
+
+  def tasks(self):
+    yield Task("run", rqmt=self.rqmt)
+
+  def run(self):
+    import h5py
+    if self.segment_list is not None:
+      with open(self.segment_list.get_path(), "r") as f:
+        segment_list = f.read().splitlines()
+      segment_audios = _get_segment_audios(self.bliss_corpus.get_path(), segment_list)
+    else:
+      index = open_bliss_corpus_index(self.bliss_corpus.get_path())
+      segment_audios = [(segment.fullname, segment.audio) for segment in index.segments()]
+
+    options = _get_feature_options(self)
+    extra_type = {"sample_rate": (1, 0, "int32")}
+    if "f0" in self.features:
+      extra_type.update({"f0": (1, 1, "float32"), "voiced": (1, 1, "int8")})
+    if "energy" in self.features:
+      extra_type["energy"] = (1, 1, "float32")
+    writer = SimpleHDFWriter(
+      self.out_hdf.get_path(), dim=self.n_mels, ndim=2, extra_type=extra_type, buffer_size=100, preallocate=True)
+    for segment, features in extract_features_parallel(segment_audios, self.features, options, self.rqmt["cpu"]):
+      mel = features.pop("mel")
+      sample_rate = features.pop("sample_rate")
+      extra = {key: numpy.expand_dims(value, 0) for key, value in features.items()}
+      extra["sample_rate"] = numpy.array([[sample_rate]], dtype="int32")
+      writer.insert_batch(numpy.expand_dims(mel, 0), [len(mel)], [segment], extra=extra)
+    writer.close()
+
+    with h5py.File(self.out_hdf.get_path(), "r+") as f:
+      f.attrs["features"] = json.dumps(list(self.features))
+      f.attrs["featureOptions"] = json.dumps(options)
 
 
 class CompareF0ValuesJob(Job):
   """
   Extracts F0 for two given Corpora and calculates MAE over both
+
+  The reference features can be taken from :class:`ExtractScoringFeaturesJob`,
+  then only the test corpus is extracted. Set rqmt["cpu"] to extract with multiple processes.
   """
 
-  def __init__(self, ref_corpus: tk.Path, test_corpus: tk.Path, segment_list: tk.Path, dtw: bool = True, check_voiced = True):
+  __sis_hash_exclude__ = {"ref_features": None}
+
+  def __init__(self, ref_corpus: tk.Path, test_corpus: tk.Path, segment_list: tk.Path, dtw: bool = True, check_voiced = True,
+               ref_features: Optional[tk.Path] = None):
+    """
+    :param ref_corpus:
+    :param test_corpus:
+    :param segment_list:
+    :param dtw:
+    :param check_voiced:
+    :param ref_features: out_hdf of :class:`ExtractScoringFeaturesJob` for the ref_corpus with "f0"
+    """
 
     self.ref_corpus = ref_corpus
     self.test_corpus = test_corpus
     self.segment_list = segment_list
     self.dtw = dtw
     self.check_voiced = check_voiced
+    self.ref_features = ref_features
 
     self.rqmt = {
+      "cpu": 1,
       "mem": 1,
       "time": 4,
     }
 
     # default parameter for DTW
-    self.step_len = 0.0125
-    self.window_len = 0.05
-    self.fmin_pyin = 60
-    self.fmin_ex = 60
-    self.fmax_ex = 7600
-    self.fmax_pyin = 1000
-    self.center = True
-    self.n_mels = 80
+    self.step_len = DEFAULT_FEATURE_OPTIONS["step_len"]
+    self.window_len = DEFAULT_FEATURE_OPTIONS["window_len"]
+    self.fmin_pyin = DEFAULT_FEATURE_OPTIONS["fmin_pyin"]
+    self.fmin_ex = DEFAULT_FEATURE_OPTIONS["fmin_ex"]
+    self.fmax_ex = DEFAULT_FEATURE_OPTIONS["fmax_ex"]
+    self.fmax_pyin = DEFAULT_FEATURE_OPTIONS["fmax_pyin"]
+    self.center = DEFAULT_FEATURE_OPTIONS["center"]
+    self.n_mels = DEFAULT_FEATURE_OPTIONS["n_mels"]
 
     self.out_maes = self.output_path("maes")
     self.out_ref_means = self.output_path("ref_means")
@@ -46,7 +336,7 @@ class CompareF0ValuesJob(Job):
 
   def tasks(self):
 
-    yield Task("run", mini_task=True)
+    yield Task("run", rqmt=self.rqmt, mini_task=self.rqmt["cpu"] <= 1)
 
   def run(self):
 
@@ -61,77 +351,26 @@ class CompareF0ValuesJob(Job):
     with open(self.segment_list.get_path(), "r") as f:
       segment_list = f.read().splitlines()
 
-    bliss_1 = corpus.Corpus()
-    bliss_1.load(self.ref_corpus.get_path())
-    bliss_2 = corpus.Corpus()
-    bliss_2.load(self.test_corpus.get_path())
-
-    recordings_1 = {}
-    for recording in bliss_1.all_recordings():
-      for segment in recording.segments:
-        if segment.fullname() in segment_list:
-          recordings_1[segment.fullname()] = recording.audio
-
-    recordings_2 = {}
-    for recording in bliss_2.all_recordings():
-      for segment in recording.segments:
-        if segment.fullname() in segment_list:
-          recordings_2[segment.fullname()] = recording.audio
-
-    assert len(recordings_1) == len(segment_list)
-    assert len(segment_list) == len(recordings_2)
-    for segment in segment_list:
-      signal_1, sr_1 = soundfile.read(recordings_1[segment])
-      signal_2, sr_2 = soundfile.read(recordings_2[segment])
-
-      assert sr_1 == sr_2, "Sample rates must match"
-      sample_rate = sr_1
-
-      mel_filterbank_1 = librosa.feature.melspectrogram(
-        y=signal_1, sr=sample_rate,
-        n_mels=self.n_mels,
-        hop_length=int(self.step_len * sample_rate),
-        n_fft=int(self.window_len * sample_rate),
-        fmin=self.fmin_ex, fmax=self.fmax_ex, center=self.center
-      )
-      mel_filterbank_2 = librosa.feature.melspectrogram(
-        y=signal_2, sr=sample_rate,
-        n_mels=self.n_mels,
-        hop_length=int(self.step_len * sample_rate),
-        n_fft=int(self.window_len * sample_rate),
-        fmin=self.fmin_ex, fmax=self.fmax_ex, center=self.center
-      )
-
-      if self.dtw:
-        D, wp = librosa.sequence.dtw(mel_filterbank_1, mel_filterbank_2)
-      else:
-        assert len(mel_filterbank_1) == len(mel_filterbank_2), "If no DTW sequences need same length"
-        wp = list(zip(range(len(mel_filterbank_1)), range(len(mel_filterbank_2))))
-
-      f0_1, voiced_1, _ = librosa.pyin(y=signal_1, sr=sample_rate, hop_length=int(self.step_len * sample_rate),
-        frame_length=int(self.window_len * sample_rate), win_length=int(self.window_len * sample_rate) // 2,
-        fmin=self.fmin_pyin, fmax=self.fmax_pyin, center=self.center, fill_na=0.0)
-      f0_2, voiced_2, _ = librosa.pyin(y=signal_2, sr=sample_rate, hop_length=int(self.step_len * sample_rate),
-        frame_length=int(self.window_len * sample_rate), win_length=int(self.window_len * sample_rate) // 2,
-        fmin=self.fmin_pyin, fmax=self.fmax_pyin, center=self.center, fill_na=0.0)
+    for segment, features_1, features_2 in _iterate_feature_pairs(self, segment_list, ("mel", "f0")):
+      assert features_1["sample_rate"] == features_2["sample_rate"], "Sample rates must match"
+
+      wp = _get_warping_path(features_1["mel"], features_2["mel"], self.dtw)
+      f0_1 = features_1["f0"][wp[:, 0]]
+      f0_2 = features_2["f0"][wp[:, 1]]
+      voiced_1 = features_1["voiced"][wp[:, 0]] > 0
+      voiced_2 = features_2["voiced"][wp[:, 1]] > 0
 
       scale = 1200 / len(wp)
-      sum = 0
-      pitch_ls_1 = []
-      pitch_ls_2 = []
-      wrong_mappings = 0
-      for t_1, t_2 in wp:
-        if (voiced_1[t_1] and voiced_2[t_2]) or not self.check_voiced:
-          pitch_ls_1.append(f0_1[t_1])
-          pitch_ls_2.append(f0_2[t_2])
-          sum += abs(numpy.log2((f0_2[t_2] / f0_1[t_1])))
-        if (voiced_1[t_1] and not voiced_2[t_2]) or (not voiced_1[t_1] and voiced_2[t_2]):
-          wrong_mappings += 1
-
-      mae = scale * sum
+      mask = numpy.logical_and(voiced_1, voiced_2) if self.check_voiced else numpy.ones(len(wp), dtype=bool)
+      pitch_ls_1 = f0_1[mask]
+      pitch_ls_2 = f0_2[mask]
+      wrong_mappings = int(numpy.count_nonzero(voiced_1 != voiced_2))
+
+      mae = scale * numpy.sum(numpy.abs(numpy.log2(pitch_ls_2 / pitch_ls_1)))
       print("MAE     Real Data        Synth Data        Wrong Mappings", "Total Lengths (real/synth)")
       print("%.2f " % mae, "%.2f+-%.2f" % (float(numpy.mean(pitch_ls_1)), float(numpy.std(pitch_ls_1))),
-        "   %.2f+-%.2f " % (float(numpy.mean(pitch_ls_2)), float(numpy.std(pitch_ls_2))), wrong_mappings, len(mel_filterbank_1), len(mel_filterbank_2))
+        "   %.2f+-%.2f " % (float(numpy.mean(pitch_ls_2)), float(numpy.std(pitch_ls_2))), wrong_mappings,
+        len(features_1["mel"]), len(features_2["mel"]))
       mae_ls.append(mae)
       mean_1_ls.append(numpy.mean(pitch_ls_1))
       mean_2_ls.append(numpy.mean(pitch_ls_2))
@@ -140,6 +379,8 @@ class CompareF0ValuesJob(Job):
       wrong_mappings_ls.append(wrong_mappings)
       mappings_ls.append(wp)
 
+    assert len(mae_ls) == len(segment_list)
+
     with open(self.out_maes.get_path(), "w") as f:
       for mae in mae_ls:
         f.write("%s\n" % mae)
@@ -169,30 +410,54 @@ class CompareF0ValuesJob(Job):
     print("Average MAE: ", average_mae, "Total wrong mappings", total_wrong_mappings)
 
 
+
+
 class CompareEnergyValuesJob(Job):
+  """
+  Extracts the RMS energy for two given Corpora and calculates MAE and correlation over the DTW mapping
 
-  def __init__(self, ref_corpus: tk.Path, test_corpus: tk.Path, segment_list: tk.Path, dtw: bool = True):
+  The reference features can be taken from :class:`ExtractScoringFeaturesJob`,
+  then only the test corpus is extracted. Set rqmt["cpu"] to extract with multiple processes.
+  """
+
+  __sis_hash_exclude__ = {"ref_features": None}
+
+  def __init__(self, ref_corpus: tk.Path, test_corpus: tk.Path, segment_list: tk.Path, dtw: bool = True,
+               ref_features: Optional[tk.Path] = None):
+    """
+    :param ref_corpus:
+    :param test_corpus:
+    :param segment_list:
+    :param dtw:
+    :param ref_features: out_hdf of :class:`ExtractScoringFeaturesJob` for the ref_corpus with "energy"
+    """
     self.ref_corpus = ref_corpus
     self.test_corpus = test_corpus
     self.segment_list = segment_list
     self.dtw = dtw
+    self.ref_features = ref_features
+
+    self.rqmt = {
+      "cpu": 1,
+      "mem": 1,
+      "time": 4,
+    }
 
     # default parameter for Extraction
-    self.step_len = 0.0125
-    self.window_len = 0.05
-    self.fmin_pyin = 60
-    self.fmin_ex = 60
-    self.fmax_ex = 7600
-    self.fmax_pyin = 1000
-    self.center = True
-    self.n_mels = 80
+    self.step_len = DEFAULT_FEATURE_OPTIONS["step_len"]
+    self.window_len = DEFAULT_FEATURE_OPTIONS["window_len"]
+    self.fmin_pyin = DEFAULT_FEATURE_OPTIONS["fmin_pyin"]
+    self.fmin_ex = DEFAULT_FEATURE_OPTIONS["fmin_ex"]
+    self.fmax_ex = DEFAULT_FEATURE_OPTIONS["fmax_ex"]
+    self.fmax_pyin = DEFAULT_FEATURE_OPTIONS["fmax_pyin"]
+    self.center = DEFAULT_FEATURE_OPTIONS["center"]
+    self.n_mels = DEFAULT_FEATURE_OPTIONS["n_mels"]
 
     self.out_maes = self.output_path("maes")
     self.out_corrs = self.output_path("corrs")
 
   def tasks(self):
-    # TODO: Caching and then with rqmt
-    yield Task("run", mini_task=True)
+    yield Task("run", rqmt=self.rqmt, mini_task=self.rqmt["cpu"] <= 1)
 
   def run(self):
     maes = []
@@ -200,63 +465,15 @@ class CompareEnergyValuesJob(Job):
     with open(self.segment_list.get_path(), "r") as f:
       segment_list = f.read().splitlines()
 
-    bliss_1 = corpus.Corpus()
-    bliss_1.load(self.ref_corpus.get_path())
-    bliss_2 = corpus.Corpus()
-    bliss_2.load(self.test_corpus.get_path())
-
-    recordings_1 = {}
-    for recording in bliss_1.all_recordings():
-      for segment in recording.segments:
-        if segment.fullname() in segment_list:
-          recordings_1[segment.fullname()] = recording.audio
-
-    recordings_2 = {}
-    for recording in bliss_2.all_recordings():
-      for segment in recording.segments:
-        if segment.fullname() in segment_list:
-          recordings_2[segment.fullname()] = recording.audio
-
-    for segment in segment_list:
-      signal_1, sr_1 = soundfile.read(recordings_1[segment])
-      signal_2, sr_2 = soundfile.read(recordings_2[segment])
-
-      assert sr_1 == sr_2, "Sample rates must match"
-      sample_rate = sr_1
-
-      mel_filterbank_1 = librosa.feature.melspectrogram(
-        y=signal_1, sr=sample_rate,
-        n_mels=self.n_mels,
-        hop_length=int(self.step_len * sample_rate),
-        n_fft=int(self.window_len * sample_rate),
-        fmin=self.fmin_ex, fmax=self.fmax_ex, center=self.center
-      )
-      mel_filterbank_2 = librosa.feature.melspectrogram(
-        y=signal_2, sr=sample_rate,
-        n_mels=self.n_mels,
-        hop_length=int(self.step_len * sample_rate),
-        n_fft=int(self.window_len * sample_rate),
-        fmin=self.fmin_ex, fmax=self.fmax_ex, center=self.center
-      )
-
-      D, wp = librosa.sequence.dtw(mel_filterbank_1, mel_filterbank_2)
-
-      energy_1 = librosa.feature.rms(
-        y=signal_1,
-        hop_length=int(self.step_len * sample_rate), frame_length=int(self.window_len * sample_rate))
-      energy_1 = numpy.squeeze(energy_1, axis=0)
-      energy_2 = librosa.feature.rms(
-        y=signal_2,
-        hop_length=int(self.step_len * sample_rate), frame_length=int(self.window_len * sample_rate))
-      energy_2 = numpy.squeeze(energy_2, axis=0)
-
-      energy_ls_1 = []
-      energy_ls_2 = []
-      for t_1, t_2 in wp:
-        energy_ls_1.append(energy_1[t_1])
-        energy_ls_2.append(energy_2[t_2])
+    for segment, features_1, features_2 in _iterate_feature_pairs(self, segment_list, ("mel", "energy")):
+      assert features_1["sample_rate"] == features_2["sample_rate"], "Sample rates must match"
+
+      # the energies were always compared on the DTW mapping
+      wp = _get_warping_path(features_1["mel"], features_2["mel"], dtw=True)
+      energy_ls_1 = features_1["energy"][wp[:, 0]]
+      energy_ls_2 = features_2["energy"][wp[:, 1]]
       corrs.append(numpy.corrcoef(energy_ls_1, energy_ls_2))
-      maes.append(numpy.mean(numpy.abs(numpy.array(energy_ls_1) - numpy.array(energy_ls_2))))
+      maes.append(numpy.mean(numpy.abs(energy_ls_1 - energy_ls_2)))
 
     with open(self.out_maes.get_path(), "w") as f:
       for mae in maes:
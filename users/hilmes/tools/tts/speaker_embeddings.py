@@ -8,6 +8,8 @@ import random
 from typing import Iterator, Optional, Dict
 
 from i6_core.lib.hdf import get_returnn_simple_hdf_writer
+from i6_experiments.users.rossenbach.lib.corpus_index import open_bliss_corpus_index
+from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader, SimpleHDFWriter
 from i6_core.lib import corpus
 import collections
 
@@ -27,7 +29,7 @@ class DistributeSpeakerEmbeddings(Job):
         """
 
         :param tk.Path speaker_embedding_hdf:
-        :param tk.Path bliss_corpus:
+        :param tk.Path bliss_corpus: corpus xml or index of :class:`BuildBlissCorpusIndexJob`
         :param tk.Path text_file: WARNING: no .gz support so far!
         :param options:
         :param use_full_seq_name:
@@ -70,100 +72,103 @@ class DistributeSpeakerEmbeddings(Job):
             if embedding_index >= len(self.speaker_embedding_features):
                 embedding_index = 0
 
+    def _segment_name(self, fullname):
+        """
+        :param str fullname: full segment name of a corpus
+        :return: seq tag in the speaker embedding hdf and the output
+        :rtype: str
+        """
+        if not self.use_full_seq_name:
+            return fullname.split("/")[-1]
+        return "/".join([self.c.name] + fullname.split("/")[-2:])
+
     def _random_matching_length(self):
+        """
+        Assigns to every segment of the corpus an embedding of a segment with a similar text length.
 
-        text_corpus = corpus.Corpus()
-        assert len(text_corpus.subcorpora) == 0
-        text_corpus.load(tk.uncached_path(self.options["corpus"]))
+        The embeddings are put in buckets by the text length of their segment in options["corpus"],
+        every segment gets the embeddings of the nearest non-empty bucket (the longer one for equal distance)
+        in round-robin order, the order within a bucket is shuffled with options["seed"].
+        """
+        text_corpus = open_bliss_corpus_index(tk.uncached_path(self.options["corpus"]))
+        assert len(numpy.unique(text_corpus.recording_idxs)) == len(text_corpus), "need one segment per recording"
 
         text_durations = {}
-
-        max_duration = 0
-        for recording in text_corpus.recordings:
-            assert len(recording.segments) == 1
-            segment = recording.segments[0]  # type:corpus.Segment
-            segment_name = "/".join([self.c.name, recording.name, segment.name])
-            if not self.use_full_seq_name:
-                segment_name = segment.name
-            seg_len = len(segment.orth)
-            text_durations[segment_name] = seg_len
-            if seg_len > max_duration:
-                max_duration = seg_len
+        for seg_idx in range(len(text_corpus)):
+            segment_name = self._segment_name(text_corpus.get_segment_name(seg_idx))
+            text_durations[segment_name] = len(text_corpus.get_orth(seg_idx))
 
         bucket_size = int(self.options["bucket_size"])
-        buckets = [[] for i in range(0, max_duration + bucket_size, bucket_size)]
-        bucket_indices = [0] * len(buckets)
-
-        # fill buckets
-        for tag, feature in zip(
-            self.speaker_embedding_tags, self.speaker_embedding_features
-        ):
-            buckets[text_durations[tag] // bucket_size].append(feature)
-
-        # shuffle buckets
-        for bucket in buckets:
-            random.shuffle(bucket)
-
-        for recording in self.c.recordings:
-            assert len(recording.segments) == 1
-            segment = recording.segments[0]  # type:corpus.Segment
-            segment_name = "/".join([self.c.name, recording.name, segment.name])
-            if not self.use_full_seq_name:
-                segment_name = segment.name
-
-            # search for nearest target bucket
-            target_bucket = len(segment.orth) // bucket_size
-            for i in range(1000):
-                if (
-                    0 <= target_bucket + i < len(buckets)
-                    and len(buckets[target_bucket + i]) > 0
-                ):
-                    target_bucket = target_bucket + i
-                    break
-                if (
-                    0 <= target_bucket - i < len(buckets)
-                    and len(buckets[target_bucket - i]) > 0
-                ):
-                    target_bucket = target_bucket - i
-                    break
+        rng = numpy.random.RandomState(self.options.get("seed"))
+
+        # sort the embeddings by bucket, shuffled within each bucket
+        embedding_buckets = numpy.array(
+            [
+                text_durations[tag if isinstance(tag, str) else tag.decode()] // bucket_size
+                for tag in self.speaker_embedding_tags
+            ],
+            dtype=numpy.int64,
+        )
+        permutation = rng.permutation(len(embedding_buckets))
+        embedding_order = permutation[numpy.argsort(embedding_buckets[permutation], kind="stable")]
+        buckets, bucket_starts, bucket_counts = numpy.unique(
+            embedding_buckets[embedding_order], return_index=True, return_counts=True
+        )
 
-            speaker_embedding = buckets[target_bucket][bucket_indices[target_bucket]]
+        assert len(numpy.unique(self.c.recording_idxs)) == len(self.c), "need one segment per recording"
+        segment_names = [self._segment_name(segment_name) for segment_name in self.c.segment_names()]
+        target_buckets = numpy.array(
+            [len(self.c.get_orth(seg_idx)) // bucket_size for seg_idx in range(len(self.c))], dtype=numpy.int64
+        )
+
+        # search for nearest non-empty bucket
+        upper = numpy.minimum(numpy.searchsorted(buckets, target_buckets), len(buckets) - 1)
+        lower = numpy.maximum(upper - 1, 0)
+        use_upper = numpy.abs(buckets[upper] - target_buckets) <= numpy.abs(target_buckets - buckets[lower])
+        chosen = numpy.where(use_upper, upper, lower)
+
+        # round-robin within each bucket, in the order of the segments
+        segments_by_bucket = numpy.argsort(chosen, kind="stable")
+        sorted_chosen = chosen[segments_by_bucket]
+        rank = numpy.empty_like(chosen)
+        rank[segments_by_bucket] = numpy.arange(len(chosen)) - numpy.searchsorted(sorted_chosen, sorted_chosen)
+        embedding_indices = embedding_order[bucket_starts[chosen] + rank % bucket_counts[chosen]]
+
+        batch_size = 10000
+        for start in range(0, len(segment_names), batch_size):
+            batch_indices = embedding_indices[start : start + batch_size]
             self.hdf_writer.insert_batch(
-                numpy.asarray([speaker_embedding]), [1], [segment_name]
+                numpy.stack([self.speaker_embedding_features[i] for i in batch_indices]),
+                [1] * len(batch_indices),
+                segment_names[start : start + batch_size],
             )
-            bucket_indices[target_bucket] += 1
-            if bucket_indices[target_bucket] >= len(buckets[target_bucket]):
-                bucket_indices[target_bucket] = 0
 
     def run(self):
 
         speaker_embedding_data = h5py.File(
             tk.uncached_path(self.speaker_embedding_hdf), "r"
         )
-        speaker_embedding_inputs = speaker_embedding_data["inputs"]
-        speaker_embedding_raw_tags = speaker_embedding_data["seqTags"]
-        speaker_embedding_lengths = speaker_embedding_data["seqLengths"]
+        # read all embeddings at once instead of one read per sequence
+        speaker_embedding_inputs = speaker_embedding_data["inputs"][...]
+        speaker_embedding_lengths = speaker_embedding_data["seqLengths"][:, 0]
 
-        self.speaker_embedding_features = []
-        self.speaker_embedding_tags = []
-        offset = 0
-        for tag, length in zip(speaker_embedding_raw_tags, speaker_embedding_lengths):
-            self.speaker_embedding_features.append(
-                speaker_embedding_inputs[offset : offset + length[0]]
-            )
-            self.speaker_embedding_tags.append(tag)
-            offset += length[0]
-
-        self.hdf_writer = get_returnn_simple_hdf_writer(returnn_root=None)(
-            tk.uncached_path(self.out), dim=self.speaker_embedding_features[0].shape[-1]
+        self.speaker_embedding_features = numpy.split(
+            speaker_embedding_inputs, numpy.cumsum(speaker_embedding_lengths)[:-1]
+        )
+        self.speaker_embedding_tags = list(speaker_embedding_data["seqTags"][...])
+
+        # one insert_batch call per sequence, so buffer them
+        self.hdf_writer = SimpleHDFWriter(
+            tk.uncached_path(self.out),
+            dim=self.speaker_embedding_features[0].shape[-1],
+            buffer_size=1000,
+            preallocate=True,
         )
 
         seq_tags = []
         if self.bliss_corpus:
-            self.c = corpus.Corpus()
-            self.c.load(tk.uncached_path(self.bliss_corpus))
-            for segment in self.c.segments():
-                seq_tags.append(segment.fullname())
+            self.c = open_bliss_corpus_index(tk.uncached_path(self.bliss_corpus))
+            seq_tags = list(self.c.segment_names())
         elif self.text_file:
             pipe = subprocess.Popen(
                 ["zcat", "-f", self.text_file.get_path()], stdout=subprocess.PIPE
@@ -457,17 +462,33 @@ class DistributeHDFByMappingJob(Job):
 
 
 class AverageF0OverDurationJob(Job):
+    """
+    Averages the F0 values over the given durations, per phoneme or as F0 contour with the averaged values.
+    The F0 HDF can also be the output of :class:`ExtractScoringFeaturesJob`, with f0_data_key="f0".
+    """
+
+    __sis_hash_exclude__ = {"f0_data_key": "inputs"}
+
     def __init__(
         self,
         f0_hdf: tk.Path,
         duration_hdf: tk.Path,
         center: bool = True,
         phoneme_level: bool = True,
+        f0_data_key: str = "inputs",
     ):
+        """
+        :param f0_hdf:
+        :param duration_hdf:
+        :param center:
+        :param phoneme_level:
+        :param f0_data_key: data key of the F0 values in f0_hdf
+        """
         self.f0 = f0_hdf
         self.duration = duration_hdf
         self.center = center
         self.phoneme_level = phoneme_level
+        self.f0_data_key = f0_data_key
 
         self.out_hdf = self.output_path("out.hdf")
         self.out_std = self.output_var("out_std")
@@ -478,34 +499,14 @@ class AverageF0OverDurationJob(Job):
 
     def run(self):
 
-        f0_data = h5py.File(self.f0.get_path(), "r")
-        f0_inputs = f0_data["inputs"]
-        f0_raw_tags = f0_data["seqTags"]
-        f0_lengths = f0_data["seqLengths"]
-        f0_tag_to_value = {}
-        f0_tag_to_len = {}
-        offset = 0
-        for tag, length in zip(f0_raw_tags, f0_lengths):
-            f0_tag_to_value[tag.decode()] = f0_inputs[offset : offset + length[0]]
-            f0_tag_to_len[tag.decode()] = length[0]
-            offset += length[0]
-
-        duration_data = h5py.File(self.duration.get_path(), "r")
-        dur_inputs = duration_data["inputs"]
-        dur_raw_tags = duration_data["seqTags"]
-        dur_lengths = duration_data["seqLengths"]
-
-        dur_tag_to_value = {}
-        offset = 0
-        for tag, length in zip(dur_raw_tags, dur_lengths):
-            dur_tag_to_value[tag] = dur_inputs[offset : offset + length[0]]
-            offset += length[0]
+        f0_tag_to_value = SimpleHDFReader(self.f0.get_path(), data_key=self.f0_data_key)
+        dur_tag_to_value = SimpleHDFReader(self.duration.get_path())
 
         avrg_dur_tag_to_value = {}
         if self.phoneme_level:
-            for tag, durations in dur_tag_to_value.items():
+            for durations, tag in dur_tag_to_value.iterate():
                 offset = 0 if self.center else 2
-                seq = f0_tag_to_value[tag]
+                seq = numpy.reshape(f0_tag_to_value[tag], (-1, 1))
                 phon_seq = []
                 for dur in durations:
                     if (
@@ -533,10 +534,10 @@ class AverageF0OverDurationJob(Job):
                 )
                 avrg_dur_tag_to_value[tag] = numpy.array(phon_seq)
         else:
-            for tag, durations in dur_tag_to_value.items():
+            for durations, tag in dur_tag_to_value.iterate():
                 offset = 0 if self.center else 2
                 cutoff = offset
-                seq = f0_tag_to_value[tag]
+                seq = numpy.reshape(f0_tag_to_value[tag], (-1, 1))
                 for dur in durations:
                     if (
                         dur > 0
@@ -560,6 +561,8 @@ class AverageF0OverDurationJob(Job):
         assert len(avrg_dur_tag_to_value) == len(
             f0_tag_to_value
         ), "Duration HDF does not include all F0 seqs"
+        f0_tag_to_value.close()
+        dur_tag_to_value.close()
 
         hdf_writer = get_returnn_simple_hdf_writer(returnn_root=None)(self.out_hdf.get_path(), dim=1, ndim=2)
         values = numpy.concatenate(list(avrg_dur_tag_to_value.values()))
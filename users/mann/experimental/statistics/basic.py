@@ -2,6 +2,7 @@ __all__ = [
     "AllophoneCounts",
     "PhonemeCounts",
     "SilenceAtSegmentBoundaries",
+    "SilenceStatisticsJob",
     "AlignmentStatisticsJob",
     "ApplyStateTyingToPhonemeStats",
     "ApplyStateTyingToAllophoneStats"
@@ -12,6 +13,7 @@ Path = setup_path(__package__)
 
 import sys, os
 import subprocess
+import numpy as np
 import matplotlib.pyplot as plt
 from itertools import filterfalse
 # from tabulate import tabulate
@@ -129,6 +131,21 @@ class ContextualSilenceCounter:
             if self.word_end_count > 0:
                 self.word_end_count -= 1
 
+class AllophoneMasks:
+    """Allophone properties used by the silence statistics, indexed by allophone id."""
+    def __init__(self, allophones):
+        self.is_silence = np.array(
+            [ContextualSilenceCounter.is_silence(a) for a in allophones], dtype=bool)
+        self.is_speech_end = np.array(
+            [ContextualSilenceCounter.is_speech_end(a) for a in allophones], dtype=bool)
+        self.is_lemma_start = np.array(
+            [ContextualSilenceCounter.is_lemma_start(a) for a in allophones], dtype=bool)
+
+def silence_runs(is_silence):
+    """Lengths of all runs of consecutive silence frames, same as SilenceCounter.counts."""
+    edges = np.diff(np.concatenate([[0], is_silence.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
 def resolve_bundle(alignment):
     if not isinstance(alignment, (str, tk.Path)):
         return alignment
@@ -137,13 +154,22 @@ def resolve_bundle(alignment):
     return alignment
 
 class AlignmentStatisticsJob(Job):
+    """
+    Collects statistics over the alignment of every segment.
+
+    The alignment caches are read in-process with :class:`FileArchive`, allophone properties are looked up
+    per allophone id and counted with numpy. Set use_archiver to fall back to one `archiver` call per segment.
+    """
+
+    __sis_hash_exclude__ = {"use_archiver": False}
 
-    def __init__(self, alignment, allophones, segments, concurrent, archiver_exe=None):
+    def __init__(self, alignment, allophones, segments, concurrent, archiver_exe=None, use_archiver=False):
         # self.csp = csp
         self.alignment = alignment
         self.allophones = allophones
         self.segments = segments
         self.concurrent = concurrent
+        self.use_archiver = use_archiver
 
         self.exe = RasrCommand.select_exe(archiver_exe, "archiver")
         self.single_counts = {i: self.output_var("single_counts.{}".format(i)) for i in range(1, self.concurrent + 1)}
@@ -169,158 +195,168 @@ class AlignmentStatisticsJob(Job):
                             stdout=subprocess.PIPE)
         lines = res.stdout.decode('utf-8').split('\n')
         return lines
-    
 
-    def run(self, task_id):
+    def segment_alignments(self, task_id):
+        """
+        Yields the allophone ids of every frame of every segment of the task
+        together with the AllophoneMasks they index into.
+        """
         alignment_path = tk.uncached_path(resolve_bundle(self.alignment)[task_id])
         segment_path = tk.uncached_path(self.segments[task_id])
 
-        silence_counts = []
-        state_count = 0
+        if not self.use_archiver:
+            archive = sc.FileArchive(alignment_path)
+            archive.setAllophones(tk.uncached_path(self.allophones))
+            masks = AllophoneMasks(archive.allophones)
 
         with open(segment_path, "r") as segment_file:
             for seg in segment_file:
-                lines = self.archive(alignment_path, seg.rstrip("\n"))
-
-                sil_counter = SilenceCounter()
-                for allo, state in allophone_and_state_generator(lines):
-                    sil_counter.feed(allo)
-                    state_count += 1
+                seg = seg.rstrip("\n")
+                if self.use_archiver:
+                    lines = self.archive(alignment_path, seg)
+                    allophones = np.array([allo for allo, _ in allophone_and_state_generator(lines)], dtype=str)
+                    unique, ids = np.unique(allophones, return_inverse=True)
+                    yield ids.reshape(-1), AllophoneMasks(unique)
+                else:
+                    alignment = archive.read(seg, "align")
+                    yield np.array([t[1] for t in alignment], dtype=np.int64), masks
 
-                silence_counts.append(sil_counter.counts)
-        
-        res = dict(
-            prepended_silence = sum(c[0] for c in silence_counts if len(c) > 0),
-            appended_silence = sum(c[-1] for c in silence_counts if len(c) > 0),
-            total_silence = sum(sum(c) for c in silence_counts),
-            total_states = state_count
+    @classmethod
+    def count_segment(cls, ids, masks):
+        runs = silence_runs(masks.is_silence[ids])
+        return dict(
+            prepended_silence = int(runs[0]) if len(runs) > 0 else 0,
+            appended_silence = int(runs[-1]) if len(runs) > 0 else 0,
+            total_silence = int(runs.sum()),
+            total_states = len(ids)
         )
-        self.single_counts[task_id].set(res)
-    
-    def gather(self):
-        res = defaultdict(int)
-        for i in range(1, self.concurrent + 1):
-            cs = self.single_counts[i].get()
-            for key, value in cs.items():
-                res[key] += value
-        self.counts.set(dict(res))
 
-
-class SilenceAtSegmentBoundaries(AlignmentStatisticsJob):
+    @classmethod
+    def normalize(cls, counter):
+        return dict(counter)
 
     def run(self, task_id):
-        alignment_path = tk.uncached_path(resolve_bundle(self.alignment)[task_id])
-        segment_path = tk.uncached_path(self.segments[task_id])
+        counts = defaultdict(int)
+        for ids, masks in self.segment_alignments(task_id):
+            for key, value in self.count_segment(ids, masks).items():
+                counts[key] += value
+        self.single_counts[task_id].set(dict(counts))
 
-        silence_counts = defaultdict(int)
-
-        with open(segment_path, "r") as segment_file:
-            for seg in segment_file:
-                lines = self.archive(alignment_path, seg.rstrip("\n"))
-
-                allo_gen = StateParser(lines)
-                
-                first_allo, _ = next(allo_gen)
-                if "#" in first_allo:
-                    silence_counts["start"] += 1
-                
-                last_allo, _ = next(reversed(allo_gen))
-                if "#" in last_allo:
-                    silence_counts["end"] += 1
-
-                silence_counts["total"] += 1
-        
-        self.single_counts[task_id].set(dict(silence_counts))
-    
-    def gather(self):
+    def sum_single_counts(self):
         counter = defaultdict(int)
         for i in range(1, self.concurrent + 1):
             cs = self.single_counts[i].get()
             for key, value in cs.items():
                 counter[key] += value
-        # normalize
-        res = {
+        return counter
+
+    def gather(self):
+        self.counts.set(self.normalize(self.sum_single_counts()))
+
+
+class SilenceAtSegmentBoundaries(AlignmentStatisticsJob):
+
+    @classmethod
+    def count_segment(cls, ids, masks):
+        is_silence = masks.is_silence[ids]
+        return dict(
+            start = int(len(ids) > 0 and is_silence[0]),
+            end = int(len(ids) > 0 and is_silence[-1]),
+            total = 1
+        )
+
+    @classmethod
+    def normalize(cls, counter):
+        return {
             "start": counter["start"] / counter["total"],
             "end"  : counter["end"]   / counter["total"],
             "total": counter["total"]
         } 
-        self.counts.set(res)
 
 
 class PositionalSilenceCounter(AlignmentStatisticsJob):
 
-    def run(self, task_id):
-        alignment_path = tk.uncached_path(resolve_bundle(self.alignment)[task_id])
-        segment_path = tk.uncached_path(self.segments[task_id])
-
-        silence_counts = []
-
-        with open(segment_path, "r") as segment_file:
-            for seg in segment_file:
-                lines = self.archive(alignment_path, seg.rstrip("\n"))
-
-                sil_counter = SilenceCounter()
-                for allo, state in allophone_and_state_generator(lines):
-                    sil_counter.feed(allo)
-
-                silence_counts.append(sil_counter.counts)
-        
-        res = dict(
-            start_loops = sum(c[0] - 1 for c in silence_counts),
-            end_loops   = sum(c[-1] - 1 for c in silence_counts),
-            inner_loops = sum(sum(c[1:-1]) - len(c) + 2 for c in silence_counts),
-            inner_count = sum(len(c) - 2 for c in silence_counts),
-            seg_count   = len(silence_counts)
+    @classmethod
+    def count_segment(cls, ids, masks):
+        runs = silence_runs(masks.is_silence[ids])
+        return dict(
+            start_loops = int(runs[0]) - 1,
+            end_loops   = int(runs[-1]) - 1,
+            inner_loops = int(runs[1:-1].sum()) - len(runs) + 2,
+            inner_count = len(runs) - 2,
+            seg_count   = 1
         )
-        self.single_counts[task_id].set(res)
-    
-    def gather(self):
-        counter = defaultdict(int)
-        for i in range(1, self.concurrent + 1):
-            cs = self.single_counts[i].get()
-            for key, value in cs.items():
-                counter[key] += value
-        # normalize
-        res = {
+
+    @classmethod
+    def normalize(cls, counter):
+        return {
             "start_loops": counter["start_loops"] / counter["seg_count"],
             "end_loops"  : counter["end_loops"]   / counter["seg_count"],
             "inner_loops": counter["inner_loops"] / counter["inner_count"]
         } 
-        self.counts.set(res)
 
 
 class SilenceBetweenWords(AlignmentStatisticsJob):
 
-    def run(self, task_id):
-        alignment_path = tk.uncached_path(resolve_bundle(self.alignment)[task_id])
-        segment_path = tk.uncached_path(self.segments[task_id])
+    @classmethod
+    def count_segment(cls, ids, masks):
+        # same as feeding all frames to a ContextualSilenceCounter
+        after_speech_end = masks.is_speech_end[ids[:-1]]
+        silence_insertions = int(np.count_nonzero(after_speech_end & masks.is_silence[ids[1:]]))
+        word_transitions = int(np.count_nonzero(after_speech_end & masks.is_lemma_start[ids[1:]]))
+        if len(ids) > 0 and masks.is_silence[ids[-1]]:
+            silence_insertions = max(silence_insertions - 1, 0)
+            word_transitions = max(word_transitions - 1, 0)
+        return dict(
+            silence_insertions = silence_insertions,
+            word_transitions = word_transitions
+        )
 
-        silence_counts = defaultdict(int)
+    @classmethod
+    def normalize(cls, counter):
+        return counter["silence_insertions"] / counter["word_transitions"]
 
-        with open(segment_path, "r") as segment_file:
-            for seg in segment_file:
-                lines = self.archive(alignment_path, seg.rstrip("\n"))
 
-                sil_counter = ContextualSilenceCounter()
-                for allo, state in allophone_and_state_generator(lines):
-                    sil_counter.feed(allo)
-                sil_counter.maybe_remove_last()
+class SilenceStatisticsJob(AlignmentStatisticsJob):
+    """
+    Computes the statistics of several AlignmentStatisticsJob variants in a single pass over the alignment.
+    The result of each variant is written to out_statistics[name], counts holds all of them.
+    """
+
+    statistics = {
+        "silence": AlignmentStatisticsJob,
+        "boundaries": SilenceAtSegmentBoundaries,
+        "positional": PositionalSilenceCounter,
+        "between_words": SilenceBetweenWords,
+    }
+
+    def __init__(self, alignment, allophones, segments, concurrent, archiver_exe=None, use_archiver=False,
+                 statistics=None):
+        """
+        :param list[str]|None statistics: keys of SilenceStatisticsJob.statistics to compute, all if None
+        """
+        super().__init__(alignment, allophones, segments, concurrent, archiver_exe, use_archiver)
+        self.statistics_keys = statistics or list(self.statistics)
+        assert all(key in self.statistics for key in self.statistics_keys), self.statistics_keys
+
+        self.out_statistics = {key: self.output_var("counts.{}".format(key)) for key in self.statistics_keys}
+
+    def count_segment(self, ids, masks):
+        return {
+            "{}/{}".format(key, name): value
+            for key in self.statistics_keys
+            for name, value in self.statistics[key].count_segment(ids, masks).items()
+        }
 
-                silence_counts["silence_insertions"] += sil_counter.sil_count
-                silence_counts["word_transitions"]   += sil_counter.word_end_count
-        
-        self.single_counts[task_id].set(
-            dict(silence_counts)
-        )
-    
     def gather(self):
-        counter = defaultdict(int)
-        for i in range(1, self.concurrent + 1):
-            cs = self.single_counts[i].get()
-            for key, value in cs.items():
-                counter[key] += value
-        # normalize
-        self.counts.set(counter["silence_insertions"] / counter["word_transitions"])
+        counter = self.sum_single_counts()
+        res = {}
+        for key in self.statistics_keys:
+            prefix = key + "/"
+            sub_counter = defaultdict(int, {k[len(prefix):]: v for k, v in counter.items() if k.startswith(prefix)})
+            res[key] = self.statistics[key].normalize(sub_counter)
+            self.out_statistics[key].set(res[key])
+        self.counts.set(res)
 
 class AllophoneSequencer:
     def __init__(self, corpus, lexicon, state_tying, hmm_partition):
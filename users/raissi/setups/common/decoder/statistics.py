@@ -7,18 +7,82 @@ import xml.etree.ElementTree as ET
 
 from sisyphus import tk, Job, Task
 
+from i6_experiments.common.utils.rasr_search_log import parse_search_logs
+
 
 Path = tk.setup_path(__package__)
 
 
+def _segment_statistics(seg: ET.Element, partial: dict):
+    """
+    Adds the statistics of one segment of the search log to the partial aggregate.
+    """
+    for layer in seg.findall('./layer[@name="recognizer"]'):
+        frames = int(layer.findall('./statistics/frames[@port="features"]')[0].attrib["number"])
+        partial["total_frames"] += frames
+        partial["total_word_ends"] += frames * float(
+            layer.findall('./search-space-statistics/statistic[@name="ending words after pruning"]/avg')[0].text
+        )
+        partial["total_trees"] += frames * float(
+            layer.findall('./search-space-statistics/statistic[@name="trees after  pruning"]/avg')[0].text
+        )
+        partial["total_states"] += frames * float(
+            layer.findall('./search-space-statistics/statistic[@name="states after pruning"]/avg')[0].text
+        )
+
+        partial["recognizer_time"] += float(layer.findall("./flf-recognizer-time")[0].text)
+
+    for rescore in seg.findall("./flf-push-forward-rescoring-time"):
+        partial["rescoring_time"] += float(rescore.text)
+
+    seg_stats = {}
+    full_name = seg.attrib["full-name"]
+    for sss in seg.findall('./layer[@name="recognizer"]/search-space-statistics/statistic[@type="scalar"]'):
+        min_val = float(sss.findtext("./min", default="0"))
+        avg_val = float(sss.findtext("./avg", default="0"))
+        max_val = float(sss.findtext("./max", default="0"))
+        seg_stats[sss.attrib["name"]] = (min_val, avg_val, max_val)
+    partial["seq_ss_statistics"][full_name] = seg_stats
+
+    features = seg.find('./layer[@name="recognizer"]/statistics/frames[@port="features"]')
+    seg_stats["frames"] = int(features.attrib["number"])
+
+    tf_fwd = seg.find(
+        './layer[@name="recognizer"]/information[@component="flf-lattice-tool.network.recognizer.feature-extraction.tf-fwd"]'
+    )
+    if tf_fwd is not None:
+        seg_stats["tf_fwd"] = float(tf_fwd.text.strip().split()[-1])
+    else:
+        seg_stats["tf_fwd"] = 0.0
+
+    partial["eval_statistics"][full_name] = {}
+    for evaluation in seg.findall(".//evaluation"):
+        stat_name = evaluation.attrib["name"]
+        alignment = evaluation.find('statistic[@type="alignment"]')
+        partial["eval_statistics"][full_name][stat_name] = {
+            "errors": int(alignment.findtext("edit-operations")),
+            "ref-tokens": int(alignment.findtext('count[@event="token"][@source="reference"]')),
+            "score": float(alignment.findtext('score[@source="best"]')),
+        }
+
+
 class ExtractSearchStatisticsJob(Job):
+    """
+    The search logs are parsed in a streaming way, with up to num_processes logs in parallel,
+    see :func:`i6_experiments.common.utils.rasr_search_log.parse_search_log`.
+    """
+
+    __sis_hash_exclude__ = {"num_processes": 1}
+
     def __init__(
         self,
         search_logs: typing.List[typing.Union[str, tk.Path]],
         corpus_duration_hours: float,
+        num_processes: int = 1,
     ):
         self.corpus_duration = corpus_duration_hours
         self.search_logs = search_logs
+        self.num_processes = num_processes
 
         self.elapsed_time = self.output_var("elapsed_time")
         self.user_time = self.output_var("user_time")
@@ -41,90 +105,41 @@ class ExtractSearchStatisticsJob(Job):
         self.eval_statistics = self.output_var("eval_statistics")
         self.overall_rtf = self.output_var("overall_rtf")
 
-        self.rqmt = {"cpu": 1, "mem": 2.0, "time": 0.5}
+        self.rqmt = {"cpu": num_processes, "mem": 2.0, "time": 0.5}
 
     def tasks(self):
         yield Task("run", resume="run", rqmt=self.rqmt)
 
     def run(self):
-        queue_stats = collections.defaultdict(list)
-
-        total_elapsed = 0.0
-        total_user = 0.0
-        total_system = 0.0
-        total_frames = 0
-        total_word_ends = 0.0
-        total_trees = 0.0
-        total_states = 0.0
-        recognizer_time = 0.0
-        rescoring_time = 0.0
-        lm_time = 0.0
+        stats = parse_search_logs(
+            [tk.uncached_path(path) for path in self.search_logs],
+            segment_statistics=_segment_statistics,
+            initial_statistics={
+                "total_frames": 0,
+                "total_word_ends": 0.0,
+                "total_trees": 0.0,
+                "total_states": 0.0,
+                "recognizer_time": 0.0,
+                "rescoring_time": 0.0,
+                "seq_ss_statistics": {},
+                "eval_statistics": {},
+            },
+            num_processes=self.num_processes,
+        )
+
+        total_elapsed = stats["total_elapsed"]
+        total_user = stats["total_user"]
+        total_system = stats["total_system"]
+        total_frames = stats["total_frames"]
+        total_word_ends = stats["total_word_ends"]
+        total_trees = stats["total_trees"]
+        total_states = stats["total_states"]
+        recognizer_time = stats["recognizer_time"]
+        rescoring_time = stats["rescoring_time"]
+        lm_time = stats["lm_time"]
         ss_statistics = collections.defaultdict(lambda: (0.0, 0))
-        seq_ss_statistics = {}
-        eval_statistics = {}
-
-        for path in self.search_logs:
-            with gzip.open(tk.uncached_path(path), "rt") as f:
-                root = ET.fromstring(f.read())
-            host = root.findall("./system-information/name")[0].text
-            elapsed = float(root.findall("./timer/elapsed")[0].text)
-            user = float(root.findall("./timer/user")[0].text)
-            system = float(root.findall("./timer/system")[0].text)
-            total_elapsed += elapsed
-            total_user += user
-            total_system += system
-
-            for layer in root.findall('.//segment/layer[@name="recognizer"]'):
-                frames = int(layer.findall('./statistics/frames[@port="features"]')[0].attrib["number"])
-                total_frames += frames
-                total_word_ends += frames * float(
-                    layer.findall('./search-space-statistics/statistic[@name="ending words after pruning"]/avg')[0].text
-                )
-                total_trees += frames * float(
-                    layer.findall('./search-space-statistics/statistic[@name="trees after  pruning"]/avg')[0].text
-                )
-                total_states += frames * float(
-                    layer.findall('./search-space-statistics/statistic[@name="states after pruning"]/avg')[0].text
-                )
-
-                recognizer_time += float(layer.findall("./flf-recognizer-time")[0].text)
-
-            for rescore in root.findall(".//segment/flf-push-forward-rescoring-time"):
-                rescoring_time += float(rescore.text)
-
-            for lm_total in root.findall(".//fwd-summary/total-run-time"):
-                lm_time += float(lm_total.text)
-
-            for seg in root.findall(".//segment"):
-                seg_stats = {}
-                full_name = seg.attrib["full-name"]
-                for sss in seg.findall('./layer[@name="recognizer"]/search-space-statistics/statistic[@type="scalar"]'):
-                    min_val = float(sss.findtext("./min", default="0"))
-                    avg_val = float(sss.findtext("./avg", default="0"))
-                    max_val = float(sss.findtext("./max", default="0"))
-                    seg_stats[sss.attrib["name"]] = (min_val, avg_val, max_val)
-                seq_ss_statistics[full_name] = seg_stats
-
-                features = seg.find('./layer[@name="recognizer"]/statistics/frames[@port="features"]')
-                seq_ss_statistics[full_name]["frames"] = int(features.attrib["number"])
-
-                tf_fwd = seg.find(
-                    './layer[@name="recognizer"]/information[@component="flf-lattice-tool.network.recognizer.feature-extraction.tf-fwd"]'
-                )
-                if tf_fwd is not None:
-                    seq_ss_statistics[full_name]["tf_fwd"] = float(tf_fwd.text.strip().split()[-1])
-                else:
-                    seq_ss_statistics[full_name]["tf_fwd"] = 0.0
-
-                eval_statistics[full_name] = {}
-                for evaluation in seg.findall(".//evaluation"):
-                    stat_name = evaluation.attrib["name"]
-                    alignment = evaluation.find('statistic[@type="alignment"]')
-                    eval_statistics[full_name][stat_name] = {
-                        "errors": int(alignment.findtext("edit-operations")),
-                        "ref-tokens": int(alignment.findtext('count[@event="token"][@source="reference"]')),
-                        "score": float(alignment.findtext('score[@source="best"]')),
-                    }
+        seq_ss_statistics = stats["seq_ss_statistics"]
+        eval_statistics = stats["eval_statistics"]
 
         for s in seq_ss_statistics.values():
             frames = s["frames"]
@@ -56,6 +56,15 @@ def get_batch_from_segments(segments, batchSize=10000):
 # Triphone
 ###################################
 class EstimateSprintTriphoneForwardPriorsJob(Job):
+    """
+    With label_batch_size=None, the posteriors are computed with one graph invocation per dense label.
+    Otherwise, up to label_batch_size dense labels are evaluated in one invocation, by tiling the encoder output
+    along the batch axis. This needs label_batch_size times the memory for the encoder output,
+    i.e. choose it according to n_batch and the mem rqmt.
+    """
+
+    __sis_hash_exclude__ = {"label_batch_size": None}
+
     def __init__(
         self,
         graph_path,
@@ -73,6 +82,7 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
         gpu=1,
         mem=2,
         time=1,
+        label_batch_size=None,
     ):
         self.graph_path = graph_path
         self.model_path = model_path
@@ -80,8 +90,6 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
         self.data_indices = data_indices
         self.segment_slice = (start_ind_segment, end_ind_segment)
         self.tf_lib = library_path
-        self.triphone_means, self.diphone_means = initialize_dicts_with_zeros(n_contexts, n_state_classes)
-        self.context_means = np.zeros(n_contexts)
         self.numSegments = [
             self.output_path("segmentLength.%d.%d-%d" % (index, start_ind_segment, end_ind_segment), cached=False)
             for index in self.data_indices
@@ -101,6 +109,7 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
         self.n_contexts = n_contexts
         self.n_state_classes = n_state_classes
         self.n_batch = n_batch
+        self.label_batch_size = label_batch_size
         self.tensor_map = tensor_map
         self.rqmt = {"cpu": cpu, "gpu": gpu, "mem": mem, "time": float(time)}
 
@@ -111,13 +120,27 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
     def get_dense_label(self, pastLabel, centerState, futureLabel=0):
         return (((centerState * self.n_contexts) + pastLabel) * self.n_contexts) + futureLabel
 
-    def getSegmentFeaturesFromHdf(self, dataIndex):
-        hf = h5py.File(self.data_paths[dataIndex].get_path())
-        segmentNames = list(hf["streams"]["features"]["data"])
-        segments = []
-        for name in segmentNames:
-            segments.append(hf["streams"]["features"]["data"][name])
-        return np.vstack(segments[self.segment_slice[0] : self.segment_slice[1]])
+    def getFeatureBatchesFromHdf(self, dataIndex):
+        """
+        Yields the concatenated features of the segment slice in batches of n_batch frames.
+        The segments are read one by one, so at most one batch is kept in memory.
+        """
+        with h5py.File(self.data_paths[dataIndex].get_path(), "r") as hf:
+            data = hf["streams"]["features"]["data"]
+            segmentNames = list(data)[self.segment_slice[0] : self.segment_slice[1]]
+            buffer, bufferLen = [], 0
+            for name in segmentNames:
+                features = data[name][()]
+                while len(features) > 0:
+                    take = min(self.n_batch - bufferLen, len(features))
+                    buffer.append(features[:take])
+                    bufferLen += take
+                    features = features[take:]
+                    if bufferLen == self.n_batch:
+                        yield np.concatenate(buffer)
+                        buffer, bufferLen = [], 0
+            if bufferLen:
+                yield np.concatenate(buffer)
 
     def getEncoderOutput(self, session, featureVector):
         return session.run(
@@ -142,45 +165,105 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
             },
         )
 
+    def getPosteriorsOfOutputsWithEncoderOutputBatched(self, session, featureVector, classLabels, outputs):
+        """
+        Like getPosteriorsOfOutputsWithEncoderOutput, but for multiple dense labels in one graph invocation.
+
+        :param featureVector: encoder output of shape (1, T, F)
+        :param classLabels: L dense labels
+        :param outputs: tensor names to fetch
+        :return: per output an array of shape (L, T, dim)
+        """
+        nLabels = len(classLabels)
+        nFrames = featureVector.shape[1]
+        if "fwd" in self.tensor_map.in_encoder_output:
+            feature_in = np.broadcast_to(
+                featureVector.reshape(nFrames, 1, -1), (nFrames, nLabels, featureVector.shape[2])
+            )
+        else:
+            feature_in = np.broadcast_to(featureVector, (nLabels,) + featureVector.shape[1:])
+        labels_in = np.broadcast_to(np.asarray(classLabels)[:, None], (nLabels, nFrames))
+        return session.run(
+            outputs,
+            feed_dict={
+                self.tensor_map.in_encoder_output: feature_in,
+                self.tensor_map.in_seq_length: labels_in,
+            },
+        )
+
+    def accumulatePosteriors(self, session, encoderOutput, triphoneSums, diphoneSums, contextSums):
+        for pastContextId in range(self.n_contexts):
+            for currentState in range(self.n_state_classes):
+                denselabel = self.get_dense_label(pastLabel=pastContextId, centerState=currentState)
+                p = self.getPosteriorsOfOutputsWithEncoderOutput(session, encoderOutput, denselabel)
+                # triphone is calculates for each center and left context
+                triphoneSums[pastContextId, currentState] += np.sum(p[0][0], axis=0)
+                # diphone is calculated for each context with centerstate 0
+                if not currentState:
+                    diphoneSums[pastContextId] += np.sum(p[1][0], axis=0)
+                    # context is not label dependent
+                    if not pastContextId:
+                        contextSums += np.sum(p[2][0], axis=0)
+
+    def accumulatePosteriorsBatched(self, session, encoderOutput, triphoneSums, diphoneSums, contextSums):
+        tm = self.tensor_map
+        # diphone and context only need the labels with centerstate 0
+        for start in range(0, self.n_contexts, self.label_batch_size):
+            pastContextIds = np.arange(start, min(start + self.label_batch_size, self.n_contexts))
+            labels = [self.get_dense_label(pastLabel=c, centerState=0) for c in pastContextIds]
+            outputs = [tm.out_left_context, tm.out_center_state] + ([tm.out_right_context] if start == 0 else [])
+            p = self.getPosteriorsOfOutputsWithEncoderOutputBatched(session, encoderOutput, labels, outputs)
+            triphoneSums[pastContextIds, 0] += np.sum(p[0], axis=1)
+            diphoneSums[pastContextIds] += np.sum(p[1], axis=1)
+            if start == 0:
+                # context is not label dependent
+                contextSums += np.sum(p[2][0], axis=0)
+        # triphone for all remaining center states
+        pastContextIds, currentStates = np.meshgrid(
+            np.arange(self.n_contexts), np.arange(1, self.n_state_classes), indexing="ij"
+        )
+        pastContextIds, currentStates = pastContextIds.flatten(), currentStates.flatten()
+        for start in range(0, len(pastContextIds), self.label_batch_size):
+            past = pastContextIds[start : start + self.label_batch_size]
+            center = currentStates[start : start + self.label_batch_size]
+            labels = self.get_dense_label(pastLabel=past, centerState=center)
+            p = self.getPosteriorsOfOutputsWithEncoderOutputBatched(
+                session, encoderOutput, labels, [tm.out_left_context]
+            )
+            triphoneSums[past, center] += np.sum(p[0], axis=1)
+
     def calculateMeanPosteriors(self, session, taskId):
         sampleCount = 0
-        segments = self.getSegmentFeaturesFromHdf(self.data_indices[taskId - 1])
+        triphoneSums = np.zeros((self.n_contexts, self.n_state_classes, self.n_contexts))
+        diphoneSums = np.zeros((self.n_contexts, self.n_state_classes))
+        contextSums = np.zeros(self.n_contexts)
 
-        for batch in get_batch_from_segments(segments, self.n_batch):
-            bSize = len(batch)
-            denom = sampleCount + bSize
-            if len(batch) == 0:
-                break
+        for batch in self.getFeatureBatchesFromHdf(self.data_indices[taskId - 1]):
             encoderOutput = self.getEncoderOutput(session, batch)
-            for pastContextId in range(self.n_contexts):
-                for currentState in range(self.n_state_classes):
-                    denselabel = self.get_dense_label(pastLabel=pastContextId, centerState=currentState)
-                    p = self.getPosteriorsOfOutputsWithEncoderOutput(session, encoderOutput[0], denselabel)
-                    # triphone is calculates for each center and left context
-                    tri = (sampleCount * self.triphone_means[pastContextId][currentState]) + (
-                        bSize * np.mean(p[0][0], axis=0)
-                    )
-                    self.triphone_means[pastContextId][currentState] = np.divide(tri, denom)
-                    # diphone is calculated for each context with centerstate 0
-                    if not currentState:
-                        di = (sampleCount * self.diphone_means[pastContextId]) + (bSize * np.mean(p[1][0], axis=0))
-                        self.diphone_means[pastContextId] = np.divide(di, denom)
-                        # context is not label dependent
-                        if not pastContextId:
-                            ctx = (sampleCount * self.context_means) + (bSize * np.mean(p[2][0], axis=0))
-                            self.context_means = np.divide(ctx, denom)
-            sampleCount += bSize
+            if self.label_batch_size is None:
+                self.accumulatePosteriors(session, encoderOutput[0], triphoneSums, diphoneSums, contextSums)
+            else:
+                self.accumulatePosteriorsBatched(session, encoderOutput[0], triphoneSums, diphoneSums, contextSums)
+            sampleCount += len(batch)
 
         with open(self.numSegments[taskId - 1].get_path(), "wb") as fp:
             pickle.dump(sampleCount, fp, protocol=pickle.HIGHEST_PROTOCOL)
 
-    def dumpMeans(self, taskId):
+        denom = max(sampleCount, 1)
+        return triphoneSums / denom, diphoneSums / denom, contextSums / denom
+
+    def dumpMeans(self, taskId, triphoneMeans, diphoneMeans, contextMeans):
+        # same format as before, as expected by DumpXmlForTriphoneForwardJob
+        triphoneDict = {
+            i: {j: triphoneMeans[i, j] for j in range(self.n_state_classes)} for i in range(self.n_contexts)
+        }
+        diphoneDict = {i: diphoneMeans[i] for i in range(self.n_contexts)}
         with open(self.triphone_files[taskId - 1].get_path(), "wb") as f1:
-            pickle.dump(self.triphone_means, f1, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(triphoneDict, f1, protocol=pickle.HIGHEST_PROTOCOL)
         with open(self.diphone_files[taskId - 1].get_path(), "wb") as f2:
-            pickle.dump(self.diphone_means, f2, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(diphoneDict, f2, protocol=pickle.HIGHEST_PROTOCOL)
         with open(self.context_means[taskId - 1].get_path(), "wb") as f3:
-            pickle.dump(self.context_means, f3, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(contextMeans, f3, protocol=pickle.HIGHEST_PROTOCOL)
 
     def run(self, taskId):
         tf.load_op_library(self.tf_lib)
@@ -189,10 +272,10 @@ class EstimateSprintTriphoneForwardPriorsJob(Job):
         tf.compat.v1.import_graph_def(mg.graph_def, name="")
         # session
         s = tf.compat.v1.Session()
-        returnValue = s.run(["save/restore_all"], feed_dict={"save/Const:0": self.model.get_path()})
+        returnValue = s.run(["save/restore_all"], feed_dict={"save/Const:0": self.model_path.get_path()})
 
-        self.calculateMeanPosteriors(s, taskId)
-        self.dumpMeans(taskId)
+        means = self.calculateMeanPosteriors(s, taskId)
+        self.dumpMeans(taskId, *means)
 
 
 class DumpXmlForTriphoneForwardJob(Job):
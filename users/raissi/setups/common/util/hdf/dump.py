@@ -8,7 +8,7 @@ from sisyphus import gs, Job, Path, Task, tk
 
 from i6_core.corpus import SegmentCorpusJob
 import i6_core.features as features
-from i6_core.lib.rasr_cache import FileArchive
+from i6_core.lib.rasr_cache import FileArchive, FileArchiveBundle
 from i6_core.meta.system import CorpusObject
 from i6_core import rasr
 from i6_core.returnn import ReturnnDumpHDFJob
@@ -119,12 +119,117 @@ def build_rasr_feature_hdfs(
     return hdf_files
 
 #### NextGenDataset#####
+def _acquire_slot_lock(lock_dir: str, num_slots: int, stale_after: float = 3600.0) -> Optional[str]:
+    """
+    Tries to take one of `num_slots` lock files in `lock_dir`, lock files older than `stale_after` seconds
+    are considered left over from a crashed task and are removed.
+
+    :return: path of the acquired lock file or None if all slots are taken
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    for slot in range(num_slots):
+        lock_file = os.path.join(lock_dir, f"cache.lock.{slot}")
+        try:
+            if time.time() - os.path.getmtime(lock_file) > stale_after:
+                logging.warning(f"removing stale lock {lock_file}")
+                os.remove(lock_file)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.write(fd, f"{os.uname().nodename}:{os.getpid()}\n".encode())
+        os.close(fd)
+        return lock_file
+    return None
+
+
+def cache_file_with_backoff(
+    file: Union[tk.Path, str],
+    lock_dir: str,
+    max_parallel: int = 2,
+    max_tries: int = 10,
+    max_wait: float = 6 * 3600.0,
+    base_delay: float = 1.0,
+    max_delay: float = 120.0,
+) -> str:
+    """
+    Calls the cache manager while at most `max_parallel` tasks of the job do so at the same time.
+    Waiting for a free slot and failed cache attempts are retried with exponential backoff and jitter,
+    which replaces the fixed random sleep against the thundering herd.
+
+    :param max_tries: number of failed cache manager calls before giving up, waiting for a slot does not count
+    :param max_wait: seconds to wait in total for a free slot before giving up
+    """
+    num_failures = 0
+    num_retries = 0
+    wait_start = time.time()
+    while True:
+        lock_file = _acquire_slot_lock(lock_dir, max_parallel)
+        if lock_file is not None:
+            try:
+                return cache_file(file)
+            except Exception as e:
+                num_failures += 1
+                if num_failures >= max_tries:
+                    raise
+                logging.warning(f"caching {file} failed with {e!r} ({num_failures}/{max_tries}), retrying")
+            finally:
+                os.remove(lock_file)
+            wait_start = time.time()
+        elif time.time() - wait_start > max_wait:
+            raise TimeoutError(f"could not acquire a cache slot for {file} within {max_wait:.0f}s")
+        delay = min(max_delay, base_delay * 2 ** min(num_retries, 32)) * random.uniform(0.5, 1.0)
+        num_retries += 1
+        logging.info(f"waiting {delay:.1f}s before trying to cache {file} again...")
+        time.sleep(delay)
+
+
 #From old recipes
 class RasrFeaturesToHdf(Job):
-    def __init__(self, feature_caches: Union[MultiPath, List[Path]]):
+    """
+    Dumps RASR feature caches into HDF files.
+
+    By default, every sequence is stored as its own dataset in the NextGenHDFDataset layout.
+    With `bulk=True`, all features of a cache are streamed into a single contiguous, chunked and
+    optionally compressed `inputs` array in the RETURNN simple HDF layout (`seqTags`, `seqLengths`),
+    plus a `seqOffsets` index into `inputs`, which is much faster to write and to open.
+    """
+
+    __sis_hash_exclude__ = {
+        "bulk": False,
+        "compression": None,
+        "chunk_frames": 16384,
+        "prefetch_seqs": 64,
+        "max_parallel_caching": 2,
+    }
+
+    def __init__(
+        self,
+        feature_caches: Union[MultiPath, List[Path]],
+        bulk: bool = False,
+        compression: Optional[str] = None,
+        chunk_frames: int = 16384,
+        prefetch_seqs: int = 64,
+        max_parallel_caching: int = 2,
+    ):
+        """
+        :param feature_caches: RASR feature caches, one output HDF per cache
+        :param bulk: write one contiguous array per HDF instead of one dataset per sequence
+        :param compression: h5py compression filter for the bulk array, e.g. "gzip" or "lzf"
+        :param chunk_frames: number of frames per HDF chunk and per write in bulk mode
+        :param prefetch_seqs: size of the queue between the cache reader thread and the HDF writer
+        :param max_parallel_caching: number of tasks of this job that may call the cache manager at the same time
+        """
         self.feature_caches = (
             list(feature_caches.hidden_paths.values()) if isinstance(feature_caches, MultiPath) else feature_caches
         )
+        self.bulk = bulk
+        self.compression = compression
+        self.chunk_frames = chunk_frames
+        self.prefetch_seqs = prefetch_seqs
+        self.max_parallel_caching = max_parallel_caching
 
         self.out_hdf_files = [self.output_path(f"data.hdf.{i}", cached=False) for i in range(len(self.feature_caches))]
         self.out_single_segment_files = [self.output_path(f"segments.{i}") for i in range(len(self.feature_caches))]
@@ -136,11 +241,17 @@ class RasrFeaturesToHdf(Job):
 
     def run(self, *indices: int):
         for index in indices:
-            to_sleep = random.randrange(0, 120)
-            logging.info(f"sleeping for {to_sleep}s to avoid thundering herd...")
-            time.sleep(to_sleep)
-
-            self.process(index)
+            if self.bulk:
+                self.process_bulk(index)
+            else:
+                self.process(index)
+
+    def _cache(self, index: int) -> str:
+        return cache_file_with_backoff(
+            self.feature_caches[index],
+            lock_dir=self._sis_path(gs.JOB_WORK_DIR),
+            max_parallel=self.max_parallel_caching,
+        )
 
     def process(self, index: int):
         seq_names = []
@@ -148,7 +259,7 @@ class RasrFeaturesToHdf(Job):
 
         logging.info(f"processing {self.feature_caches[index]}")
 
-        cached_path = cache_file(self.feature_caches[index])
+        cached_path = self._cache(index)
         feature_cache = FileArchive(cached_path)
 
         with tempfile.TemporaryDirectory() as out_dir:
@@ -183,21 +294,178 @@ class RasrFeaturesToHdf(Job):
 
             shutil.move(out_file, target)
 
+        self._write_segments(index, seq_names)
+
+    def process_bulk(self, index: int):
+        import queue
+        import threading
+
+        logging.info(f"processing {self.feature_caches[index]} in bulk mode")
+
+        cached_path = self._cache(index)
+        feature_cache = FileArchive(cached_path)
+
+        # the reader thread decodes the cache while the main thread writes, None marks the end
+        seq_queue = queue.Queue(maxsize=self.prefetch_seqs)
+        reader_errors = []
+
+        def read_cache():
+            try:
+                for file in feature_cache.ft:
+                    info = feature_cache.ft[file]
+                    if info.name.endswith(".attribs"):
+                        continue
+                    times, features = feature_cache.read(file, "feat")
+                    seq_queue.put((info.name, np.asarray(features, dtype=np.float32)))
+            except Exception as e:
+                reader_errors.append(e)
+            finally:
+                seq_queue.put(None)
+
+        reader = threading.Thread(target=read_cache, daemon=True)
+        reader.start()
+
+        seq_names = []
+        seq_lengths = []
+        pending = []
+        pending_frames = 0
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_file = os.path.join(out_dir, "data.hdf")
+            logging.info(f"creating HDF at {out_file}")
+
+            with h5py.File(out_file, "w") as out:
+                inputs = None
+
+                def flush():
+                    block = np.concatenate(pending, axis=0)
+                    offset = inputs.shape[0]
+                    inputs.resize(offset + block.shape[0], axis=0)
+                    inputs[offset:] = block
+                    pending.clear()
+
+                while True:
+                    item = seq_queue.get()
+                    if item is None:
+                        break
+                    name, features = item
+                    if inputs is None:
+                        dim = features.shape[1]
+                        inputs = out.create_dataset(
+                            "inputs",
+                            shape=(0, dim),
+                            maxshape=(None, dim),
+                            chunks=(self.chunk_frames, dim),
+                            dtype=np.float32,
+                            compression=self.compression,
+                        )
+                    seq_names.append(name)
+                    seq_lengths.append(features.shape[0])
+                    pending.append(features)
+                    pending_frames += features.shape[0]
+                    if pending_frames >= self.chunk_frames:
+                        flush()
+                        pending_frames = 0
+
+                reader.join()
+                if reader_errors:
+                    raise reader_errors[0]
+                assert inputs is not None, f"no features found in {self.feature_caches[index]}"
+                if pending:
+                    flush()
+
+                lengths = np.array(seq_lengths, dtype=np.int32)
+                offsets = np.zeros_like(lengths, dtype=np.int64)
+                np.cumsum(lengths[:-1], out=offsets[1:])
+
+                out.attrs["numSeqs"] = len(seq_names)
+                out.attrs["numTimesteps"] = int(lengths.sum())
+                out.attrs["inputPattSize"] = inputs.shape[1]
+                out.attrs["numDims"] = 1
+                out.attrs["numLabels"] = 1
+                out.create_dataset("labels", (0,), dtype="S5")
+                out.create_dataset("seqTags", data=seq_names, dtype=h5py.special_dtype(vlen=str))
+                # second column is expected by HDFDataset for the (here empty) "classes"
+                out.create_dataset("seqLengths", data=np.stack([lengths, np.zeros_like(lengths)], axis=1))
+                out.create_dataset("seqOffsets", data=offsets)
+
+            target = self.out_hdf_files[index].get_path()
+            logging.info(f"moving {out_file} to its target {target}")
+
+            shutil.move(out_file, target)
+
+        self._write_segments(index, seq_names)
+
+    def _write_segments(self, index: int, seq_names: List[str]):
         with open(self.out_single_segment_files[index], "wt") as file:
             file.writelines((f"{seq_name.strip()}\n" for seq_name in seq_names))
 
 
+def _read_alignment_indices(archive: FileArchive, file: str) -> np.ndarray:
+    """
+    :return: int32 array of shape (T, 2) containing the allophone index and the state of every frame
+    """
+    alignment = archive.read(file, "align")
+    if len(alignment) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    return np.array(alignment)[:, 1:3].astype(np.int32)
+
+
+def _convert_alignment_archive(args):
+    """
+    Converts all sequences of a single archive of an alignment bundle, used as worker in a process pool.
+
+    :return: seq names and the targets of each sequence
+    """
+    job_cls, archive_path, allophones_path, table = args
+
+    archive = FileArchive(archive_path)
+    archive.setAllophones(allophones_path)
+
+    seq_names = []
+    targets = []
+    for file in archive.file_list():
+        if file.endswith(".attribs"):
+            continue
+        indices = _read_alignment_indices(archive, file)
+        seq_names.append(file)
+        targets.append(job_cls.compute_targets_from_indices(indices[:, 0], indices[:, 1], table))
+
+    return seq_names, targets
+
+
 class RasrAlignmentToHDF(Job):
-    def __init__(self, alignment_bundle: tk.Path, allophones: tk.Path, state_tying: tk.Path, num_tied_classes: int):
+    """
+    Converts a RASR alignment bundle into a NextGenHDFDataset HDF of tied state labels.
+
+    With `use_lookup_table=True`, an `(allophone_index, state) -> tied_class` table is computed once per bundle
+    and every alignment is mapped with a single gather instead of formatting and looking up one string per frame.
+    The archives of the bundle are then converted by `num_processes` worker processes. The resulting HDF is the
+    same as with the string based conversion, see `benchmark_alignment_to_hdf`.
+    """
+
+    __sis_hash_exclude__ = {"use_lookup_table": False, "num_processes": 1}
+
+    def __init__(
+        self,
+        alignment_bundle: tk.Path,
+        allophones: tk.Path,
+        state_tying: tk.Path,
+        num_tied_classes: int,
+        use_lookup_table: bool = False,
+        num_processes: int = 1,
+    ):
         self.alignment_bundle = alignment_bundle
         self.allophones = allophones
         self.num_tied_classes = num_tied_classes
         self.state_tying = state_tying
+        self.use_lookup_table = use_lookup_table
+        self.num_processes = num_processes
 
         self.out_hdf_file = self.output_path("alignment.hdf")
         self.out_segments = self.output_path("segments")
 
-        self.rqmt = {"cpu": 1, "mem": 8, "time": 1}
+        self.rqmt = {"cpu": num_processes, "mem": 8, "time": 1}
 
     def tasks(self):
         yield Task("run", rqmt=self.rqmt)
@@ -212,15 +480,20 @@ class RasrAlignmentToHDF(Job):
 
             shutil.move(f, self.out_hdf_file.get_path())
 
+    def read_state_tying(self) -> Dict[str, int]:
+        with open(self.state_tying, "rt") as st:
+            return {k: int(v) for line in st for k, v in [line.strip().split()[0:2]]}
+
     def __run(self, out: h5py.File):
         string_dt = h5py.special_dtype(vlen=str)
 
-        with open(self.state_tying, "rt") as st:
-            state_tying = {k: int(v) for line in st for k, v in [line.strip().split()[0:2]]}
+        state_tying = self.read_state_tying()
 
         cached_alignment_bundle = cache_file(self.alignment_bundle)
-        alignment_cache = FileArchiveBundle(cached_alignment_bundle)
-        alignment_cache.setAllophones(self.allophones.get_path())
+        if self.use_lookup_table:
+            converted = self.convert_with_lookup_table(cached_alignment_bundle, state_tying)
+        else:
+            converted = self.convert_with_strings(cached_alignment_bundle, state_tying)
 
         seq_names = []
 
@@ -239,27 +512,59 @@ class RasrAlignmentToHDF(Job):
         # second level
         alignment_data = alignment_group.create_group("data")
 
+        for file, targets in converted:
+            seq_names.append(file)
+            alignment_data.create_dataset(
+                seq_names[-1].replace("/", "\\"),
+                data=np.asarray(targets).astype(np.int32),
+            )
+
+        out.create_dataset("seq_names", data=[s.encode() for s in seq_names], dtype=string_dt)
+
+        with open(self.out_segments, "wt") as file:
+            file.writelines((f"{seq_name.strip()}\n" for seq_name in seq_names))
+
+    def convert_with_strings(self, cached_alignment_bundle: str, state_tying: Dict[str, int]):
+        """
+        Yields seq name and targets, formatting one allophone state string per frame.
+        """
+        alignment_cache = FileArchiveBundle(cached_alignment_bundle)
+        alignment_cache.setAllophones(self.allophones.get_path())
+
         for file in alignment_cache.file_list():
             if file.endswith(".attribs"):
                 continue
 
-            seq_names.append(file)
-
             # alignment
             alignment = alignment_cache.read(file, "align")
 
             alignment_states = [f"{alignment_cache.files[file].allophones[t[1]]}.{t[2]:d}" for t in alignment]
-            targets = self.compute_targets(alignment_states=alignment_states, state_tying=state_tying)
+            yield file, self.compute_targets(alignment_states=alignment_states, state_tying=state_tying)
 
-            alignment_data.create_dataset(
-                seq_names[-1].replace("/", "\\"),
-                data=np.array(targets).astype(np.int32),
-            )
-
-        out.create_dataset("seq_names", data=[s.encode() for s in seq_names], dtype=string_dt)
+    def convert_with_lookup_table(self, cached_alignment_bundle: str, state_tying: Dict[str, int]):
+        """
+        Yields seq name and targets in the order of the bundle, the archives are converted in parallel.
+        """
+        import multiprocessing
 
-        with open(self.out_segments, "wt") as file:
-            file.writelines((f"{seq_name.strip()}\n" for seq_name in seq_names))
+        alignment_cache = FileArchiveBundle(cached_alignment_bundle)
+        alignment_cache.setAllophones(self.allophones.get_path())
+        archive_paths = list(alignment_cache.archives.keys())
+        allophones = alignment_cache.archives[archive_paths[0]].allophones
+
+        table = self.build_lookup_table(allophones, state_tying)
+        logging.info(f"built lookup table for {len(allophones)} allophones, converting {len(archive_paths)} archives")
+
+        args = [(type(self), path, self.allophones.get_path(), table) for path in archive_paths]
+        if self.num_processes > 1:
+            with multiprocessing.Pool(self.num_processes) as pool:
+                # imap keeps the order of the bundle
+                for seq_names, targets in pool.imap(_convert_alignment_archive, args):
+                    yield from zip(seq_names, targets)
+        else:
+            for arg in args:
+                seq_names, targets = _convert_alignment_archive(arg)
+                yield from zip(seq_names, targets)
 
     def compute_targets(
         self, alignment_states: List[str], state_tying: Dict[str, int]
@@ -267,6 +572,64 @@ class RasrAlignmentToHDF(Job):
         targets = [state_tying[allophone] for allophone in alignment_states]
         return targets
 
+    @classmethod
+    def build_lookup_table(cls, allophones: List[str], state_tying: Dict[str, int]) -> Any:
+        """
+        :return: int32 array of shape (num_allophones, num_states) with the tied class of every allophone state,
+            -1 where the allophone state is not part of the state tying
+        """
+        num_states = 1 + max(int(k.rsplit(".", 1)[1]) for k in state_tying)
+        table = np.full((len(allophones), num_states), -1, dtype=np.int32)
+        for index, allophone in enumerate(allophones):
+            for state in range(num_states):
+                table[index, state] = state_tying.get(f"{allophone}.{state}", -1)
+        return table
+
+    @classmethod
+    def compute_targets_from_indices(cls, allophone_indices: np.ndarray, states: np.ndarray, table: Any) -> np.ndarray:
+        num_states = table.shape[1]
+        valid = states < num_states
+        targets = np.full(allophone_indices.shape, -1, dtype=np.int32)
+        targets[valid] = table[allophone_indices[valid], states[valid]]
+        if (targets < 0).any():
+            t = int(np.argmax(targets < 0))
+            raise KeyError(f"allophone index {allophone_indices[t]} state {states[t]} not in state tying")
+        return targets
+
+
+def benchmark_alignment_to_hdf(job: RasrAlignmentToHDF, num_processes: Optional[int] = None) -> Dict[str, float]:
+    """
+    Times the string based against the lookup table based conversion of the alignment bundle of `job`
+    and checks that both produce the same targets, e.g. to be called from the Sisyphus console.
+
+    :return: seconds taken per conversion
+    """
+    state_tying = job.read_state_tying()
+    cached_alignment_bundle = cache_file(job.alignment_bundle)
+    old_num_processes = job.num_processes
+    if num_processes is not None:
+        job.num_processes = num_processes
+
+    timings = {}
+    results = {}
+    try:
+        for name, convert in [
+            ("strings", job.convert_with_strings),
+            ("lookup_table", job.convert_with_lookup_table),
+        ]:
+            start = time.monotonic()
+            results[name] = [(seq, np.asarray(t).astype(np.int32)) for seq, t in convert(cached_alignment_bundle, state_tying)]
+            timings[name] = time.monotonic() - start
+            logging.info(f"{name}: {timings[name]:.2f}s for {len(results[name])} sequences")
+    finally:
+        job.num_processes = old_num_processes
+
+    assert len(results["strings"]) == len(results["lookup_table"])
+    for (seq_a, a), (seq_b, b) in zip(results["strings"], results["lookup_table"]):
+        assert seq_a == seq_b and np.array_equal(a, b), f"mismatch for {seq_a}"
+
+    return timings
+
 
 @dataclass(eq=True, frozen=True)
 class AllophoneState:
@@ -315,6 +678,43 @@ class RasrForcedTriphoneAlignmentToHDF(RasrAlignmentToHDF):
 
         return super().compute_targets(forced_triphone_alignment, state_tying)
 
+    @classmethod
+    def build_lookup_table(cls, allophones: List[str], state_tying: Dict[str, int]) -> Any:
+        # the tied class depends on the neighbouring frames, so the table is filled lazily per context
+        return allophones, state_tying, {}
+
+    @classmethod
+    def compute_targets_from_indices(cls, allophone_indices: np.ndarray, states: np.ndarray, table: Any) -> np.ndarray:
+        allophones, state_tying, resolved = table
+        if len(allophone_indices) == 0:
+            return np.zeros((0,), dtype=np.int32)
+
+        # (left allophone, allophone, state, right allophone), -1 marks the sequence boundaries
+        keys = np.stack(
+            [
+                np.concatenate([[-1], allophone_indices[:-1]]),
+                allophone_indices,
+                states,
+                np.concatenate([allophone_indices[1:], [-1]]),
+            ],
+            axis=1,
+        )
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+        def parse(index: int, state: int) -> Optional[AllophoneState]:
+            return AllophoneState.from_alignment_state(f"{allophones[index]}.{state}") if index >= 0 else None
+
+        classes = np.empty(len(unique_keys), dtype=np.int32)
+        for i, (left, cur, state, right) in enumerate(unique_keys.tolist()):
+            key = (left, cur, state, right)
+            if key not in resolved:
+                # neighbour states only contribute their phone, which does not depend on the state
+                in_context = parse(cur, state).in_context(parse(left, 0), parse(right, 0))
+                resolved[key] = state_tying[str(in_context)]
+            classes[i] = resolved[key]
+
+        return classes[inverse.reshape(-1)]
+
 
 ###ToDo------ Needs cleanup
 class RasrFeatureAndDeduplicatedPhonemeSequenceToHDF(Job):
@@ -57,12 +57,48 @@ def ffmpeg_silence_remove(
     return bliss_ffmpeg_job.out_corpus
 
 
+def _cut_audio_soundfile(in_file, target_file, groups):
+    """
+    Decodes the audio once and writes the concatenation of the kept time intervals.
+
+    :param str in_file:
+    :param str target_file:
+    :param list[tuple[float, float]] groups: (start, end) in seconds
+    """
+    import soundfile
+
+    info = soundfile.info(in_file)
+    data, sample_rate = soundfile.read(in_file, dtype="int16" if info.subtype == "PCM_16" else "float64")
+    pieces = []
+    for start, end in groups:
+        start = min(max(int(round(start * sample_rate)), 0), len(data))
+        end = min(max(int(round(end * sample_rate)), start), len(data))
+        pieces.append(data[start:end])
+    target_format = os.path.splitext(target_file)[1][1:].upper()
+    subtype = info.subtype if target_format == info.format and soundfile.check_format(target_format, info.subtype) else None
+    soundfile.write(target_file, numpy.concatenate(pieces) if pieces else data[:0], sample_rate, subtype=subtype)
+
+
+def _soundfile_supports(*files):
+    import soundfile
+
+    formats = soundfile.available_formats()
+    return all(os.path.splitext(f)[1][1:].upper() in formats for f in files)
+
+
 class AlignmentCacheSilenceRemoval(Job):
     """
     This Job uses an alignment cache to do silence removal on a given bliss corpus
+
+    With cut_engine="soundfile", each recording is decoded once and the kept intervals are sliced from the samples,
+    recordings are processed by cut_rqmt["cpu"] workers. FFmpeg is then only used for formats soundfile can not handle.
     """
+
+    __sis_hash_exclude__ = {"cut_engine": "ffmpeg"}
+
     def __init__(self, bliss_corpus, alignment_cache, allophone_file, window_shift, pause_duration=0.0,
-                 silence_symbol=None, silence_symbol_duration=0.1, output_format=None, ffmpeg_binary=None):
+                 silence_symbol=None, silence_symbol_duration=0.1, output_format=None, ffmpeg_binary=None,
+                 cut_engine="ffmpeg"):
         """
 
         :param bliss_corpus:
@@ -74,7 +110,9 @@ class AlignmentCacheSilenceRemoval(Job):
         :param silence_symbol_duration:
         :param output_format:
         :param ffmpeg_binary:
+        :param str cut_engine: "ffmpeg" or "soundfile"
         """
+        assert cut_engine in ["ffmpeg", "soundfile"], "invalid cut engine: %s" % cut_engine
         self.bliss_corpus = bliss_corpus
         self.alignment_cache = alignment_cache
         self.allophone_file = allophone_file
@@ -84,6 +122,7 @@ class AlignmentCacheSilenceRemoval(Job):
         self.pause_duration = pause_duration
         self.silence_symbol = silence_symbol
         self.silence_symbol_duration = silence_symbol_duration
+        self.cut_engine = cut_engine
 
         self.out_audio_folder = self.output_path("audio/", directory=True)
         self.out_corpus = self.output_path("corpus.xml.gz")
@@ -92,7 +131,8 @@ class AlignmentCacheSilenceRemoval(Job):
         self.recover_rqmt = {'time': 4, 'mem': 4, 'cpu': 1}
 
     def tasks(self):
-        yield Task("extract_silence", mini_task=True)
+        if self.cut_engine == "ffmpeg":
+            yield Task("extract_silence", mini_task=True)
         yield Task("cut_audio", rqmt=self.cut_rqmt)
         yield Task("recover_duration", rqmt=self.recover_rqmt)
 
@@ -122,6 +162,13 @@ class AlignmentCacheSilenceRemoval(Job):
         TODO: fix the high memory consumption
         :return:
         """
+        pickle.dump(self.extract_groups(), open("groups.pkl", "wb"))
+
+    def extract_groups(self):
+        """
+        :return: segment name -> [speech groups (start, end) in seconds, silence word positions]
+        :rtype: dict[str, list]
+        """
         alignment_path = tk.uncached_path(self.alignment_cache)
 
         groups_dict = {}
@@ -194,7 +241,7 @@ class AlignmentCacheSilenceRemoval(Job):
             # as we never have silence in the beginning
             groups_dict[key] = [groups, silence_word_positions[1:]]
 
-        pickle.dump(groups_dict, open("groups.pkl", "wb"))
+        return groups_dict
 
     def run_subprocess(self, command):
         subprocess.check_call(command)
@@ -204,11 +251,15 @@ class AlignmentCacheSilenceRemoval(Job):
         c = corpus.Corpus()
         c.load(tk.uncached_path(self.bliss_corpus))
 
-        groups_dict = pickle.load(open("groups.pkl", "rb"))
+        if self.cut_engine == "ffmpeg":
+            groups_dict = pickle.load(open("groups.pkl", "rb"))
+        else:
+            groups_dict = self.extract_groups()
 
         empty_recordings = []
 
         ffmpeg_commands = []
+        soundfile_cuts = []
 
         for recording in c.all_recordings():
 
@@ -230,7 +281,7 @@ class AlignmentCacheSilenceRemoval(Job):
                 empty_recordings.append(recording)
                 continue
 
-            ffmpeg_command = ["ffmpeg", "-y", "-i", in_file, "-filter_complex"]
+            ffmpeg_command = [self.ffmpeg_binary, "-y", "-i", in_file, "-filter_complex"]
 
             split_orth = segment.orth.split(" _ ")
             filter_commands = []
@@ -259,8 +310,11 @@ class AlignmentCacheSilenceRemoval(Job):
 
             ffmpeg_command += [filter_command, "-map", "[out]", target_file]
 
-            print(" ".join(ffmpeg_command))
-            ffmpeg_commands.append(ffmpeg_command)
+            if self.cut_engine == "soundfile" and _soundfile_supports(in_file, target_file):
+                soundfile_cuts.append((in_file, target_file, groups[0]))
+            else:
+                print(" ".join(ffmpeg_command))
+                ffmpeg_commands.append(ffmpeg_command)
 
             recording.audio = target_file
 
@@ -275,8 +329,9 @@ class AlignmentCacheSilenceRemoval(Job):
 
         c.dump("temp_corpus.xml.gz")
 
-        p = multiprocessing.Pool(processes=4)
-        p.map(self.run_subprocess, ffmpeg_commands)
+        with multiprocessing.Pool(processes=self.cut_rqmt['cpu']) as p:
+            p.starmap(_cut_audio_soundfile, soundfile_cuts, chunksize=16)
+            p.map(self.run_subprocess, ffmpeg_commands)
 
     def recover_duration(self):
         run_duration_recover("temp_corpus.xml.gz", tk.uncached_path(self.out_corpus))
\ No newline at end of file
@@ -0,0 +1,29 @@
+from sisyphus import Job, Task, tk
+
+from i6_experiments.users.rossenbach.lib.corpus_index import write_bliss_corpus_index
+
+
+class BuildBlissCorpusIndexJob(Job):
+    """
+    Writes the compact, memory-mappable index of a Bliss corpus,
+    see :mod:`i6_experiments.users.rossenbach.lib.corpus_index` for the format.
+
+    Jobs which only look up segments by name (orth, speaker, recording, times) can take out_index
+    instead of the corpus XML and avoid parsing the whole corpus.
+    """
+
+    def __init__(self, bliss_corpus: tk.Path):
+        """
+        :param bliss_corpus: corpus xml
+        """
+        self.bliss_corpus = bliss_corpus
+
+        self.out_index = self.output_path("index", directory=True)
+
+        self.rqmt = {"time": 1, "mem": 8}
+
+    def tasks(self):
+        yield Task("run", rqmt=self.rqmt)
+
+    def run(self):
+        write_bliss_corpus_index(self.bliss_corpus.get_path(), self.out_index.get_path())
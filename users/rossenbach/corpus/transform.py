@@ -11,6 +11,8 @@ from i6_core.lib.corpus import Corpus, Recording, Segment
 from i6_core.lib.lexicon import Lexicon
 from i6_core.corpus.transform import ApplyLexiconToCorpusJob, MergeStrategy, MergeCorporaJob
 
+from i6_experiments.users.rossenbach.lib.corpus_index import open_bliss_corpus_index
+
 class LexiconStrategy(enum.Enum):
     PICK_FIRST = 0
 
@@ -118,7 +120,8 @@ class RandomAssignSpeakersFromCorpus(Job):
         """
 
         :param bliss_corpus: bliss corpus to assign speakers to
-        :param speaker_reference_bliss_corpus: bliss corpus to take speakers from
+        :param speaker_reference_bliss_corpus: bliss corpus to take speakers from,
+            or its index of :class:`BuildBlissCorpusIndexJob`
         :param seed: random seed for deterministic behavior
         """
         self.bliss_corpus = bliss_corpus
@@ -137,10 +140,15 @@ class RandomAssignSpeakersFromCorpus(Job):
         out_corpus = Corpus()
         out_corpus.load(self.bliss_corpus.get_path())
 
-        speaker_corpus = Corpus()
-        speaker_corpus.load(self.speaker_reference_bliss_corpus.get_path())
+        # only the speakers are needed, so this can also be an index
+        speaker_corpus = open_bliss_corpus_index(self.speaker_reference_bliss_corpus.get_path())
 
-        out_corpus.speakers = speaker_corpus.speakers
+        out_corpus.speakers = {}
+        for speaker_name, attribs in zip(speaker_corpus.speakers, speaker_corpus.speaker_attribs):
+            speaker = corpus.Speaker()
+            speaker.name = speaker_name
+            speaker.attribs = dict(attribs)
+            out_corpus.speakers[speaker_name] = speaker
         speaker_name_list = list(out_corpus.speakers.keys())
         num_speakers = len(speaker_name_list)
 
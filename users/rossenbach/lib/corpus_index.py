@@ -0,0 +1,245 @@
+"""
+Compact index of a Bliss corpus, to look up segments without parsing the corpus XML.
+
+The index is a directory of .npy files, so that all arrays can be memory mapped
+(S: num segments, R: num recordings, K: num speakers):
+
+- ``segment_name_blob``, ``segment_name_offsets`` [S+1]: utf8 full segment names (corpus/recording/segment)
+- ``segment_name_order`` [S]: segment indices sorted by name, for the lookup by binary search
+- ``orth_blob``, ``orth_offsets`` [S+1]: utf8 orthographies
+- ``recording`` [S]: recording index of every segment
+- ``start``, ``end`` [S]: segment times in seconds
+- ``speaker`` [S]: speaker index of the segment (or its recording), -1 if none
+- ``recording_name_blob``, ``recording_name_offsets`` [R+1]: full recording names
+- ``audio_blob``, ``audio_offsets`` [R+1]: audio paths of the recordings
+- ``speakers.json``: name and attribs of the K speakers, in the order of ``Corpus.all_speakers()``
+- ``info.json``: corpus name and counts
+
+:class:`BuildBlissCorpusIndexJob` writes it once per corpus,
+:func:`open_bliss_corpus_index` opens either an index or a Bliss XML file, so jobs can accept both.
+"""
+
+import json
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy
+
+from i6_core.lib import corpus
+
+
+class IndexedSegment(NamedTuple):
+    fullname: str
+    name: str
+    recording: str
+    audio: Optional[str]
+    start: float
+    end: float
+    speaker: Optional[str]
+    orth: str
+
+
+def _strings_to_blob(strings: List[Optional[str]]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    :return: utf8 bytes of all strings concatenated, offsets [len(strings)+1]
+    """
+    encoded = [(s or "").encode("utf8") for s in strings]
+    offsets = numpy.zeros((len(encoded) + 1,), dtype=numpy.int64)
+    numpy.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8).copy(), offsets
+
+
+def build_bliss_corpus_index(bliss_corpus: str) -> Tuple[Dict[str, numpy.ndarray], List[Dict], Dict]:
+    """
+    Parses the Bliss corpus once and collects the index arrays.
+
+    :param bliss_corpus: path to the corpus XML
+    :return: arrays, speakers, info, see the module docstring
+    """
+    c = corpus.Corpus()
+    c.load(bliss_corpus)
+
+    speakers = [{"name": speaker.name, "attribs": dict(speaker.attribs)} for speaker in c.all_speakers()]
+    speaker_to_idx = {speaker["name"]: idx for idx, speaker in enumerate(speakers)}
+
+    recording_names = []
+    audios = []
+    segment_names = []
+    orths = []
+    recording_idxs = []
+    starts = []
+    ends = []
+    speaker_idxs = []
+    for recording in c.all_recordings():
+        for segment in recording.segments:
+            segment_names.append(segment.fullname())
+            orths.append(segment.orth)
+            recording_idxs.append(len(recording_names))
+            starts.append(segment.start)
+            ends.append(segment.end)
+            speaker_name = segment.speaker_name or recording.speaker_name
+            speaker_idxs.append(speaker_to_idx.get(speaker_name, -1) if speaker_name else -1)
+        recording_names.append(recording.fullname())
+        audios.append(recording.audio)
+
+    arrays = {}
+    arrays["segment_name_blob"], arrays["segment_name_offsets"] = _strings_to_blob(segment_names)
+    arrays["segment_name_order"] = numpy.array(
+        sorted(range(len(segment_names)), key=lambda idx: segment_names[idx].encode("utf8")), dtype=numpy.int64
+    )
+    arrays["orth_blob"], arrays["orth_offsets"] = _strings_to_blob(orths)
+    arrays["recording"] = numpy.array(recording_idxs, dtype=numpy.int32)
+    arrays["start"] = numpy.array(starts, dtype=numpy.float64)
+    arrays["end"] = numpy.array(ends, dtype=numpy.float64)
+    arrays["speaker"] = numpy.array(speaker_idxs, dtype=numpy.int32)
+    arrays["recording_name_blob"], arrays["recording_name_offsets"] = _strings_to_blob(recording_names)
+    arrays["audio_blob"], arrays["audio_offsets"] = _strings_to_blob(audios)
+    info = {"name": c.name, "num_segments": len(segment_names), "num_recordings": len(recording_names)}
+    return arrays, speakers, info
+
+
+def write_bliss_corpus_index(bliss_corpus: str, out_dir: str):
+    """
+    :param bliss_corpus: path to the corpus XML
+    :param out_dir: existing directory
+    """
+    arrays, speakers, info = build_bliss_corpus_index(bliss_corpus)
+    for key, array in arrays.items():
+        numpy.save(os.path.join(out_dir, key + ".npy"), array)
+    with open(os.path.join(out_dir, "speakers.json"), "wt") as f:
+        json.dump(speakers, f)
+    with open(os.path.join(out_dir, "info.json"), "wt") as f:
+        json.dump(info, f)
+
+
+class BlissCorpusIndex:
+    """
+    Lazy access to the segments of a Bliss corpus index, see the module docstring for the format.
+    Strings are only decoded when they are accessed.
+    """
+
+    def __init__(
+        self, arrays: Dict[str, numpy.ndarray], speakers: List[Dict], info: Dict, *, path: Optional[str] = None
+    ):
+        """
+        Use :func:`open_bliss_corpus_index` or :func:`load` instead.
+        """
+        self.path = path
+        self._arrays = arrays
+        self.name: str = info["name"]
+        self.speakers: List[str] = [speaker["name"] for speaker in speakers]
+        self.speaker_attribs: List[Dict[str, str]] = [speaker["attribs"] for speaker in speakers]
+        self._segment_name_blob = arrays["segment_name_blob"]
+        self._segment_name_offsets = arrays["segment_name_offsets"]
+        self._segment_name_order = arrays["segment_name_order"]
+        self._orth_blob = arrays["orth_blob"]
+        self._orth_offsets = arrays["orth_offsets"]
+        self.recording_idxs: numpy.ndarray = arrays["recording"]
+        self.starts: numpy.ndarray = arrays["start"]
+        self.ends: numpy.ndarray = arrays["end"]
+        self.speaker_idxs: numpy.ndarray = arrays["speaker"]
+
+    @classmethod
+    def load(cls, path: str, *, mmap: bool = True) -> "BlissCorpusIndex":
+        """
+        :param path: directory written by :func:`write_bliss_corpus_index`
+        :param mmap: memory map the arrays instead of reading them
+        """
+        arrays = {}
+        for filename in os.listdir(path):
+            if filename.endswith(".npy"):
+                arrays[filename[: -len(".npy")]] = numpy.load(
+                    os.path.join(path, filename), mmap_mode="r" if mmap else None
+                )
+        with open(os.path.join(path, "speakers.json"), "rt") as f:
+            speakers = json.load(f)
+        with open(os.path.join(path, "info.json"), "rt") as f:
+            info = json.load(f)
+        return cls(arrays, speakers, info, path=path)
+
+    @staticmethod
+    def _get_string(blob: numpy.ndarray, offsets: numpy.ndarray, idx: int) -> str:
+        return bytes(blob[offsets[idx] : offsets[idx + 1]]).decode("utf8")
+
+    def __len__(self) -> int:
+        return len(self.recording_idxs)
+
+    def __contains__(self, segment_name: str) -> bool:
+        try:
+            self.get_segment_idx(segment_name)
+        except KeyError:
+            return False
+        return True
+
+    def get_segment_name(self, seg_idx: int) -> str:
+        """:return: full segment name"""
+        return self._get_string(self._segment_name_blob, self._segment_name_offsets, seg_idx)
+
+    def segment_names(self) -> Iterator[str]:
+        """:return: full segment names in corpus order"""
+        for seg_idx in range(len(self)):
+            yield self.get_segment_name(seg_idx)
+
+    def get_segment_idx(self, segment_name: str) -> int:
+        """
+        Binary search of the full segment name, raises a KeyError if it does not exist.
+        """
+        key = segment_name.encode("utf8")
+        lo, hi = 0, len(self._segment_name_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            seg_idx = int(self._segment_name_order[mid])
+            mid_key = bytes(
+                self._segment_name_blob[self._segment_name_offsets[seg_idx] : self._segment_name_offsets[seg_idx + 1]]
+            )
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return seg_idx
+        raise KeyError(segment_name)
+
+    def get_orth(self, seg_idx: int) -> str:
+        return self._get_string(self._orth_blob, self._orth_offsets, seg_idx)
+
+    def get_speaker(self, seg_idx: int) -> Optional[str]:
+        speaker_idx = int(self.speaker_idxs[seg_idx])
+        return self.speakers[speaker_idx] if speaker_idx >= 0 else None
+
+    def get_recording_name(self, seg_idx: int) -> str:
+        """:return: full recording name"""
+        rec_idx = int(self.recording_idxs[seg_idx])
+        return self._get_string(self._arrays["recording_name_blob"], self._arrays["recording_name_offsets"], rec_idx)
+
+    def get_audio(self, seg_idx: int) -> Optional[str]:
+        rec_idx = int(self.recording_idxs[seg_idx])
+        return self._get_string(self._arrays["audio_blob"], self._arrays["audio_offsets"], rec_idx) or None
+
+    def get_segment(self, seg_idx: int) -> IndexedSegment:
+        fullname = self.get_segment_name(seg_idx)
+        return IndexedSegment(
+            fullname=fullname,
+            name=fullname.split("/")[-1],
+            recording=self.get_recording_name(seg_idx),
+            audio=self.get_audio(seg_idx),
+            start=float(self.starts[seg_idx]),
+            end=float(self.ends[seg_idx]),
+            speaker=self.get_speaker(seg_idx),
+            orth=self.get_orth(seg_idx),
+        )
+
+    def segments(self) -> Iterator[IndexedSegment]:
+        """:return: all segments in corpus order"""
+        for seg_idx in range(len(self)):
+            yield self.get_segment(seg_idx)
+
+
+def open_bliss_corpus_index(path: str) -> BlissCorpusIndex:
+    """
+    :param path: output of :class:`BuildBlissCorpusIndexJob`, or a Bliss corpus XML which is then indexed in memory
+    """
+    if os.path.isdir(path):
+        return BlissCorpusIndex.load(path)
+    arrays, speakers, info = build_bliss_corpus_index(path)
+    return BlissCorpusIndex(arrays, speakers, info)
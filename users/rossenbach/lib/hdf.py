@@ -27,9 +27,14 @@ class SimpleHDFWriter:
   which can be read later by :class:`HDFDataset`.
 
   Note that we dump to a temp file first, and only at :func:`close` we move it over to the real destination.
+
+  Every :func:`insert_batch` call does a single resize and write per dataset.
+  For callers which insert single sequences, buffer_size collects multiple calls before writing,
+  and preallocate grows the datasets geometrically, they are cut to the real size at :func:`close`.
   """
 
-  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False, extend_existing_file=False):
+  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False, extend_existing_file=False,
+               buffer_size=0, preallocate=False):
     """
     :param str filename: Create file, truncate if exists
     :param int|None dim:
@@ -38,6 +43,8 @@ class SimpleHDFWriter:
     :param dict[str,(int,int,str)]|None extra_type: key -> (dim,ndim,dtype)
     :param bool swmr: see http://docs.h5py.org/en/stable/swmr.html
     :param bool extend_existing_file: True also means we expect that it exists
+    :param int buffer_size: number of sequences which are kept in memory before they are written to the file
+    :param bool preallocate: grow the datasets by a factor of 2 instead of to the exact size
     """
     import tempfile
     import os
@@ -53,6 +60,8 @@ class SimpleHDFWriter:
     if labels:
       assert len(labels) == dim
     self.filename = filename
+    self.buffer_size = buffer_size
+    self.preallocate = preallocate
     tmp_fd, self.tmp_filename = tempfile.mkstemp(suffix=".hdf")
     os.close(tmp_fd)
     self.extend_existing_file = extend_existing_file
@@ -98,6 +107,10 @@ class SimpleHDFWriter:
 
     self._extra_num_time_steps = {}  # type: typing.Dict[str,int]  # key -> num-steps
     self._prepared_extra = set()
+    self._num_seqs = int(self._file.attrs['numSeqs'])
+    self._num_time_steps = int(self._file.attrs['numTimesteps'])
+    # sequences which are not written yet, list of (seq_tag, inputs, extra)
+    self._buffer = []  # type: typing.List[typing.Tuple[typing.Union[str,bytes], numpy.ndarray, typing.Dict[str, numpy.ndarray]]]
     if extra_type:
       self._prepare_extra(extra_type)
 
@@ -153,36 +166,29 @@ class SimpleHDFWriter:
       self._seq_lengths.resize(1 + len(self._prepared_extra), axis=1)
     return bool(added_count)
 
-  def _insert_h5_inputs(self, raw_data):
+  def _grow(self, dataset, size):
     """
-    Inserts a record into the hdf5-file.
-    Resizes if necessary.
+    Resizes the first axis of the dataset to at least size.
 
-    :param numpy.ndarray raw_data: shape=(time,data) or shape=(time,)
+    :param h5py.Dataset dataset:
+    :param int size:
     """
-    assert raw_data.ndim >= 1
-    name = "inputs"
-    if self.extend_existing_file:
-      # Just expect that the same dataset already exists.
-      self._datasets[name] = self._file[name]
-    if name not in self._datasets:
-      self._datasets[name] = self._file.create_dataset(
-        name, raw_data.shape, raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape))
-    else:
-      old_shape = self._datasets[name].shape
-      self._datasets[name].resize(old_shape[0] + raw_data.shape[0], axis=0)
-    # append raw data to dataset
-    self._datasets[name][self._file.attrs['numTimesteps']:] = raw_data
-    self._file.attrs['numTimesteps'] += raw_data.shape[0]
-    self._file.attrs['numSeqs'] += 1
+    if dataset.shape[0] >= size:
+      return
+    if self.preallocate:
+      size = max(size, 2 * dataset.shape[0])
+    dataset.resize(size, axis=0)
 
-  def _insert_h5_other(self, data_key, raw_data, dtype=None, add_time_dim=False, dim=None):
+  def _prepare_h5_other(self, data_key, raw_data, dtype=None, add_time_dim=False, dim=None):
     """
+    Converts the extra data of one sequence, and creates the dataset if it does not exist yet.
+
     :param str data_key:
     :param numpy.ndarray|int|float|list[int] raw_data: shape=(time,data) or shape=(time,) or shape=()...
     :param str|None dtype:
     :param bool add_time_dim:
     :param int|None dim:
+    :rtype: numpy.ndarray
     """
     if isinstance(raw_data, (int, float, list, numpy.float32)):
       raw_data = numpy.array(raw_data)
@@ -198,11 +204,7 @@ class SimpleHDFWriter:
       else:
         dim = 1  # dummy
 
-    # We assume that _insert_h5_inputs was called before.
-    assert self._file.attrs['numSeqs'] > 0 and self._seq_lengths.shape[0] > 0
-    seq_idx = self._file.attrs['numSeqs'] - 1
-
-    if raw_data.dtype == numpy.object:
+    if raw_data.dtype == object:
       # Is this a string?
       assert isinstance(raw_data.flat[0], (str, bytes))
       dtype = "string"
@@ -210,20 +212,58 @@ class SimpleHDFWriter:
       dtype = raw_data.dtype.name
     if self._prepare_extra({data_key: (dim, raw_data.ndim, dtype)}):
       # We added it now. Maybe other extra data keys were added before. The data_key_idx is different now.
-      # Thus, seq_lengths might have become invalid. Reinit them.
-      assert seq_idx == 0 or self.extend_existing_file  # We can only do that in the beginning.
-      for data_key_idx_0, data_key_ in enumerate(sorted(self._prepared_extra)):
-        self._seq_lengths[seq_idx, data_key_idx_0 + 1] = self._extra_num_time_steps[data_key_]
+      # The seq lengths are only written in _write_buffer, with the final data_key_idx,
+      # but the already written ones would become invalid.
+      assert self._num_seqs == 0 or self.extend_existing_file  # We can only do that in the beginning.
+    return raw_data
 
-    self._extra_num_time_steps[data_key] += raw_data.shape[0]
-    self._datasets[data_key].resize(self._extra_num_time_steps[data_key], axis=0)
+  def _write_buffer(self):
+    """
+    Writes all buffered sequences, with a single resize and write per dataset.
+    """
+    if not self._buffer:
+      return
+    n_seqs = len(self._buffer)
+    seq_idx = self._num_seqs
 
-    data_key_idx = sorted(self._prepared_extra).index(data_key) + 1
-    self._seq_lengths[seq_idx, data_key_idx] = raw_data.shape[0]
+    self._grow(self._seq_tags, seq_idx + n_seqs)
+    self._seq_tags[seq_idx:seq_idx + n_seqs] = numpy.array(
+      [seq_tag for seq_tag, _, _ in self._buffer], dtype=self._seq_tags.dtype)
 
-    offset = self._extra_num_time_steps[data_key] - raw_data.shape[0]
-    hdf_data = self._datasets[data_key]
-    hdf_data[offset:] = raw_data
+    # seq_length idx represents (seq_idx,data_key_idx), see __init__
+    seq_lengths = numpy.zeros((n_seqs, self._seq_lengths.shape[1]), dtype=self._seq_lengths.dtype)
+    seq_lengths[:, 0] = [len(data) for _, data, _ in self._buffer]
+    for data_key_idx_0, data_key in enumerate(sorted(self._prepared_extra)):
+      seq_lengths[:, data_key_idx_0 + 1] = [len(extra[data_key]) if data_key in extra else 0 for _, _, extra in self._buffer]
+      parts = [extra[data_key] for _, _, extra in self._buffer if data_key in extra]
+      if not parts:
+        continue
+      raw_data = numpy.concatenate(parts, axis=0)
+      offset = self._extra_num_time_steps[data_key]
+      self._grow(self._datasets[data_key], offset + raw_data.shape[0])
+      self._datasets[data_key][offset:offset + raw_data.shape[0]] = raw_data
+      self._extra_num_time_steps[data_key] += raw_data.shape[0]
+    self._grow(self._seq_lengths, seq_idx + n_seqs)
+    self._seq_lengths[seq_idx:seq_idx + n_seqs] = seq_lengths
+
+    raw_data = numpy.concatenate([data for _, data, _ in self._buffer], axis=0)
+    assert raw_data.ndim >= 1
+    name = "inputs"
+    if self.extend_existing_file and name in self._file:
+      # Just expect that the same dataset already exists.
+      self._datasets[name] = self._file[name]
+    if name not in self._datasets:
+      self._datasets[name] = self._file.create_dataset(
+        name, (0,) + raw_data.shape[1:], raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape))
+    self._grow(self._datasets[name], self._num_time_steps + raw_data.shape[0])
+    # append raw data to dataset
+    self._datasets[name][self._num_time_steps:self._num_time_steps + raw_data.shape[0]] = raw_data
+
+    self._num_time_steps += raw_data.shape[0]
+    self._num_seqs += n_seqs
+    self._file.attrs['numTimesteps'] = self._num_time_steps
+    self._file.attrs['numSeqs'] = self._num_seqs
+    self._buffer = []
 
   def insert_batch(self, inputs, seq_len, seq_tag, extra=None):
     """
@@ -258,12 +298,7 @@ class SimpleHDFWriter:
       assert all([n_batch == value.shape[0] for value in extra.values()]), (
         "n_batch %i, extra shapes: %r" % (n_batch, {key: value.shape for (key, value) in extra.items()}))
 
-    seqlen_offset = self._seq_lengths.shape[0]
-    self._seq_lengths.resize(seqlen_offset + n_batch, axis=0)
-    self._seq_tags.resize(seqlen_offset + n_batch, axis=0)
-
     for i in range(n_batch):
-      self._seq_tags[seqlen_offset + i] = numpy.array(seq_tag[i], dtype=self._seq_tags.dtype)
       # Note: Currently, our HDFDataset does not support to have multiple axes with dynamic length.
       # Thus, we flatten all together, and calculate the flattened seq len.
       # (Ignore this if there is only a single time dimension.)
@@ -272,36 +307,48 @@ class SimpleHDFWriter:
       flat_shape = [flat_seq_len]
       if self.dim and not sparse:
         flat_shape.append(self.dim)
-      self._seq_lengths[seqlen_offset + i, 0] = flat_seq_len
       data = inputs[i]
       data = data[tuple([slice(None, seq_len[axis][i]) for axis in range(ndim_with_seq_len)])]
       data = numpy.reshape(data, flat_shape)
-      self._insert_h5_inputs(data)
+      seq_extra = {}
       if len(seq_len) > 1:
         # Note: Because we have flattened multiple axes with dynamic len into a single one,
         # we want to store the individual axes lengths. We store those in a separate data entry "sizes".
         # Note: We could add a dummy time-dim for this "sizes", and then have a feature-dim = number of axes.
         # However, we keep it consistent to how we handled it in our 2D MDLSTM experiments.
-        self._insert_h5_other(
+        seq_extra["sizes"] = self._prepare_h5_other(
           "sizes", [seq_len[axis][i] for axis in range(ndim_with_seq_len)], add_time_dim=False, dtype="int32")
       if extra:
         try:
           for key, value in extra.items():
             assert value.shape[0] == n_batch
-            self._insert_h5_other(key, value[i])
+            seq_extra[key] = self._prepare_h5_other(key, value[i])
         except Exception:
           print("%s: insert extra exception. input shape %r, seq len %r, extra shapes: %r" % (
             self, inputs.shape, seq_len,
             {key: value.shape if isinstance(value, numpy.ndarray) else repr(value) for (key, value) in extra.items()}))
           raise
+      # copy, as inputs might be reused by the caller while the sequence is still in the buffer
+      self._buffer.append((seq_tag[i], numpy.array(data), seq_extra))
+
+    if len(self._buffer) >= self.buffer_size:
+      self._write_buffer()
 
   def close(self):
     """
-    Closes the file.
+    Writes the remaining buffered sequences and closes the file.
     """
     import os
     import shutil
     if self._file:
+      self._write_buffer()
+      # cut the preallocated space
+      self._seq_tags.resize(self._num_seqs, axis=0)
+      self._seq_lengths.resize(self._num_seqs, axis=0)
+      if "inputs" in self._datasets:
+        self._datasets["inputs"].resize(self._num_time_steps, axis=0)
+      for data_key in self._prepared_extra:
+        self._datasets[data_key].resize(self._extra_num_time_steps[data_key], axis=0)
       self._file.close()
       self._file = None
     if self.tmp_filename:
@@ -315,6 +362,127 @@ class SimpleHDFWriter:
       self.tmp_filename = None
 
 
+def merge_simple_hdf_files(in_filenames, out_filename, chunk_frames=1000000):
+  """
+  Concatenates simple HDF files with the same data keys, e.g. the shards written by :class:`SimpleHDFShardedWriter`.
+  The datasets of the output file are not chunked, so :class:`SimpleHDFReader` can memory map them.
+
+  :param list[str] in_filenames: in the order of the output
+  :param str out_filename:
+  :param int chunk_frames: number of frames copied at once
+  """
+  import os
+  all_in_files = [h5py.File(filename, "r") for filename in in_filenames]
+  assert all_in_files
+  # empty files, e.g. of workers without any data, might not have all data keys
+  in_files = [f for f in all_in_files if f["seqLengths"].shape[0] > 0] or all_in_files[:1]
+  first = in_files[0]
+  data_keys = ["inputs"] + (["targets/data/%s" % key for key in first["targets/data"]] if "targets" in first else [])
+  num_seqs = sum(f["seqLengths"].shape[0] for f in in_files)
+  num_frames = {key: 0 for key in data_keys}
+  templates = {}  # key -> dataset of the first file which has it
+  for f in in_files:
+    assert f["seqLengths"].shape[1] == first["seqLengths"].shape[1], "different data keys in %s" % f.filename
+    for key in data_keys:
+      if key in f:
+        num_frames[key] += f[key].shape[0]
+        templates.setdefault(key, f[key])
+
+  tmp_filename = "%s/.%s.merging" % (os.path.dirname(out_filename) or ".", os.path.basename(out_filename))
+  with h5py.File(tmp_filename, "w") as out:
+    for attr in ["inputPattSize", "numDims", "numLabels"]:
+      out.attrs[attr] = first.attrs[attr]
+    out.attrs["numSeqs"] = num_seqs
+    out.attrs["numTimesteps"] = num_frames["inputs"]
+    out.copy(first["labels"], "labels")
+    if "targets" in first:
+      out.create_group("targets/data")
+      out.copy(first["targets/size"], "targets/size")
+      out.copy(first["targets/labels"], "targets/labels")
+    out_seq_lengths = out.create_dataset("seqLengths", (num_seqs, first["seqLengths"].shape[1]), dtype="i")
+    # noinspection PyUnresolvedReferences
+    out_seq_tags = out.create_dataset("seqTags", (num_seqs,), dtype=h5py.special_dtype(vlen=str))
+    out_datasets = {
+      key: out.create_dataset(key, (num_frames[key],) + templates[key].shape[1:], dtype=templates[key].dtype)
+      for key in data_keys if key in templates}
+
+    seq_offset = 0
+    frame_offsets = {key: 0 for key in out_datasets}
+    for f in in_files:
+      n = f["seqLengths"].shape[0]
+      out_seq_lengths[seq_offset:seq_offset + n] = f["seqLengths"][...]
+      out_seq_tags[seq_offset:seq_offset + n] = [
+        tag if isinstance(tag, str) else tag.decode() for tag in f["seqTags"][...]]
+      seq_offset += n
+      for key, out_dataset in out_datasets.items():
+        if key not in f:
+          continue
+        in_dataset = f[key]
+        for start in range(0, in_dataset.shape[0], chunk_frames):
+          chunk = in_dataset[start:start + chunk_frames]
+          out_dataset[frame_offsets[key]:frame_offsets[key] + len(chunk)] = chunk
+          frame_offsets[key] += len(chunk)
+  for f in all_in_files:
+    f.close()
+  os.replace(tmp_filename, out_filename)
+
+
+class SimpleHDFShardedWriter:
+  """
+  Writes the data of multiple processes into a single HDF file without a serial writer:
+  every process writes its own shard with a :class:`SimpleHDFWriter`,
+  and :func:`close` concatenates the shards in the order of their index with :func:`merge_simple_hdf_files`.
+
+  The object can be passed to the worker processes, e.g.::
+
+    writer = SimpleHDFShardedWriter(filename, num_shards=4, dim=80, buffer_size=100)
+    with multiprocessing.Pool(4) as pool:
+      pool.starmap(dump, [(writer, shard_idx) for shard_idx in range(4)])  # calls writer.open_shard(shard_idx)
+    writer.close()
+  """
+
+  def __init__(self, filename, num_shards, **writer_kwargs):
+    """
+    :param str filename: final destination, must not exist
+    :param int num_shards:
+    :param writer_kwargs: passed to :class:`SimpleHDFWriter`
+    """
+    import os
+    assert not os.path.exists(filename)
+    self.filename = filename
+    self.num_shards = num_shards
+    self.writer_kwargs = writer_kwargs
+
+  def get_shard_filename(self, shard_idx):
+    """
+    :param int shard_idx:
+    :rtype: str
+    """
+    import os
+    assert 0 <= shard_idx < self.num_shards
+    return "%s/.%s.shard%i" % (os.path.dirname(self.filename) or ".", os.path.basename(self.filename), shard_idx)
+
+  def open_shard(self, shard_idx):
+    """
+    :param int shard_idx:
+    :return: writer for this shard, the caller has to close it
+    :rtype: SimpleHDFWriter
+    """
+    return SimpleHDFWriter(self.get_shard_filename(shard_idx), **self.writer_kwargs)
+
+  def close(self):
+    """
+    Merges all shards, which must be closed already, and removes them.
+    """
+    import os
+    shard_filenames = [self.get_shard_filename(shard_idx) for shard_idx in range(self.num_shards)]
+    for shard_filename in shard_filenames:
+      assert os.path.exists(shard_filename), "shard %s was not written" % shard_filename
+    merge_simple_hdf_files(shard_filenames, self.filename)
+    for shard_filename in shard_filenames:
+      os.remove(shard_filename)
+
+
 def load_default_data(hdf_filename):
     """
     opens a hdf file an reads the default "data" as numpy array plus the list of sequence tags
@@ -340,3 +508,205 @@ def load_default_data(hdf_filename):
       data_tags.append(tag)
 
     return numpy.array(data_seqs), data_tags
+
+
+def iterate_default_data(hdf_filename, chunk_frames=100000):
+    """
+    streaming version of :func:`load_default_data`, yields one sequence at a time.
+    The "inputs" are read in contiguous chunks of at least chunk_frames frames (or one sequence if longer),
+    so memory stays constant in the size of the file.
+
+    :param str hdf_filename:
+    :param int chunk_frames:
+    :return: generator of (data, tag) tuples
+    """
+    with SimpleHDFReader(hdf_filename, mmap=False, cache_blocks=0) as reader:
+        yield from reader.iterate(chunk_frames=chunk_frames)
+
+
+class SimpleHDFReader:
+  """
+  Random access by sequence tag to a RETURNN simple HDF, as written by :class:`SimpleHDFWriter`.
+
+  The tag -> (offset, length) index is built once from "seqTags" and "seqLengths",
+  the data itself is never loaded completely:
+
+    * uncompressed contiguous datasets are memory mapped (if mmap), so the OS page cache does the caching
+    * otherwise single sequences are served from an LRU cache of blocks of block_frames frames
+    * :func:`get_batch` and :func:`iterate` read neighbouring sequences with a single contiguous read
+
+  The reader can be used like a read-only dict seq_tag -> numpy.ndarray.
+  """
+
+  def __init__(self, filename, data_key="inputs", mmap=True, block_frames=65536, cache_blocks=16):
+    """
+    :param str filename:
+    :param str data_key: "inputs" or a key of "targets/data"
+    :param bool mmap: memory map the data if it is stored uncompressed and contiguous
+    :param int block_frames: frames per block of the LRU cache
+    :param int cache_blocks: number of cached blocks, 0 disables the cache
+    """
+    from collections import OrderedDict
+    self.filename = filename
+    self.data_key = data_key
+    self.block_frames = block_frames
+    self.cache_blocks = cache_blocks
+    self._file = h5py.File(filename, "r")
+    if data_key == "inputs":
+      self._dataset = self._file["inputs"]
+      data_key_idx = 0
+    else:
+      self._dataset = self._file["targets/data"][data_key]
+      # see SimpleHDFWriter: data_key_idx == 1 + sorted(extra keys).index(data_key)
+      data_key_idx = 1 + sorted(self._file["targets/data"].keys()).index(data_key)
+
+    self.tags = [tag if isinstance(tag, str) else tag.decode() for tag in self._file["seqTags"][...]]
+    self.lengths = self._file["seqLengths"][:, data_key_idx].astype("int64")
+    self.offsets = numpy.concatenate([[0], numpy.cumsum(self.lengths)])
+    self._tag_to_idx = {tag: idx for idx, tag in enumerate(self.tags)}
+
+    self._mmap = None
+    if mmap:
+      self._mmap = self._try_mmap()
+    self._cache = OrderedDict()  # type: typing.OrderedDict[int, numpy.ndarray]  # block idx -> data
+
+  def _try_mmap(self):
+    """
+    :return: memory map of the dataset, or None if it is chunked, compressed or empty
+    :rtype: numpy.memmap|None
+    """
+    dset = self._dataset
+    if dset.chunks is not None or dset.compression is not None or dset.dtype.hasobject:
+      return None
+    file_offset = dset.id.get_offset()
+    if file_offset is None or dset.size == 0:
+      return None
+    return numpy.memmap(self.filename, dtype=dset.dtype, mode="r", offset=file_offset, shape=dset.shape)
+
+  @property
+  def shape(self):
+    """
+    :return: shape of the flattened data, i.e. (total frames, ...)
+    :rtype: tuple[int]
+    """
+    return self._dataset.shape
+
+  def __len__(self):
+    return len(self.tags)
+
+  def __iter__(self):
+    return iter(self.tags)
+
+  def __contains__(self, tag):
+    return tag in self._tag_to_idx
+
+  def __getitem__(self, tag):
+    return self.get_by_index(self._tag_to_idx[tag])
+
+  def keys(self):
+    """
+    :rtype: list[str]
+    """
+    return list(self.tags)
+
+  def get_by_index(self, seq_idx):
+    """
+    :param int seq_idx:
+    :rtype: numpy.ndarray
+    """
+    start, end = int(self.offsets[seq_idx]), int(self.offsets[seq_idx + 1])
+    if self._mmap is not None:
+      return numpy.array(self._mmap[start:end])
+    if not self.cache_blocks or end == start or end - start >= self.block_frames:
+      return self._dataset[start:end]
+    parts = []
+    for block_idx in range(start // self.block_frames, (end - 1) // self.block_frames + 1):
+      block = self._get_block(block_idx)
+      block_start = block_idx * self.block_frames
+      parts.append(block[max(start - block_start, 0):end - block_start])
+    return parts[0].copy() if len(parts) == 1 else numpy.concatenate(parts)
+
+  def _get_block(self, block_idx):
+    """
+    :param int block_idx:
+    :rtype: numpy.ndarray
+    """
+    if block_idx in self._cache:
+      self._cache.move_to_end(block_idx)
+      return self._cache[block_idx]
+    block = self._dataset[block_idx * self.block_frames:(block_idx + 1) * self.block_frames]
+    self._cache[block_idx] = block
+    if len(self._cache) > self.cache_blocks:
+      self._cache.popitem(last=False)
+    return block
+
+  def _read_range(self, start, end):
+    """
+    :param int start: frame offset
+    :param int end: frame offset
+    :rtype: numpy.ndarray
+    """
+    if self._mmap is not None:
+      return numpy.array(self._mmap[start:end])
+    return self._dataset[start:end]
+
+  def get_batch(self, tags, max_gap_frames=0):
+    """
+    Reads multiple sequences, where sequences which are (nearly) neighbours in the file are read at once.
+
+    :param list[str] tags:
+    :param int max_gap_frames: also merge reads of sequences which are up to this many frames apart
+    :return: data in the order of tags
+    :rtype: list[numpy.ndarray]
+    """
+    seq_idxs = [self._tag_to_idx[tag] for tag in tags]
+    res = [None] * len(seq_idxs)  # type: typing.List[typing.Optional[numpy.ndarray]]
+    order = sorted(range(len(seq_idxs)), key=lambda i: self.offsets[seq_idxs[i]])
+    group = []  # positions in seq_idxs
+    for pos in order + [None]:
+      if group and (pos is None or self.offsets[seq_idxs[pos]] - self.offsets[seq_idxs[group[-1]] + 1] > max_gap_frames):
+        start = int(self.offsets[seq_idxs[group[0]]])
+        end = int(max(self.offsets[seq_idxs[i] + 1] for i in group))
+        chunk = self._read_range(start, end)
+        for i in group:
+          res[i] = chunk[self.offsets[seq_idxs[i]] - start:self.offsets[seq_idxs[i] + 1] - start]
+        group = []
+      if pos is not None:
+        group.append(pos)
+    return res
+
+  def iterate(self, chunk_frames=100000):
+    """
+    Iterates over all sequences in the order of the file,
+    reading contiguous chunks of at least chunk_frames frames (or one sequence if longer).
+
+    :param int chunk_frames:
+    :return: generator of (data, tag) tuples
+    """
+    seq_idx = 0
+    num_seqs = len(self.tags)
+    while seq_idx < num_seqs:
+      end_idx = seq_idx + 1
+      while end_idx < num_seqs and self.offsets[end_idx + 1] - self.offsets[seq_idx] <= chunk_frames:
+        end_idx += 1
+      chunk_start = int(self.offsets[seq_idx])
+      chunk = self._read_range(chunk_start, int(self.offsets[end_idx]))
+      for idx in range(seq_idx, end_idx):
+        yield chunk[self.offsets[idx] - chunk_start:self.offsets[idx + 1] - chunk_start], self.tags[idx]
+      seq_idx = end_idx
+
+  def close(self):
+    """
+    Closes the file.
+    """
+    self._mmap = None
+    self._cache.clear()
+    if self._file:
+      self._file.close()
+      self._file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
@@ -8,7 +8,56 @@ from i6_core.lib.hdf import get_returnn_simple_hdf_writer, get_input_dict_from_r
 from i6_core.lib.rasr_cache import FileArchive
 from i6_core.lib.corpus import Corpus
 
-from i6_experiments.users.rossenbach.lib.hdf import load_default_data
+from i6_experiments.users.rossenbach.lib.hdf import iterate_default_data
+
+
+def alignment_to_durations(alignment, skip_token):
+    """
+    Run-length encoding of a label alignment.
+    A new label starts wherever the label changes, the skip token is merged into the preceding label,
+    which means the same label before and after a skip token becomes two labels, e.g. [1,skip_token,1] -> [1,1].
+
+    :param numpy.ndarray alignment: shape (time,)
+    :param int skip_token:
+    :return: durations, shape (num_labels,)
+    :rtype: numpy.ndarray
+    """
+    if len(alignment) == 0:
+        return numpy.zeros((0,), dtype=numpy.int32)
+    assert alignment[0] != skip_token, "alignment can not start with the skip token"
+    is_start = numpy.concatenate([[True], alignment[1:] != alignment[:-1]]) & (alignment != skip_token)
+    starts = numpy.flatnonzero(is_start)
+    return numpy.diff(numpy.append(starts, len(alignment))).astype(numpy.int32)
+
+
+def write_durations_hdf(filename, returnn_root, tagged_durations, batch_size=1000):
+    """
+    Writes duration sequences with the RETURNN SimpleHDFWriter, batch_size sequences per insert_batch call.
+
+    :param str filename:
+    :param tk.Path|str|None returnn_root:
+    :param Iterable[tuple[str, numpy.ndarray]] tagged_durations: (tag, durations) pairs, consumed lazily
+    :param int batch_size:
+    """
+    SimpleHDFWriter = get_returnn_simple_hdf_writer(returnn_root)
+    writer = SimpleHDFWriter(filename, dim=1, ndim=2)
+    batch = []
+
+    def flush():
+        lengths = [len(durations) for _, durations in batch]
+        data = numpy.zeros((len(batch), max(lengths), 1), dtype=numpy.int32)
+        for i, (_, durations) in enumerate(batch):
+            data[i, :len(durations), 0] = durations
+        writer.insert_batch(data, lengths, [tag for tag, _ in batch])
+        batch.clear()
+
+    for tag, durations in tagged_durations:
+        batch.append((tag, durations))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    writer.close()
 
 
 class ViterbiAlignmentToDurationsJob(Job):
@@ -25,6 +74,7 @@ class ViterbiAlignmentToDurationsJob(Job):
             dataset_to_check=None,
             time_rqmt=2,
             mem_rqmt=4,
+            write_batch_size=1000,
     ):
         """
         :param Path viterbi_alignment: Path to the alignment HDF produced by CTC/Viterbi
@@ -33,12 +83,14 @@ class ViterbiAlignmentToDurationsJob(Job):
         :param blank_token: Value of the blank token in CTC, or the phoneme string of the lexicon.
             Will use the last phoneme-inventory index if not provided.
         :param tk.Path|None dataset_to_check:
+        :param int write_batch_size: number of sequences written to the HDF at once
         """
         self.viterbi_alignment_hdf = viterbi_alignment_hdf
         self.bliss_lexicon = bliss_lexicon
         self.returnn_root = returnn_root
         self.blank_token = blank_token
         self.check = dataset_to_check
+        self.write_batch_size = write_batch_size
         self.out_durations_hdf = self.output_path("durations.hdf")
         self.rqmt = {"time": time_rqmt, "mem": mem_rqmt}
 
@@ -46,10 +98,6 @@ class ViterbiAlignmentToDurationsJob(Job):
         yield Task("run", rqmt=self.rqmt)
 
     def run(self):
-        # Load HDF data
-        alignment, tags = load_default_data(self.viterbi_alignment_hdf.get_path())
-        durations_total = []
-
         lex = lexicon.Lexicon()
         lex.load(self.bliss_lexicon.get_path())
         if isinstance(self.blank_token, str):
@@ -60,49 +108,30 @@ class ViterbiAlignmentToDurationsJob(Job):
             assert self.blank_token is None
             skip_token = len(lex.phonemes) - 1
 
-        # sort based on tags
+        # both files are read sequence by sequence
+        alignments = iterate_default_data(self.viterbi_alignment_hdf.get_path())
         if self.check is not None:
-            check, check_tag = load_default_data(self.check.get_path())
-
-        # Alignemnt to duration conversion
-        for alignment_idx, s in enumerate(alignment):
-            durations = []
-            for idx, p in enumerate(s):
-                # Skip_token only appears now if 2 labels following each other are the same.
-                #   Example [1,skip_token,1] -> [1,1]
-                if p == skip_token:
-                    durations[-1] += 1
-                    continue
-                if idx != 0 and s[idx] != s[idx - 1]:
-                    durations.append(1)
-                elif idx != 0 and s[idx] == s[idx - 1]:
-                    durations[-1] += 1
-                else:
-                    durations.append(1)
-            # Check if lengths match if dataset is provided
-            if self.check is not None:
-                assert sum(durations) == len(check[alignment_idx]), (
-                    f"durations {sum(durations)} and spectrogram length {len(check[alignment_idx])}"
-                    f"do not match in length "
-                )
-            durations_total.append(durations)
-
-        # Dump into HDF
-        new_lengths = []
-        for seq in durations_total:
-            new_lengths.append([len(seq), 2, 2])
-        duration_sequence = numpy.hstack(durations_total).astype(numpy.int32)
-        dim = 1
-        hdf_writer = get_returnn_simple_hdf_writer(self.returnn_root)
-        writer = hdf_writer(self.out_durations_hdf.get_path(), dim=dim, ndim=2)
-        offset = 0
-        for tag, length in zip(tags, new_lengths):
-            in_data = duration_sequence[offset : offset + length[0]]
-            in_data = numpy.expand_dims(in_data, axis=1)
-            offset += length[0]
-            writer.insert_batch(numpy.asarray([in_data]), [in_data.shape[0]], [tag])
+            checks = iterate_default_data(self.check.get_path())
+        else:
+            checks = None
+
+        def tagged_durations():
+            # Alignemnt to duration conversion
+            for alignment, tag in alignments:
+                durations = alignment_to_durations(numpy.asarray(alignment).reshape(-1), skip_token)
+                # Check if lengths match if dataset is provided
+                if checks is not None:
+                    check, _ = next(checks)
+                    assert sum(durations) == len(check), (
+                        f"durations {sum(durations)} and spectrogram length {len(check)}"
+                        f"do not match in length "
+                    )
+                yield tag, durations
+
+        write_durations_hdf(
+            self.out_durations_hdf.get_path(), self.returnn_root, tagged_durations(), batch_size=self.write_batch_size
+        )
         print(f"Succesfully converted durations into {(self.out_durations_hdf.get_path())}")
-        writer.close()
 
     @classmethod
     def hash(cls, parsed_args):
@@ -163,68 +192,104 @@ class ExtractDurationsFromRASRAlignmentJob(Job):
   def tasks(self):
     yield Task("run", rqmt=self.rqmt)
 
+  def durations_and_labels(self, key, alignment, allophones, difference):
+    """
+    Computes the duration sequence and the matching label sequence of a single rasr alignment.
+    The alignment is processed per run of identical allophones instead of per frame.
+
+    :param str key: segment name
+    :param list[tuple] alignment: as read from the FileArchive
+    :param list[str] allophones:
+    :param int difference: number of frames the alignment is longer than the target durations
+    :return: durations including the start/end token and the labels
+    :rtype: tuple[numpy.ndarray, list[str]]
+    """
+    times = numpy.array([a[0] for a in alignment])
+    allophone_ids = numpy.array([a[1] for a in alignment])
+    run_starts = numpy.flatnonzero(numpy.concatenate([[True], allophone_ids[1:] != allophone_ids[:-1]]))
+    run_lengths = numpy.diff(numpy.append(run_starts, len(alignment)))
+
+    seq = []
+    gmm_seq = []
+    start_time = 0
+    space_insert = False
+    # Start computing duration sequence from rasr alignment
+    last_allophone = None
+    for run_start, run_length in zip(run_starts.tolist(), run_lengths.tolist()):
+      time = int(times[run_start])
+      allophone = allophones[allophone_ids[run_start]]
+      phoneme = allophone.split("{", 1)[0].rstrip()
+      # new sequence has boundary instead of silence token
+      if phoneme == self.silence_token:
+        phoneme = self.boundary_token
+      # start of sequence
+      if len(gmm_seq) == 0:
+        gmm_seq.append(phoneme)
+      # within phoneme or silence
+      elif allophone == last_allophone:
+        space_insert = False
+      # Insert word boundary token between words where there is no silence
+      elif (
+        self.boundary_token not in gmm_seq[-1]
+        and allophone != last_allophone
+        and "@i" in allophone
+        and phoneme != self.boundary_token
+      ):
+        seq.append(time - start_time)
+        gmm_seq.append(self.boundary_token)
+        seq.append(0)
+        space_insert = True
+        start_time = time
+        gmm_seq.append(phoneme)
+      # new phoneme but no word boundary
+      elif allophone != last_allophone and space_insert is False:
+        gmm_seq.append(phoneme)
+        seq.append(time - start_time)
+        start_time = time
+      else:
+        assert False, "Check your data, this should not be reached!"
+      last_allophone = allophone
+      if run_length > 1:
+        # all further frames of the run are within phoneme or silence
+        space_insert = False
+    # Add duration of last token
+    seq.append(len(alignment) - start_time - difference)
+    # Assert that number of durations fit the given alignment
+    assert len(alignment) == (sum(seq) + difference), (
+      key,
+      len(alignment),
+      sum(seq),
+    )
+    # manually add start/end token with duration 0
+    seq = numpy.insert(seq, 0, 0)
+    seq = numpy.append(seq, 0)
+    gmm_seq.append(self.end_token)
+    gmm_seq.insert(0, self.start_token)
+
+    # Assert that the number of labels fit the number of tokens in the duration sequence
+    assert len(seq) == len(gmm_seq), (key, alignment, len(seq), len(gmm_seq))
+    return seq, gmm_seq
+
   def run(self):
-    durations = []
-    tags = []
     full_corpus_labels = {}
     empty_aligns = []
     if self.target_duration_hdf is not None:
       hdf_file = h5py.File(self.target_duration_hdf, "r")
       returnn_length_dict = get_input_dict_from_returnn_hdf(hdf_file=hdf_file)
-    if self.align.get_path().endswith(".bundle"):
+
+    def tagged_durations():
+      if not self.align.get_path().endswith(".bundle"):
+        return
       files = open(self.align.get_path(), "rt")
       for cache in files:
         sprint_cache = FileArchive(cache.strip())
         sprint_cache.setAllophones(self.rasr_allophones.get_path())
         keys = [str(s) for s in sprint_cache.ft if not str(s).endswith(".attribs")]
         for key in keys:
-          seq = []
-          gmm_seq = []
-          tags.append(key)
-          start_time = 0
-          space_insert = False
-          alignment = [
-            (a[0], sprint_cache.allophones[a[1]])
-            for a in sprint_cache.read(key, "align")
-          ]
-          # Start computing duration sequence from rasr alignment
-          last_allophone = None
+          alignment = sprint_cache.read(key, "align")
           if len(alignment) == 0:
             empty_aligns.append(key)
             continue
-          for time, allophone in alignment:
-            phoneme = allophone.split("{", 1)[0].rstrip()
-            # new sequence has boundary instead of silence token
-            if phoneme == self.silence_token:
-              phoneme = self.boundary_token
-            # start of sequence
-            if len(gmm_seq) == 0:
-              gmm_seq.append(phoneme)
-            # within phoneme or silence
-            elif allophone == last_allophone:
-              space_insert = False
-            # Insert word boundary token between words where there is no silence
-            elif (
-              self.boundary_token not in gmm_seq[-1]
-              and allophone != last_allophone
-              and "@i" in allophone
-              and phoneme != self.boundary_token
-            ):
-              seq.append(time - start_time)
-              gmm_seq.append(self.boundary_token)
-              seq.append(0)
-              space_insert = True
-              start_time = time
-              gmm_seq.append(phoneme)
-            # new phoneme but no word boundary
-            elif allophone != last_allophone and space_insert is False:
-              gmm_seq.append(phoneme)
-              seq.append(time - start_time)
-              start_time = time
-            else:
-              assert False, "Check your data, this should not be reached!"
-            last_allophone = allophone
-          # Add duration of last token
           if self.target_duration_hdf is not None:
             # take the difference between returnn feature extraction and rasr feature extraction in account
             difference = len(alignment) - returnn_length_dict[key]
@@ -235,42 +300,13 @@ class ExtractDurationsFromRASRAlignmentJob(Job):
             )
           else:
             difference = 0
-          seq.append(len(alignment) - start_time - difference)
-          # Assert that number of durations fit the given alignment
-          assert len(alignment) == (sum(seq) + difference), (
-            key,
-            len(alignment),
-            sum(seq),
-          )
-          # manually add start/end token with duration 0
-          seq = numpy.insert(seq, 0, 0)
-          seq = numpy.append(seq, 0)
-          gmm_seq.append(self.end_token)
-          gmm_seq.insert(0, self.start_token)
-
-          # Create new labels for corpus
-          corpus_labels = gmm_seq
-          # Assert that the number of labels fit the number of tokens in the duration sequence
-          assert len(seq) == len(corpus_labels), (key, alignment, len(seq), len(corpus_labels))
-          durations.append(seq)
-          full_corpus_labels[key] = corpus_labels
-
-    # Write durations to hdf file
+          seq, gmm_seq = self.durations_and_labels(key, alignment, sprint_cache.allophones, difference)
+          full_corpus_labels[key] = gmm_seq
+          yield key, seq
+
+    # Write durations to hdf file while reading the alignment
+    write_durations_hdf(self.out_durations_hdf.get_path(), self.returnn_root.get_path(), tagged_durations())
     assert len(empty_aligns) == 0, (len(empty_aligns), empty_aligns)
-    new_lengths = []
-    for seq in durations:
-      new_lengths.append([len(seq), 2, 2])
-    duration_sequence = numpy.hstack(durations).astype(numpy.int32)
-    dim = 1
-    SimpleHDFWriter = get_returnn_simple_hdf_writer(self.returnn_root.get_path())
-    writer = SimpleHDFWriter(self.out_durations_hdf.get_path(), dim=dim, ndim=2)
-    offset = 0
-    for tag, length in zip(tags, new_lengths):
-      in_data = duration_sequence[offset : offset + length[0]]
-      in_data = numpy.expand_dims(in_data, axis=1)
-      offset += length[0]
-      writer.insert_batch(numpy.asarray([in_data]), [in_data.shape[0]], [tag])
-    writer.close()
 
     # Write new labels into the corpus such that label sequence fits the duration sequence
     bliss_corpus = Corpus()
@@ -2,8 +2,8 @@ from sisyphus import *
 import numpy
 import pickle
 
+from i6_experiments.users.rossenbach.lib.corpus_index import open_bliss_corpus_index
 from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFWriter
-from i6_core.lib import corpus
 from i6_core.util import uopen
 
 
@@ -15,7 +15,7 @@ class SpeakerLabelHDFFromBliss(Job):
 
     def __init__(self, bliss_corpus: tk.Path):
         """
-        :param bliss_corpus:
+        :param bliss_corpus: corpus xml or index of :class:`BuildBlissCorpusIndexJob`
         """
         self.bliss_corpus = bliss_corpus
         self.out_speaker_hdf = self.output_path("speaker_labels.hdf")
@@ -27,25 +27,25 @@ class SpeakerLabelHDFFromBliss(Job):
 
     def run(self):
 
-        bliss = corpus.Corpus()
-        bliss.load(self.bliss_corpus.get_path())
+        bliss = open_bliss_corpus_index(self.bliss_corpus.get_path())
         speaker_by_index = {}
-        index_by_speaker = {}
         num_speakers = len(bliss.speakers)
         self.out_num_speakers.set(num_speakers)
-        for i, speaker in enumerate(bliss.all_speakers()):
-            speaker_by_index[i] = speaker.name
-            index_by_speaker[speaker.name] = i
+        for i, speaker_name in enumerate(bliss.speakers):
+            speaker_by_index[i] = speaker_name
 
         pickle.dump(speaker_by_index, uopen(self.out_speaker_dict, "wb"))
 
-        hdf_writer = SimpleHDFWriter(self.out_speaker_hdf.get_path(), dim=num_speakers, ndim=1)
-
-        for recording in bliss.all_recordings():
-            for segment in recording.segments:
-                speaker_name = segment.speaker_name or recording.speaker_name
-                speaker_index = index_by_speaker[speaker_name]
-                segment_name = "/".join([bliss.name, recording.name, segment.name])
-                hdf_writer.insert_batch(numpy.asarray([[speaker_index]], dtype="int32"), [1], [segment_name])
+        hdf_writer = SimpleHDFWriter(
+            self.out_speaker_hdf.get_path(), dim=num_speakers, ndim=1, buffer_size=1000, preallocate=True
+        )
+
+        for seg_idx in range(len(bliss)):
+            segment_name = bliss.get_segment_name(seg_idx)
+            speaker_index = int(bliss.speaker_idxs[seg_idx])
+            assert speaker_index >= 0, "no speaker for %s" % segment_name
+            # seq tag is corpus/recording/segment also for nested corpora, i.e. without the subcorpus names
+            seq_tag = "/".join([bliss.name] + segment_name.split("/")[-2:])
+            hdf_writer.insert_batch(numpy.asarray([[speaker_index]], dtype="int32"), [1], [seq_tag])
 
         hdf_writer.close()
\ No newline at end of file
@@ -1,8 +1,4 @@
 import errno
-import gc
-import glob
-import shutil
-import tempfile
 
 import numpy as np
 import os
@@ -18,6 +14,9 @@ from i6_core.lib import corpus as bliss_corpus
 
 class PhaseReconstructor():
 
+    # backends which reconstruct a whole batch of spectrograms at once
+    batch_backends = ['numpy_batch', 'torch_batch']
+
     def __init__(self, out_folder,
                  backend,
                  sample_rate,
@@ -32,7 +31,7 @@ class PhaseReconstructor():
         """
 
         :param str out_folder:
-        :param str backend:
+        :param str backend: legacy/numpy, librosa or one of batch_backends
         :param int sample_rate:
         :param float window_shift:
         :param float window_size:
@@ -61,6 +60,8 @@ class PhaseReconstructor():
             self.reconstruct_function = self.griffin_lim
         elif self.backend in ['librosa']:
             self.reconstruct_function = self.librosa_griffin_lim
+        elif self.backend in self.batch_backends:
+            self.reconstruct_function = self.griffin_lim_batch
         else:
             assert False, "invalid backend: %s" % self.backend
 
@@ -110,6 +111,63 @@ class PhaseReconstructor():
                                   hop_length=int(self.sample_rate*self.window_shift),
                                   win_length=int(self.sample_rate*self.window_size),)
 
+    def griffin_lim_batch(self, spectrograms):
+        """
+        Griffin-Lim on multiple spectrograms at once, which are zero-padded to the longest one
+        and processed as a single complex64 array (numpy_batch, using librosa) or tensor (torch_batch).
+
+        :param list[np.array] spectrograms: each of shape (n_fft/2 + 1, time)
+        :return: waveforms, each cut to the length of its spectrogram
+        :rtype: list[np.array]
+        """
+        hop_length = int(self.sample_rate*self.window_shift)
+        win_length = int(self.sample_rate*self.window_size)
+        lengths = [spectrogram.shape[1] for spectrogram in spectrograms]
+        magnitudes = np.zeros((len(spectrograms), spectrograms[0].shape[0], max(lengths)), dtype=np.float32)
+        for i, spectrogram in enumerate(spectrograms):
+            magnitudes[i, :, :lengths[i]] = np.abs(spectrogram)
+
+        if self.backend == 'torch_batch':
+            waveforms = self._torch_griffin_lim_batch(magnitudes, hop_length, win_length)
+        else:
+            waveforms = self._numpy_griffin_lim_batch(magnitudes, hop_length, win_length)
+
+        return [waveform[:hop_length * (length - 1)].astype(np.float64) for waveform, length in zip(waveforms, lengths)]
+
+    def _numpy_griffin_lim_batch(self, magnitudes, hop_length, win_length):
+        import librosa
+
+        def istft(stft_matrix):
+            return librosa.istft(stft_matrix=stft_matrix, hop_length=hop_length, win_length=win_length,
+                                 n_fft=self.n_fft, dtype=np.float32)
+
+        complex_magnitudes = magnitudes.astype(np.complex64)
+        angles = np.exp(2j * np.pi * np.random.rand(*magnitudes.shape)).astype(np.complex64)
+        waveforms = istft(complex_magnitudes * angles)
+        for i in range(self.iterations):
+            stft_matrix = librosa.stft(y=waveforms, n_fft=self.n_fft, hop_length=hop_length, win_length=win_length,
+                                       pad_mode='constant')
+            angles = np.exp(1j * np.angle(stft_matrix)).astype(np.complex64)
+            waveforms = istft(complex_magnitudes * angles)
+        return waveforms
+
+    def _torch_griffin_lim_batch(self, magnitudes, hop_length, win_length):
+        import torch
+        # the conversion runs in a worker pool already
+        torch.set_num_threads(1)
+
+        window = torch.hann_window(win_length)
+        stft_args = dict(n_fft=self.n_fft, hop_length=hop_length, win_length=win_length, window=window, center=True)
+        with torch.no_grad():
+            magnitudes = torch.from_numpy(magnitudes)
+            angles = torch.polar(torch.ones_like(magnitudes), 2 * np.pi * torch.rand_like(magnitudes))
+            waveforms = torch.istft(magnitudes * angles, **stft_args)
+            for i in range(self.iterations):
+                stft_matrix = torch.stft(waveforms, pad_mode='constant', return_complex=True, **stft_args)
+                angles = torch.polar(torch.ones_like(magnitudes), torch.angle(stft_matrix))
+                waveforms = torch.istft(magnitudes * angles, **stft_args)
+        return waveforms.numpy()
+
 
     def convert(self, data_tuple):
         """
@@ -120,25 +178,53 @@ class PhaseReconstructor():
         """
         tag = data_tuple[0]
         print("reconstructing phase for %s" % tag)
-        lin_spec = data_tuple[1]
+        lin_spec = self._prepare_spectrogram(data_tuple[1])
 
-        # in compliance with the bliss format, create folders if tag is seperated by slashes
-        if "/" in tag:
-            tag_split = tag.split("/")
-            folder = "/".join(tag_split[:-1])
-            print("create folder %s" % folder)
-            mkdir_p(self.out_folder + "/" + folder)
+        waveform = self.reconstruct_function(lin_spec)
+
+        return self._finalize(tag, lin_spec, waveform)
+
+    def convert_batch(self, data_tuples):
+        """
+        perform the conversion for a list of (tag, spectrogram) tuples,
+        as one batch for the batch_backends and one by one otherwise
 
-        # if
+        :param list[tuple(str, np.array)] data_tuples:
+        :return: one result of :func:`convert` per tuple
+        :rtype: list
+        """
+        if self.backend not in self.batch_backends:
+            return [self.convert(data_tuple) for data_tuple in data_tuples]
+
+        tags = [data_tuple[0] for data_tuple in data_tuples]
+        print("reconstructing phase for %s" % ", ".join(tags))
+        lin_specs = [self._prepare_spectrogram(data_tuple[1]) for data_tuple in data_tuples]
+
+        waveforms = self.griffin_lim_batch(lin_specs)
+
+        return [self._finalize(tag, lin_spec, waveform) for tag, lin_spec, waveform in zip(tags, lin_specs, waveforms)]
+
+    def _prepare_spectrogram(self, lin_spec):
         spec_width = int(self.n_fft/2)
         if lin_spec.shape[0] == spec_width:
             lin_spec = np.pad(lin_spec, ((1,0),(0,0)), mode='constant', constant_values=0)
         elif lin_spec.shape[0] == spec_width + 1:
-            lin_spec = lin_spec[0, :] = 0
+            lin_spec = lin_spec.copy()
+            lin_spec[0, :] = 0
         else:
             assert False, "invalid feature shape %i in data, n_fft/2 is %i" % (lin_spec.shape[0], spec_width)
+        return lin_spec
 
-        waveform = self.reconstruct_function(lin_spec)
+    def _finalize(self, tag, lin_spec, waveform):
+        """
+        store the waveform and create the corpus entry
+        """
+        # in compliance with the bliss format, create folders if tag is seperated by slashes
+        if "/" in tag:
+            tag_split = tag.split("/")
+            folder = "/".join(tag_split[:-1])
+            print("create folder %s" % folder)
+            mkdir_p(self.out_folder + "/" + folder)
 
         if self.preemphasis != 0:
             waveform = self.inv_preemphasis(waveform)
@@ -226,19 +312,21 @@ def save_ogg(wav, path, sr, peak_normalization=True):
 
 class HDFPhaseReconstruction(Job):
 
-    __sis_hash_exclude__ = {"peak_normalization": True}
+    __sis_hash_exclude__ = {"peak_normalization": True, "batch_size": 16, "bucket_frames": 50}
 
     def __init__(self, hdf_file, backend, iterations, sample_rate, window_shift, window_size, preemphasis, file_format, peak_normalization=True,
-                 time_rqmt=8, mem_rqmt=8, cpu_rqmt=4):
+                 time_rqmt=8, mem_rqmt=8, cpu_rqmt=4, batch_size=16, bucket_frames=50):
         """
 
         :param tk.Path hdf_file:
-        :param str backend:
+        :param str backend: see :class:`PhaseReconstructor`
         :param int iterations:
         :param int sample_rate:
         :param float window_shift:
         :param float window_size:
         :param str file_format:
+        :param int batch_size: number of spectrograms per batch for the batch backends
+        :param int bucket_frames: spectrograms are only batched with others of the same length // bucket_frames
         """
         self.hdf_file = hdf_file
         self.backend = backend
@@ -249,6 +337,8 @@ class HDFPhaseReconstruction(Job):
         self.preemphasis = preemphasis
         self.file_format = file_format
         self.peak_normalization = peak_normalization
+        self.batch_size = batch_size
+        self.bucket_frames = bucket_frames
 
         self.out_folder = self.output_path("corpus", directory=True)
         self.out_corpus = self.output_path("corpus/corpus.xml.gz")
@@ -260,18 +350,16 @@ class HDFPhaseReconstruction(Job):
 
 
     def run(self):
-        import h5py
+        from collections import defaultdict, deque
+        from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader
 
-        temp_dir = tempfile.TemporaryDirectory(prefix="hdf_reconstruction_")
-        ref_linear_data = h5py.File(self.hdf_file.get_path(), 'r')
-        rl_inputs = ref_linear_data['inputs']
-        rl_tags = ref_linear_data['seqTags']
-        rl_lengths = ref_linear_data['seqLengths']
+        ref_linear_data = SimpleHDFReader(self.hdf_file.get_path(), cache_blocks=0)
 
-        n_fft = rl_inputs[0].shape[0]*2
+        n_fft = ref_linear_data.shape[1]*2
         print("N_FFT from HDF: % i" % n_fft)
 
-        converter = PhaseReconstructor(out_folder=temp_dir.name,
+        # write the audio files directly to their final location, so the corpus needs no path replacement
+        converter = PhaseReconstructor(out_folder=self.out_folder.get_path(),
                                        backend=self.backend,
                                        sample_rate=self.sample_rate,
                                        window_shift=self.window_shift,
@@ -282,54 +370,57 @@ class HDFPhaseReconstruction(Job):
                                        peak_normalization=self.peak_normalization,
                                        file_format=self.file_format,
                                        corpus_format="bliss")
-
+        batch_size = self.batch_size if self.backend in PhaseReconstructor.batch_backends else 1
+
+        # H5py has issues with multithreaded loading, so the spectrograms are read in the main process,
+        # which waits for the oldest batch when too many batches are in flight.
+        max_in_flight = 2 * self.rqmt['cpu']
+        tags = []
+
+        def batches():
+            buckets = defaultdict(list)
+            for spectrogram, tag in ref_linear_data.iterate():
+                tags.append(tag)
+                bucket = buckets[len(spectrogram) // self.bucket_frames]
+                # copy, so the bucket does not keep the whole read chunk alive
+                bucket.append((tag, np.array(spectrogram).T))
+                if len(bucket) >= batch_size:
+                    yield list(bucket)
+                    bucket.clear()
+            # process rest in the buckets
+            for bucket in buckets.values():
+                if len(bucket) > 0:
+                    yield bucket
+
+        recordings = {}
+
+        def collect(async_result):
+            # get() re-raises the exception of a failed worker, the pool is then terminated when leaving the with
+            for recording in async_result.get():
+                recordings[recording.name + "/" + recording.segments[0].name] = recording
+
+        with multiprocessing.Pool(self.rqmt['cpu']) as p:
+            in_flight = deque()
+            for batch in batches():
+                in_flight.append(p.apply_async(converter.convert_batch, (batch,)))
+                while in_flight and (len(in_flight) >= max_in_flight or in_flight[0].ready()):
+                    collect(in_flight.popleft())
+            while in_flight:
+                collect(in_flight.popleft())
+        ref_linear_data.close()
+
+        # put all recordings to the corpus in the order of the hdf
         corpus = bliss_corpus.Corpus()
+        for tag in tags:
+            corpus.add_recording(recordings["/".join(tag.split("/")[1:])])
 
-
-        # H5py has issues with multithreaded loading, so buffer 512 spectograms
-        # single threaded and then distribute to the workers for conversion
-
-        p = multiprocessing.Pool(self.rqmt['cpu'])
-
-        loaded_spectograms = []
-        offset = 0
-        for tag, length in zip(rl_tags, rl_lengths):
-            tag = tag if isinstance(tag, str) else tag.decode()
-            loaded_spectograms.append((tag, np.asarray(rl_inputs[offset:offset + length[0]]).T))
-            offset += length[0]
-            if len(loaded_spectograms) > 512:
-                recordings = p.map(converter.convert, loaded_spectograms)
-
-                for recording in recordings:
-                    corpus.add_recording(recording)
-
-                # force gc for minimal memory requirement
-                del loaded_spectograms
-                gc.collect()
-                loaded_spectograms = []
-
-        # process rest in the buffer
-        if len(loaded_spectograms) > 0:
-            recordings = p.map(converter.convert, loaded_spectograms)
-            # put all recordings to the corpus
-            for recording in recordings:
-                corpus.add_recording(recording)
-
-        corpus.name = tag.split("/")[0]
+        corpus.name = tags[-1].split("/")[0]
         print("dump corpus")
-        corpus.dump("corpus.xml")
-        replacement_string = "s:%s:%s:g" % (temp_dir.name, self.out_folder.get_path())
-        subprocess.call(["sed", "-i", replacement_string, "corpus.xml"])
-        subprocess.call(["gzip", "corpus.xml"])
-        print("copy temp files to output")
-        for path in glob.glob(temp_dir.name + "/*"):
-            print(f"copy {path} to {self.out_folder.get_path()}")
-            shutil.move(path, self.out_folder.get_path())
-        shutil.move("corpus.xml.gz", self.out_corpus.get_path())
+        corpus.dump(self.out_corpus.get_path())
         print("done")
 
     @classmethod
     def hash(cls, kwargs):
         kwargs.pop('time_rqmt')
         kwargs.pop('mem_rqmt')
-        return super().hash(kwargs)
\ No newline at end of file
+        return super().hash(kwargs)
@@ -2,7 +2,7 @@ from sisyphus import *
 
 import ast
 import numpy as np
-import h5py
+from i6_experiments.users.rossenbach.lib.hdf import SimpleHDFReader
 from typing import Optional, Dict
 
 
@@ -39,24 +39,12 @@ class CalcSearchErrorJobV2(Job):
   @staticmethod
   def load_hdf_data(hdf_path: Path):
     """
-    Load data from an hdf file. Returns dict of form {seq_tag: data}
+    Load data from an hdf file. Returns dict-like reader of form {seq_tag: data},
+    which only reads the data of a seq tag when it is accessed. Needs to be closed after reading.
     :param hdf_path:
     :return:
     """
-    with h5py.File(hdf_path.get_path(), "r") as f:
-      seq_tags = f["seqTags"][()]
-      seq_tags = [tag.decode("utf8") if isinstance(tag, bytes) else tag for tag in seq_tags]  # convert from byte to string
-      data_dict = {}
-
-      # the data and seq lens
-      hdf_data = f["inputs"][()]
-      seq_lens = f["seqLengths"][()][:, 0]
-      # cut out each seq from the flattened 1d tensor according to its seq len and store it in the dict
-      # indexed by its seq tag
-      for i, seq_len in enumerate(seq_lens):
-        data_dict[seq_tags[i]] = hdf_data[:seq_len]
-        hdf_data = hdf_data[seq_len:]
-    return data_dict
+    return SimpleHDFReader(hdf_path.get_path())
 
   def run(self):
     json_vocab_path = self.json_vocab_path.get_path()
@@ -258,6 +246,13 @@ class CalcSearchErrorJobV2(Job):
       #     f.write(log_txt)
 
 
+    # all data was read, close the hdf files
+    for key in ("label_sync_scores_ground_truth", "frame_sync_scores_ground_truth", "label_sync_scores_search",
+                "frame_sync_scores_search"):
+      for hdf_reader in data_dict[key].values():
+        hdf_reader.close()
+    data_dict["targets_ground_truth"].close()
+    data_dict["targets_search"].close()
 
     with open(self.out_search_errors.get_path(), "w+") as f:
       f.write("Search errors: %f%%" % ((num_search_errors / num_seqs) * 100))
@@ -199,9 +199,14 @@ def search_dataset(
         )
         res = search_job.out_search_file
     else:
-        out_files = [_v2_forward_out_filename]
-        if config and config.get("__recog_def_ext", False):
-            out_files.append(_v2_forward_ext_out_filename)
+        recog_output_npz = bool(config and config.get("__recog_output_format", "py") == "npz")
+        if recog_output_npz:
+            # hyps and extra scores all go into the npz
+            out_files = [_v2_forward_out_npz_filename]
+        else:
+            out_files = [_v2_forward_out_filename]
+            if config and config.get("__recog_def_ext", False):
+                out_files.append(_v2_forward_ext_out_filename)
         search_job = ReturnnForwardJobV2(
             model_checkpoint=model.checkpoint,
             returnn_config=search_config_v2(
@@ -212,7 +217,12 @@ def search_dataset(
             returnn_root=tools_paths.get_returnn_root(),
             mem_rqmt=search_mem_rqmt,
         )
-        res = search_job.out_files[_v2_forward_out_filename]
+        if recog_output_npz:
+            from i6_experiments.users.zeyer.recog_output_npz import RecogOutputNpzToPyJob
+
+            res = RecogOutputNpzToPyJob(search_job.out_files[_v2_forward_out_npz_filename]).out_search_results
+        else:
+            res = search_job.out_files[_v2_forward_out_filename]
     if search_rqmt:
         search_job.rqmt.update(search_rqmt)
     if env_updates:
@@ -533,6 +543,7 @@ def _returnn_v2_forward_step(*, model, extern_data: TensorDict, **_kwargs_unused
 
 _v2_forward_out_filename = "output.py.gz"
 _v2_forward_ext_out_filename = "output_ext.py.gz"
+_v2_forward_out_npz_filename = "output.npz"  # with config __recog_output_format="npz", see recog_output_npz
 
 
 def _returnn_v2_get_forward_callback():
@@ -543,15 +554,24 @@ def _returnn_v2_get_forward_callback():
 
     config = get_global_config()
     recog_def_ext = config.bool("__recog_def_ext", False)
+    recog_output_format = config.value("__recog_output_format", "py")
+    assert recog_output_format in {"py", "npz"}, f"invalid __recog_output_format {recog_output_format!r}"
 
     class _ReturnnRecogV2ForwardCallbackIface(ForwardCallbackIface):
         def __init__(self):
             self.out_file: Optional[TextIO] = None
             self.out_ext_file: Optional[TextIO] = None
+            self.out_npz_writer = None
 
         def init(self, *, model):
             import gzip
 
+            if recog_output_format == "npz":
+                from i6_experiments.users.zeyer.recog_output_npz import RecogOutputNpzWriter
+
+                self.out_npz_writer = RecogOutputNpzWriter(_v2_forward_out_npz_filename)
+                return
+
             self.out_file = gzip.open(_v2_forward_out_filename, "wt")
             self.out_file.write("{\n")
 
@@ -570,6 +590,23 @@ def _returnn_v2_get_forward_callback():
             if hyps_len.raw_tensor.shape:
                 assert scores.raw_tensor.shape == hyps_len.raw_tensor.shape  # (beam,)
             num_beam = hyps.raw_tensor.shape[0]
+            if self.out_npz_writer:
+                if self.out_npz_writer.vocab is None:
+                    self.out_npz_writer.set_vocab(hyps.sparse_dim.vocab)
+                self.out_npz_writer.add_seq(
+                    seq_tag,
+                    hyps=[
+                        hyps.raw_tensor[i, : hyps_len.raw_tensor[i] if hyps_len.raw_tensor.shape else hyps_len.raw_tensor]
+                        for i in range(num_beam)
+                    ],
+                    scores=scores.raw_tensor,
+                    ext=(
+                        {k: v.raw_tensor for k, v in outputs.data.items() if k not in {"hyps", "scores"}}
+                        if recog_def_ext
+                        else None
+                    ),
+                )
+                return
             # Consistent to old search task, list[(float,str)].
             self.out_file.write(f"{seq_tag!r}: [\n")
             for i in range(num_beam):
@@ -591,6 +628,9 @@ def _returnn_v2_get_forward_callback():
                 self.out_ext_file.write("],\n")
 
         def finish(self):
+            if self.out_npz_writer:
+                self.out_npz_writer.close()
+                return
             self.out_file.write("}\n")
             self.out_file.close()
             if self.out_ext_file:
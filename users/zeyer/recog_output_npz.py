@@ -0,0 +1,326 @@
+"""
+Binary columnar format for recog outputs (N-best hyps with scores),
+as an alternative to the Python-literal dict in ``output.py.gz`` / ``output_ext.py.gz``,
+which becomes slow to parse and huge in memory for large N-best lists.
+
+The file is an uncompressed npz with the entries
+(S: num seqs, H: total num hyps over all seqs, N: total num tokens over all hyps):
+
+- ``seq_tags``: [S] str
+- ``seq_hyp_offsets``: [S+1] int64, hyps of seq s are ``seq_hyp_offsets[s]:seq_hyp_offsets[s+1]``
+- ``hyp_token_offsets``: [H+1] int64, tokens of hyp h are ``tokens[hyp_token_offsets[h]:hyp_token_offsets[h+1]]``
+- ``tokens``: [N] int32, label indices
+- ``scores``: [H]
+- ``vocab``: [V] str, the labels
+- ``seq_labels_format``: [] str, how the labels of a hyp are serialized, like ``Vocabulary.get_seq_labels``:
+  "words" (joined by space, e.g. ``Vocabulary``, ``BytePairEncoding``, ``SentencePieces``),
+  "chars" (concatenated, ``CharacterTargets``), "utf8" (the label indices are UTF-8 bytes, ``Utf8ByteTargets``)
+  or "strs" (any other ``get_seq_labels``, e.g. ``HuggingFaceTokenizer``, the serialized hyps are in ``hyp_strs``).
+  If missing, "words" is assumed.
+- ``hyp_strs``: [H] str, only with seq_labels_format "strs", the output of ``vocab.get_seq_labels`` for every hyp
+- ``ext.<key>``: [H,...] for every extra output of the recog def (``__recog_def_ext``)
+
+As the npz is not compressed, :class:`RecogOutputNpzReader` can memory-map all entries.
+:class:`RecogOutputNpzToPyJob` exports it to the old text format for the existing post-processing and scoring.
+"""
+
+from __future__ import annotations
+from typing import Optional, Any, Dict, List, Tuple, Sequence, Iterator
+import numpy
+
+try:
+    from sisyphus import Job, Task, tk
+except ImportError:  # standalone usage of the reader without Sisyphus, e.g. in scale_tuning/tuner_torch.py
+    Job = object
+    Task = tk = None
+
+SEQ_LABELS_FORMATS = ("words", "chars", "utf8", "strs")
+
+
+def get_seq_labels_format(vocab) -> str:
+    """
+    :param returnn.datasets.util.vocabulary.Vocabulary vocab:
+    :return: see the module docstring, such that :func:`labels_to_str` is the same as ``vocab.get_seq_labels``
+    """
+    from returnn.datasets.util.vocabulary import Vocabulary, CharacterTargets, Utf8ByteTargets
+
+    assert isinstance(vocab, Vocabulary), f"unsupported vocab {vocab}"
+    # Check the implementation which is actually used, subclasses might override it.
+    get_seq_labels = type(vocab).get_seq_labels
+    if get_seq_labels is Utf8ByteTargets.get_seq_labels:
+        return "utf8"
+    if get_seq_labels is CharacterTargets.get_seq_labels:
+        return "chars"
+    if get_seq_labels is Vocabulary.get_seq_labels:  # e.g. BytePairEncoding, SentencePieces
+        return "words"
+    # E.g. HuggingFaceTokenizer, which decodes via the tokenizer. Can not be reproduced from the labels alone.
+    return "strs"
+
+
+def labels_to_str(vocab: Sequence[str], seq: numpy.ndarray, *, seq_labels_format: str = "words") -> str:
+    """
+    :param vocab: labels
+    :param seq: 1D label indices
+    :param seq_labels_format: see the module docstring
+    :return: serialized hyp, same as ``Vocabulary.get_seq_labels``
+    """
+    if seq_labels_format == "words":
+        return " ".join(vocab[i] for i in seq.tolist())
+    if seq_labels_format == "chars":
+        return "".join(vocab[i] for i in seq.tolist())
+    if seq_labels_format == "utf8":
+        assert ((seq >= 0) & (seq < 256)).all(), f"invalid byte value, must be within 0-255: {seq}"
+        return bytearray(seq.astype(numpy.uint8)).decode(encoding="utf8")
+    if seq_labels_format == "strs":
+        raise ValueError("seq_labels_format 'strs' needs the vocab object, the hyps are stored serialized")
+    raise ValueError(f"invalid seq_labels_format {seq_labels_format!r}")
+
+
+class RecogOutputNpzWriter:
+    """
+    Collects the recog output of all seqs and writes the npz on :func:`close`.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.vocab: Optional[List[str]] = None
+        self.seq_labels_format = "words"
+        self._vocab_obj = None  # only for seq_labels_format "strs"
+        self._seq_tags: List[str] = []
+        self._seq_num_hyps: List[int] = []
+        self._hyp_lens: List[int] = []
+        self._tokens: List[numpy.ndarray] = []
+        self._hyp_strs: List[str] = []
+        self._scores: List[numpy.ndarray] = []
+        self._ext: Dict[str, List[numpy.ndarray]] = {}
+
+    def set_vocab(self, vocab):
+        """
+        :param returnn.datasets.util.vocabulary.Vocabulary vocab: labels and how they are serialized
+        """
+        self.vocab = vocab.labels
+        self.seq_labels_format = get_seq_labels_format(vocab)
+        if self.seq_labels_format == "strs":
+            self._vocab_obj = vocab
+
+    def add_seq(
+        self,
+        seq_tag: str,
+        *,
+        hyps: Sequence[numpy.ndarray],
+        scores: numpy.ndarray,
+        ext: Optional[Dict[str, numpy.ndarray]] = None,
+    ):
+        """
+        :param seq_tag:
+        :param hyps: label indices of every hyp in the beam
+        :param scores: [beam]
+        :param ext: key -> [beam,...]
+        """
+        assert len(hyps) == len(scores)
+        self._seq_tags.append(seq_tag)
+        self._seq_num_hyps.append(len(hyps))
+        for hyp in hyps:
+            self._hyp_lens.append(len(hyp))
+            self._tokens.append(numpy.asarray(hyp, dtype=numpy.int32))
+            if self.seq_labels_format == "strs":
+                self._hyp_strs.append(self._vocab_obj.get_seq_labels(numpy.asarray(hyp).tolist()))
+        self._scores.append(numpy.asarray(scores))
+        for k, v in (ext or {}).items():
+            assert len(v) == len(hyps)
+            self._ext.setdefault(k, []).append(numpy.asarray(v))
+
+    def close(self):
+        """write the file"""
+        assert self.vocab is not None or not self._tokens, "vocab not set"
+        arrays = dict(
+            seq_tags=numpy.array(self._seq_tags, dtype=str),
+            seq_hyp_offsets=numpy.concatenate([[0], numpy.cumsum(self._seq_num_hyps, dtype=numpy.int64)]),
+            hyp_token_offsets=numpy.concatenate([[0], numpy.cumsum(self._hyp_lens, dtype=numpy.int64)]),
+            tokens=numpy.concatenate(self._tokens) if self._tokens else numpy.zeros((0,), dtype=numpy.int32),
+            scores=numpy.concatenate(self._scores) if self._scores else numpy.zeros((0,), dtype=numpy.float32),
+            vocab=numpy.array(self.vocab or [], dtype=str),
+            seq_labels_format=numpy.array(self.seq_labels_format, dtype=str),
+        )
+        if self.seq_labels_format == "strs":
+            arrays["hyp_strs"] = numpy.array(self._hyp_strs, dtype=str)
+        for k, v in self._ext.items():
+            arrays[f"ext.{k}"] = numpy.concatenate(v)
+        with open(self.filename, "wb") as f:
+            numpy.savez(f, **arrays)
+
+
+class RecogOutputNpzReader:
+    """
+    Lazy reader for the npz recog output, see the module docstring for the format.
+    All entries are memory-mapped (if mmap), so only accessed seqs are read from disk.
+    """
+
+    def __init__(self, filename: str, *, mmap: bool = True):
+        self.filename = filename
+        self._arrays = _load_npz(filename, mmap=mmap)
+        self.seq_tags: numpy.ndarray = self._arrays["seq_tags"]
+        self.seq_hyp_offsets: numpy.ndarray = self._arrays["seq_hyp_offsets"]
+        self.hyp_token_offsets: numpy.ndarray = self._arrays["hyp_token_offsets"]
+        self.tokens: numpy.ndarray = self._arrays["tokens"]
+        self.scores: numpy.ndarray = self._arrays["scores"]
+        self.vocab: List[str] = self._arrays["vocab"].tolist()
+        self.seq_labels_format: str = (
+            str(self._arrays["seq_labels_format"]) if "seq_labels_format" in self._arrays else "words"
+        )
+        assert self.seq_labels_format in SEQ_LABELS_FORMATS, f"invalid seq_labels_format {self.seq_labels_format!r}"
+        self.hyp_strs: Optional[numpy.ndarray] = self._arrays["hyp_strs"] if self.seq_labels_format == "strs" else None
+        self.ext_keys: List[str] = [k[len("ext.") :] for k in self._arrays if k.startswith("ext.")]
+        self._seq_tag_to_idx: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.seq_tags)
+
+    def get_seq_idx(self, seq_tag: str) -> int:
+        """seq tag -> seq idx"""
+        if self._seq_tag_to_idx is None:
+            self._seq_tag_to_idx = {tag: i for i, tag in enumerate(self.seq_tags.tolist())}
+        return self._seq_tag_to_idx[seq_tag]
+
+    def _hyp_range(self, seq_idx: int) -> Tuple[int, int]:
+        return int(self.seq_hyp_offsets[seq_idx]), int(self.seq_hyp_offsets[seq_idx + 1])
+
+    def get_hyps(self, seq_idx: int) -> List[numpy.ndarray]:
+        """:return: label indices of every hyp of the seq"""
+        start, end = self._hyp_range(seq_idx)
+        offsets = numpy.asarray(self.hyp_token_offsets[start : end + 1])
+        tokens = numpy.asarray(self.tokens[offsets[0] : offsets[-1]])
+        return [tokens[a - offsets[0] : b - offsets[0]] for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def get_hyp_strs(self, seq_idx: int) -> List[str]:
+        """:return: serialized hyps, like ``Vocabulary.get_seq_labels``"""
+        if self.hyp_strs is not None:
+            start, end = self._hyp_range(seq_idx)
+            return [str(hyp) for hyp in self.hyp_strs[start:end]]
+        return [
+            labels_to_str(self.vocab, hyp, seq_labels_format=self.seq_labels_format) for hyp in self.get_hyps(seq_idx)
+        ]
+
+    def get_scores(self, seq_idx: int) -> numpy.ndarray:
+        """:return: [beam]"""
+        start, end = self._hyp_range(seq_idx)
+        return numpy.asarray(self.scores[start:end])
+
+    def get_ext(self, seq_idx: int) -> Dict[str, numpy.ndarray]:
+        """:return: key -> [beam,...]"""
+        start, end = self._hyp_range(seq_idx)
+        return {k: numpy.asarray(self._arrays[f"ext.{k}"][start:end]) for k in self.ext_keys}
+
+    def get_py_entry(self, seq_idx: int) -> List[Tuple[float, str]]:
+        """:return: same as the entry of the seq in output.py.gz"""
+        return [(float(score), hyp) for score, hyp in zip(self.get_scores(seq_idx), self.get_hyp_strs(seq_idx))]
+
+    def get_py_ext_entry(self, seq_idx: int) -> List[Dict[str, Any]]:
+        """:return: same as the entry of the seq in output_ext.py.gz"""
+        ext = self.get_ext(seq_idx)
+        start, end = self._hyp_range(seq_idx)
+        return [{k: v[i].tolist() for k, v in ext.items()} for i in range(end - start)]
+
+    def iter_py_entries(self) -> Iterator[Tuple[str, List[Tuple[float, str]]]]:
+        """:return: seq tag and entry, in the order of the file"""
+        for seq_idx, seq_tag in enumerate(self.seq_tags.tolist()):
+            yield seq_tag, self.get_py_entry(seq_idx)
+
+    def export_py(self, filename: str, *, ext_filename: Optional[str] = None):
+        """
+        Writes the old Python-literal format (gzipped if the filename ends with .gz).
+        """
+        import gzip
+
+        def _open(fn: str):
+            return gzip.open(fn, "wt") if fn.endswith(".gz") else open(fn, "wt")
+
+        with _open(filename) as out:
+            out.write("{\n")
+            for seq_tag, entry in self.iter_py_entries():
+                out.write(f"{seq_tag!r}: [\n")
+                for score, hyp in entry:
+                    out.write(f"  ({score!r}, {hyp!r}),\n")
+                out.write("],\n")
+            out.write("}\n")
+
+        if ext_filename:
+            with _open(ext_filename) as out:
+                out.write("{\n")
+                for seq_idx, seq_tag in enumerate(self.seq_tags.tolist()):
+                    out.write(f"{seq_tag!r}: [\n")
+                    for d in self.get_py_ext_entry(seq_idx):
+                        out.write(f"  {d!r},\n")
+                    out.write("],\n")
+                out.write("}\n")
+
+
+def _load_npz(filename: str, *, mmap: bool = True) -> Dict[str, numpy.ndarray]:
+    """
+    Like ``numpy.load`` for npz, but memory-maps uncompressed members
+    (``numpy.load`` ignores ``mmap_mode`` for npz files).
+    """
+    import zipfile
+    import struct
+
+    res = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, "rb") as f:
+        for info in zf.infolist():
+            assert info.filename.endswith(".npy")
+            name = info.filename[: -len(".npy")]
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                # skip the local file header, see the zip file format spec
+                f.seek(info.header_offset)
+                local_header = f.read(30)
+                name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                version = numpy.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+                elif version == (2, 0):
+                    shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+                else:
+                    shape, fortran_order, dtype = None, None, None
+                if dtype is not None and not dtype.hasobject and numpy.prod(shape) > 0:
+                    res[name] = numpy.memmap(
+                        filename,
+                        dtype=dtype,
+                        mode="r",
+                        offset=f.tell(),
+                        shape=shape,
+                        order="F" if fortran_order else "C",
+                    )
+                    continue
+            with zf.open(info) as member:
+                res[name] = numpy.lib.format.read_array(member, allow_pickle=False)
+    return res
+
+
+class RecogOutputNpzToPyJob(Job):
+    """
+    Exports the npz recog output to the old Python-literal format (``output.py.gz``),
+    which is what :class:`SearchRemoveLabelJob`, :class:`SearchTakeBestJob` etc. and the scoring expect.
+    """
+
+    def __init__(self, recog_output_npz: tk.Path, *, with_ext: bool = False):
+        """
+        :param recog_output_npz:
+        :param with_ext: also export the extra scores to ``output_ext.py.gz``
+        """
+        self.recog_output_npz = recog_output_npz
+        self.with_ext = with_ext
+
+        self.out_search_results = self.output_path("output.py.gz")
+        self.out_ext_search_results = self.output_path("output_ext.py.gz") if with_ext else None
+
+    def tasks(self):
+        """tasks"""
+        yield Task("run", mini_task=True)
+
+    def run(self):
+        """run"""
+        reader = RecogOutputNpzReader(self.recog_output_npz.get_path())
+        reader.export_py(
+            self.out_search_results.get_path(),
+            ext_filename=self.out_ext_search_results.get_path() if self.with_ext else None,
+        )
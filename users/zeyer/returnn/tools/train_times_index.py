@@ -0,0 +1,289 @@
+"""
+Index of the training throughput of all RETURNN training jobs in a work dir,
+based on the learning_rates files, like :mod:`check_train_times` does it for a single job.
+
+The index is a JSON file. Per job, it stores the mtime and size of the learning_rates file,
+and per epoch the train time, the number of train steps and the device.
+On an update, jobs where the learning_rates file did not change are skipped,
+and the logs are only read for new epochs where the learning_rates file does not contain the device
+(older RETURNN versions).
+
+Call this via:
+
+    export PYTHONPATH=recipe
+    python3 -m i6_experiments.users.zeyer.returnn.tools.train_times_index update
+    python3 -m i6_experiments.users.zeyer.returnn.tools.train_times_index query
+    python3 -m i6_experiments.users.zeyer.returnn.tools.train_times_index regressions
+"""
+
+from typing import Optional, Any, Dict, List, Tuple
+import os
+import json
+import time
+from glob import glob
+import numpy as np
+from i6_experiments.users.zeyer.returnn.tools.check_train_times import (
+    _read_scores_and_learning_rates,
+    _read_used_gpus_from_log,
+)
+
+INDEX_VERSION = 1
+DEFAULT_JOB_PATTERN = "i6_core/returnn/training/ReturnnTrainingJob.*"
+
+
+def load_index(filename: str) -> Dict[str, Any]:
+    """
+    :param filename: JSON file. if it does not exist, returns an empty index
+    """
+    if not os.path.exists(filename):
+        return {"version": INDEX_VERSION, "jobs": {}}
+    with open(filename) as f:
+        index = json.load(f)
+    assert index.get("version") == INDEX_VERSION, f"{filename}: unexpected version {index.get('version')}"
+    return index
+
+
+def save_index(index: Dict[str, Any], filename: str):
+    """
+    Writes the index atomically, i.e. a concurrent reader never sees a partially written file.
+    """
+    tmp_filename = f"{filename}.tmp.{os.getpid()}"
+    with open(tmp_filename, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def update_index(
+    index: Dict[str, Any], *, work_dir: str = "work", job_pattern: str = DEFAULT_JOB_PATTERN, verbose: bool = False
+) -> Tuple[int, int]:
+    """
+    Crawls the work dir for training jobs and updates the index inplace.
+
+    :param index: see :func:`load_index`
+    :param work_dir:
+    :param job_pattern: glob pattern of the job dirs, relative to the work dir
+    :param verbose:
+    :return: number of jobs found, number of jobs (re)parsed
+    """
+    jobs = index["jobs"]
+    num_found, num_parsed = 0, 0
+    for job_dir in sorted(glob(f"{work_dir}/{job_pattern}")):
+        job = os.path.relpath(job_dir, work_dir)
+        scores_and_lr_filename = _get_scores_and_lr_filename(job_dir)
+        if not scores_and_lr_filename:
+            continue
+        num_found += 1
+        st = os.stat(scores_and_lr_filename)
+        entry = jobs.get(job)
+        if entry and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            continue
+        if verbose:
+            print("parse:", job)
+        jobs[job] = _update_job_entry(job_dir, entry, scores_and_lr_filename=scores_and_lr_filename, stat=st)
+        num_parsed += 1
+    return num_found, num_parsed
+
+
+def _get_scores_and_lr_filename(job_dir: str) -> Optional[str]:
+    # Same logic as in get_training_times_per_epoch. work/ is the most recent one while the job is running.
+    for filename in [f"{job_dir}/work/learning_rates", f"{job_dir}/output/learning_rates"]:
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def _update_job_entry(
+    job_dir: str, entry: Optional[Dict[str, Any]], *, scores_and_lr_filename: str, stat: os.stat_result
+) -> Dict[str, Any]:
+    if entry is None:
+        from i6_experiments.users.zeyer.utils.job_aliases_from_log import get_job_aliases
+
+        info_filename = f"{job_dir}/info"
+        aliases = [alias for alias in get_job_aliases(job_dir) or [] if not alias.startswith("work/")]
+        entry = {
+            "config_hash": os.path.basename(job_dir).rsplit(".", 1)[-1],
+            "aliases": aliases,
+            "created": os.stat(info_filename).st_mtime if os.path.exists(info_filename) else stat.st_mtime,
+            "epochs": {},
+        }
+    entry["mtime"] = stat.st_mtime
+    entry["size"] = stat.st_size
+
+    epochs = entry["epochs"]
+    scores = _read_scores_and_learning_rates(scores_and_lr_filename)
+    new_epochs_without_device = []
+    for epoch, v in sorted(scores.items()):
+        if ":meta:epoch_train_time_secs" not in v or ":meta:epoch_num_train_steps" not in v:
+            continue  # not trained yet, or old RETURNN version
+        key = str(epoch)  # JSON keys are always str
+        if key in epochs:
+            continue
+        epochs[key] = {
+            "time": v[":meta:epoch_train_time_secs"],
+            "steps": v[":meta:epoch_num_train_steps"],
+            "device": v.get(":meta:device"),
+        }
+        if not epochs[key]["device"]:
+            new_epochs_without_device.append(key)
+
+    if new_epochs_without_device:
+        gpu = _get_gpu_from_logs(job_dir)
+        for key in new_epochs_without_device:
+            epochs[key]["device"] = gpu
+    return entry
+
+
+def _get_gpu_from_logs(job_dir: str) -> Optional[str]:
+    """
+    :return: the GPU if the logs are unique about it, otherwise None
+    """
+    if not os.path.exists(f"{job_dir}/engine") and not os.path.exists(f"{job_dir}/finished.tar.gz"):
+        return None
+    try:
+        gpus = _read_used_gpus_from_log(job_dir)
+    except AssertionError:  # no logs, or no GPU in the logs
+        return None
+    if len(gpus) != 1:
+        return None
+    return next(iter(gpus))
+
+
+def get_model_family(entry: Dict[str, Any], *, alias_depth: Optional[int] = None) -> str:
+    """
+    :param entry: job entry of the index
+    :param alias_depth: number of leading alias path components which define the family.
+        by default all except the last one, i.e. the alias dir
+    """
+    if not entry["aliases"]:
+        return "<no alias>"
+    parts = entry["aliases"][0].split("/")
+    if alias_depth is None:
+        alias_depth = max(len(parts) - 1, 1)
+    return "/".join(parts[:alias_depth])
+
+
+def get_job_steps_per_sec(entry: Dict[str, Any], *, ignore_first_n_epochs: int = 0) -> Dict[str, List[float]]:
+    """
+    :param entry: job entry of the index
+    :param ignore_first_n_epochs: see :func:`check_train_times.get_training_times_per_epoch`
+    :return: device -> steps/sec per epoch. the device can change when the job was restarted
+    """
+    res = {}
+    for epoch, v in sorted(entry["epochs"].items(), key=lambda item: int(item[0])):
+        if int(epoch) <= ignore_first_n_epochs or v["time"] <= 0:
+            continue
+        res.setdefault(v["device"] or "<unknown>", []).append(v["steps"] / v["time"])
+    return res
+
+
+def get_steps_per_sec_by_device_and_family(
+    index: Dict[str, Any], *, ignore_first_n_epochs: int = 0, alias_depth: Optional[int] = None
+) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """
+    :return: (device, family) -> median steps/sec per job
+    """
+    res = {}
+    for job, entry in index["jobs"].items():
+        family = get_model_family(entry, alias_depth=alias_depth)
+        for device, steps_per_sec in get_job_steps_per_sec(entry, ignore_first_n_epochs=ignore_first_n_epochs).items():
+            res.setdefault((device, family), {})[job] = float(np.median(steps_per_sec))
+    return res
+
+
+def get_regressions(
+    index: Dict[str, Any],
+    *,
+    threshold: float = 0.1,
+    ignore_first_n_epochs: int = 0,
+    alias_depth: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Compares every job to the previous job (by creation time) of the same model family on the same device.
+
+    :param index:
+    :param threshold: relative slowdown of the median steps/sec to count as a regression
+    :param ignore_first_n_epochs:
+    :param alias_depth: see :func:`get_model_family`
+    :return: list of regressions, as dicts with keys device, family, job, prev_job, steps_per_sec, prev_steps_per_sec
+    """
+    res = []
+    for (device, family), jobs in sorted(
+        get_steps_per_sec_by_device_and_family(
+            index, ignore_first_n_epochs=ignore_first_n_epochs, alias_depth=alias_depth
+        ).items()
+    ):
+        jobs_ordered = sorted(jobs.keys(), key=lambda job_: index["jobs"][job_]["created"])
+        for prev_job, job in zip(jobs_ordered[:-1], jobs_ordered[1:]):
+            if jobs[job] < jobs[prev_job] * (1.0 - threshold):
+                res.append(
+                    {
+                        "device": device,
+                        "family": family,
+                        "job": job,
+                        "prev_job": prev_job,
+                        "steps_per_sec": jobs[job],
+                        "prev_steps_per_sec": jobs[prev_job],
+                    }
+                )
+    return res
+
+
+def main():
+    import argparse
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("action", choices=["update", "query", "regressions"])
+    arg_parser.add_argument("--index", default="train_times_index.json", help="index file, JSON")
+    arg_parser.add_argument("--work-dir", default="work")
+    arg_parser.add_argument("--job-pattern", default=DEFAULT_JOB_PATTERN, help="glob pattern, relative to work dir")
+    arg_parser.add_argument("--ignore-first-n-epochs", type=int, default=0)
+    arg_parser.add_argument("--alias-depth", type=int, default=None, help="alias path components for the family")
+    arg_parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown for regressions")
+    arg_parser.add_argument("--verbose", action="store_true")
+    args = arg_parser.parse_args()
+
+    index = load_index(args.index)
+
+    if args.action == "update":
+        start_time = time.time()
+        num_found, num_parsed = update_index(
+            index, work_dir=args.work_dir, job_pattern=args.job_pattern, verbose=args.verbose
+        )
+        save_index(index, args.index)
+        print(f"found {num_found} jobs, parsed {num_parsed}, took {time.time() - start_time:.1f} secs")
+
+    elif args.action == "query":
+        res = get_steps_per_sec_by_device_and_family(
+            index, ignore_first_n_epochs=args.ignore_first_n_epochs, alias_depth=args.alias_depth
+        )
+        for (device, family), jobs in sorted(res.items()):
+            values = list(jobs.values())
+            print(
+                f"{device} {family}: num jobs {len(values)},"
+                f" median steps/sec {np.median(values):.2f}, min {min(values):.2f}, max {max(values):.2f}"
+            )
+            if args.verbose:
+                for job, steps_per_sec in sorted(jobs.items(), key=lambda item: item[1]):
+                    print(f"  {job}: {steps_per_sec:.2f}")
+
+    elif args.action == "regressions":
+        res = get_regressions(
+            index,
+            threshold=args.threshold,
+            ignore_first_n_epochs=args.ignore_first_n_epochs,
+            alias_depth=args.alias_depth,
+        )
+        for r in res:
+            print(
+                f"{r['device']} {r['family']}: {r['job']} {r['steps_per_sec']:.2f} steps/sec,"
+                f" previous {r['prev_job']} {r['prev_steps_per_sec']:.2f} steps/sec"
+                f" ({r['steps_per_sec'] / r['prev_steps_per_sec'] - 1.0:+.1%})"
+            )
+        print(f"{len(res)} regressions")
+
+    else:
+        raise ValueError(f"invalid action {args.action!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 Auto scaling, based on recog output.
 """
 
+import os
 import sys
 import argparse
 import gzip
@@ -15,7 +16,8 @@ def main():
     arg_parser.add_argument(
         "recog_output_dir",
         nargs="+",
-        help="from our recog, expect output.py.gz and output_ext.py.gz. assume first entry is ground truth",
+        help="from our recog, expect output.npz or output.py.gz and output_ext.py.gz."
+        " assume first entry is ground truth",
     )
     arg_parser.add_argument("--device", default="cpu")
     arg_parser.add_argument("--num-steps", type=int, default=10_000)
@@ -43,14 +45,18 @@ def main():
     exts = {}
     for fn in args.recog_output_dir:
         print(f"* Reading entries from {fn}...")
-        with gzip.open(fn + "/output.py.gz", "rt") as f:
-            hyps_f = eval(f.read())
-        with gzip.open(fn + "/output_ext.py.gz", "rt") as f:
-            exts_f = eval(f.read())
-        assert isinstance(hyps_f, dict) and isinstance(exts_f, dict) and set(hyps_f) == set(exts_f)
+        if os.path.exists(fn + "/output.npz"):
+            hyps_f, exts_f = _NpzEntries(fn + "/output.npz", ext=False), _NpzEntries(fn + "/output.npz", ext=True)
+        else:
+            with gzip.open(fn + "/output.py.gz", "rt") as f:
+                hyps_f = eval(f.read())
+            with gzip.open(fn + "/output_ext.py.gz", "rt") as f:
+                exts_f = eval(f.read())
+        assert set(hyps_f.keys()) == set(exts_f.keys())
         assert not set(hyps_f.keys()).intersection(hyps.keys())
-        hyps.update(hyps_f)
-        exts.update(exts_f)
+        # only references, the npz entries are read on access
+        hyps.update({seq_tag: hyps_f for seq_tag in hyps_f.keys()})
+        exts.update({seq_tag: exts_f for seq_tag in exts_f.keys()})
 
     print(f"* Processing data...")
     seq_tags = list(hyps)
@@ -65,8 +71,8 @@ def main():
 
     key_signs = None
     for seq_tag in seq_tags:
-        hyps_ = hyps[seq_tag]
-        exts_ = exts[seq_tag]
+        hyps_ = hyps[seq_tag][seq_tag]
+        exts_ = exts[seq_tag][seq_tag]
         assert isinstance(hyps_, list) and isinstance(exts_, list) and len(hyps_) == len(exts_)
         if not keys:
             keys = list(exts_[0].keys())
@@ -173,6 +179,30 @@ def main():
             print(f"(Or scale0 fixed anyway: Final loss: {_loss():.4f}, err: {_err():.4f}, {_scales_str()})")
 
 
+class _NpzEntries:
+    """
+    Read-only mapping seq tag -> entry like in output.py.gz or output_ext.py.gz, lazily from output.npz.
+    """
+
+    def __init__(self, filename: str, *, ext: bool):
+        try:
+            from i6_experiments.users.zeyer.recog_output_npz import RecogOutputNpzReader
+        except ImportError:  # running this script directly, without i6_experiments in the path
+            sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            from recog_output_npz import RecogOutputNpzReader
+
+        self.reader = RecogOutputNpzReader(filename)
+        self.ext = ext
+
+    def keys(self):
+        """seq tags"""
+        return self.reader.seq_tags.tolist()
+
+    def __getitem__(self, seq_tag: str):
+        seq_idx = self.reader.get_seq_idx(seq_tag)
+        return self.reader.get_py_ext_entry(seq_idx) if self.ext else self.reader.get_py_entry(seq_idx)
+
+
 def batch_gather(values: torch.Tensor, *, indices: torch.Tensor) -> torch.Tensor:
     """
     :param values: shape [Batch,Indices,ValuesDims...], e.g. [Batch,InBeam,...]
@@ -0,0 +1,109 @@
+"""
+Polyphase resampling with cached filters.
+
+Speed perturbation with a small discrete set of factors only needs a few different resampling ratios,
+so we design the anti-aliasing filter once per ratio and reuse it for every utterance,
+instead of redesigning it on every call as ``librosa.core.resample`` does.
+
+The filter is a Kaiser-windowed sinc with parameters similar to ``res_type="kaiser_fast"`` (resampy),
+so the result is close to, but not bitwise identical with, the librosa resampling.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional, Dict, Tuple
+import math
+import numpy as np
+
+if TYPE_CHECKING:
+    import torch
+
+
+class PolyphaseResampler:
+    """
+    Resampling from orig_sr to target_sr via upsampling by ``up``, low-pass filtering and downsampling by ``down``,
+    where up/down = target_sr/orig_sr. The filters are cached per (up, down).
+    """
+
+    def __init__(self, *, num_zeros: int = 16, rolloff: float = 0.85, kaiser_beta: float = 8.555):
+        """
+        :param num_zeros: number of zero crossings of the sinc on each side, defines the filter length
+        :param rolloff: cutoff relative to the Nyquist frequency of the lower sample rate
+        :param kaiser_beta: shape of the Kaiser window
+        """
+        self.num_zeros = num_zeros
+        self.rolloff = rolloff
+        self.kaiser_beta = kaiser_beta
+        self._filters: Dict[Tuple[int, int], np.ndarray] = {}
+        self._torch_filters: Dict[Tuple[int, int, str, str], torch.Tensor] = {}
+
+    @staticmethod
+    def get_ratio(orig_sr: int, target_sr: int) -> Tuple[int, int]:
+        """:return: up, down"""
+        g = math.gcd(int(orig_sr), int(target_sr))
+        return int(target_sr) // g, int(orig_sr) // g
+
+    def get_filter(self, up: int, down: int) -> np.ndarray:
+        """
+        :return: symmetric FIR filter of odd length, with unit gain at DC (w.r.t. the upsampled signal)
+        """
+        key = (up, down)
+        if key not in self._filters:
+            from scipy.signal import firwin
+
+            max_rate = max(up, down)
+            half_len = self.num_zeros * max_rate
+            self._filters[key] = firwin(
+                2 * half_len + 1, self.rolloff / max_rate, window=("kaiser", self.kaiser_beta)
+            ).astype(np.float64)
+        return self._filters[key]
+
+    def resample(self, audio: np.ndarray, *, orig_sr: int, target_sr: int) -> np.ndarray:
+        """
+        :param audio: shape (audio_len,)
+        :return: shape (ceil(audio_len * target_sr / orig_sr),)
+        """
+        from scipy.signal import resample_poly
+
+        up, down = self.get_ratio(orig_sr, target_sr)
+        if up == down:
+            return audio
+        return resample_poly(audio, up, down, window=self.get_filter(up, down)).astype(audio.dtype, copy=False)
+
+    def resample_torch(self, audio: torch.Tensor, *, orig_sr: int, target_sr: int) -> torch.Tensor:
+        """
+        Same as :func:`resample`, but for a batch of (padded) torch tensors.
+        The output length of a sequence of length n is ceil(n * up / down).
+
+        :param audio: shape (..., audio_len)
+        :return: shape (..., ceil(audio_len * up / down))
+        """
+        import torch
+
+        up, down = self.get_ratio(orig_sr, target_sr)
+        if up == down:
+            return audio
+        key = (up, down, str(audio.dtype), str(audio.device))
+        if key not in self._torch_filters:
+            self._torch_filters[key] = torch.tensor(
+                self.get_filter(up, down) * up, dtype=audio.dtype, device=audio.device
+            ).view(1, 1, -1)
+        weight = self._torch_filters[key]
+        half_len = (weight.size(-1) - 1) // 2
+        batch_shape = audio.shape[:-1]
+        x = audio.reshape(-1, 1, audio.size(-1))  # [B, 1, T]
+        # upsampling and filtering at once, y[n] = sum_i x[i] h[n - i * up]
+        y = torch.nn.functional.conv_transpose1d(x, weight, stride=up)  # [B, 1, (T-1)*up + len(h)]
+        out_len = -(-audio.size(-1) * up // down)  # ceil
+        y = y[:, 0, half_len : half_len + (out_len - 1) * down + 1 : down]  # [B, T']
+        return y.reshape(*batch_shape, out_len)
+
+
+_resampler: Optional[PolyphaseResampler] = None
+
+
+def get_polyphase_resampler() -> PolyphaseResampler:
+    """:return: resampler of this process, such that the filters are shared by all calls"""
+    global _resampler
+    if _resampler is None:
+        _resampler = PolyphaseResampler()
+    return _resampler
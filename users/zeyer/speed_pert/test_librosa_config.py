@@ -0,0 +1,44 @@
+"""
+Tests for :mod:`librosa_config`.
+
+Run via:
+
+    export PYTHONPATH=recipe
+    python3 -m pytest recipe/i6_experiments/users/zeyer/speed_pert/test_librosa_config.py
+"""
+
+import __future__
+import inspect
+import numpy as np
+import pytest
+
+
+def _get_func_from_source():
+    """
+    Like the RETURNN config serialization (CodeFromFunction), i.e. only the source of the function itself,
+    without any of the other module-level objects.
+    """
+    from i6_experiments.users.zeyer.speed_pert.librosa_config import speed_pert_librosa_config
+
+    code = inspect.getsource(speed_pert_librosa_config)
+    namespace = {}
+    exec(compile(code, "<config>", "exec", flags=__future__.annotations.compiler_flag), namespace)
+    return namespace["speed_pert_librosa_config"]
+
+
+def test_speed_pert_librosa_config_from_source():
+    config_mod = pytest.importorskip("returnn.config")
+    pytest.importorskip("librosa")
+
+    func = _get_func_from_source()
+    config = config_mod.Config({"speed_pert_discrete_values": [0.9, 1.0, 1.1]})
+    audio = np.random.RandomState(42).uniform(-1.0, 1.0, (16_000,)).astype(np.float32)
+    random_state = np.random.RandomState(1)
+    with config_mod.global_config_ctx(config):
+        lens = {len(func(audio, 16_000, random_state)) for _ in range(20)}
+        assert lens == {14_400, 16_000, 17_600}
+        assert config._speed_pert_librosa_config_opts is not None
+
+        # parsed only once
+        config._speed_pert_librosa_config_opts = (0.0, [1.1], [1.0], "librosa")
+        assert func(audio, 16_000, random_state) is audio